@@ -0,0 +1,221 @@
+import logging
+import math
+from typing import Any, Callable, Dict, List, Optional, Sequence
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Cross-venue spreads: selling on one venue against buying on the other
+SPREADS = {
+    'valr_over_ib': ('valr_bid', 'ib_ask'),  # buy IB, sell VALR
+    'ib_over_valr': ('ib_bid', 'valr_ask'),  # buy VALR, sell IB
+}
+
+
+class RollingStats:
+    """Mean and standard deviation over the last `window` values.
+
+    Uses a sliding Welford update, so each value costs O(1) and the result
+    does not drift the way running sum / sum-of-squares totals do.
+    """
+
+    __slots__ = ('window', '_values', '_pos', 'count', 'mean', '_m2')
+
+    def __init__(self, window: int):
+        self.window = window
+        self._values = np.zeros(window)
+        self._pos = 0
+        self.count = 0
+        self.mean = 0.0
+        self._m2 = 0.0
+
+    def update(self, x: float) -> None:
+        if self.count < self.window:
+            self.count += 1
+            delta = x - self.mean
+            self.mean += delta / self.count
+            self._m2 += delta * (x - self.mean)
+        else:
+            old = float(self._values[self._pos])
+            old_mean = self.mean
+            self.mean += (x - old) / self.window
+            self._m2 += (x - old) * (x - self.mean + old - old_mean)
+            if self._m2 < 0:
+                self._m2 = 0.0
+        self._values[self._pos] = x
+        self._pos = (self._pos + 1) % self.window
+
+    @property
+    def std(self) -> float:
+        return math.sqrt(self._m2 / (self.count - 1)) if self.count > 1 else 0.0
+
+    def zscore(self, x: float) -> Optional[float]:
+        std = self.std
+        return (x - self.mean) / std if std > 0 else None
+
+    def values(self) -> np.ndarray:
+        """Buffered values, oldest first"""
+        if self.count < self.window:
+            return self._values[:self.count].copy()
+        return np.roll(self._values, -self._pos)
+
+
+class Ewma:
+    """Exponentially weighted moving average and variance"""
+
+    __slots__ = ('alpha', 'mean', 'var', 'initialized')
+
+    def __init__(self, alpha: float):
+        self.alpha = alpha
+        self.mean = 0.0
+        self.var = 0.0
+        self.initialized = False
+
+    def update(self, x: float) -> None:
+        if not self.initialized:
+            self.mean = x
+            self.initialized = True
+            return
+        delta = x - self.mean
+        self.mean += self.alpha * delta
+        self.var = (1 - self.alpha) * (self.var + self.alpha * delta * delta)
+
+    @property
+    def std(self) -> float:
+        return math.sqrt(self.var)
+
+
+class ThresholdTrigger:
+    """Edge-triggered level crossing with hysteresis"""
+
+    __slots__ = ('level', 'hysteresis', 'active')
+
+    def __init__(self, level: float, hysteresis: float = 0.0):
+        self.level = level
+        self.hysteresis = hysteresis
+        self.active = False
+
+    def update(self, x: Optional[float]) -> Optional[str]:
+        """Return 'enter' or 'exit' when the level is crossed, otherwise None"""
+        if x is None:
+            return None
+        if not self.active and x >= self.level:
+            self.active = True
+            return 'enter'
+        if self.active and x < self.level - self.hysteresis:
+            self.active = False
+            return 'exit'
+        return None
+
+
+class SpreadSeries:
+    """Rolling statistics for one spread of one instrument"""
+
+    def __init__(self, name: str, windows: Sequence[int], ewma_alpha: float,
+                 quantiles: Sequence[float], alert_bps: float, alert_z: float):
+        self.name = name
+        self.windows = {w: RollingStats(w) for w in windows}
+        self.ewma = Ewma(ewma_alpha)
+        self.quantiles = list(quantiles)
+        self.level_trigger = ThresholdTrigger(alert_bps, hysteresis=alert_bps * 0.2)
+        self.z_trigger = ThresholdTrigger(alert_z, hysteresis=0.5)
+        self.last_rand: Optional[float] = None
+        self.last_bps: Optional[float] = None
+        self.last_z: Optional[float] = None
+
+    def update(self, rand: float, bps: float) -> List[str]:
+        """Fold in one observation (in bps) and return the triggers that fired"""
+        # z-score against the window before this value is added
+        self.last_z = self.windows[max(self.windows)].zscore(bps)
+        for stats in self.windows.values():
+            stats.update(bps)
+        self.ewma.update(bps)
+        self.last_rand = rand
+        self.last_bps = bps
+
+        fired = []
+        level = self.level_trigger.update(bps)
+        if level:
+            fired.append(f"level_{level}")
+        z = self.z_trigger.update(self.last_z)
+        if z:
+            fired.append(f"zscore_{z}")
+        return fired
+
+    def summary(self) -> Dict[str, Any]:
+        out: Dict[str, Any] = {'rand': self.last_rand, 'bps': self.last_bps, 'z': self.last_z,
+                               'ewma_bps': self.ewma.mean}
+        for window, stats in self.windows.items():
+            out[f'mean_{window}'] = stats.mean
+            out[f'std_{window}'] = stats.std
+            # Exact percentiles of the window's buffered values; only computed for summaries
+            values = stats.values()
+            estimates = np.quantile(values, self.quantiles) if len(values) else [None] * len(self.quantiles)
+            for q, estimate in zip(self.quantiles, estimates):
+                out[f'p{int(q * 100)}_{window}'] = None if estimate is None else float(estimate)
+        return out
+
+
+class SpreadAnalytics:
+    """Incremental cross-venue spread analytics for one instrument.
+
+    Fed with the same tick documents the collector stores. For both
+    directions (VALR bid over IB ask and IB bid over VALR ask) it keeps the
+    spread in rand and basis points of the IB mid, rolling mean / std /
+    z-score and percentiles over each tick-count window, and an EWMA.
+    `on_signal` is called when a spread crosses the bps level or its
+    z-score crosses the z level (and again when it falls back).
+    """
+
+    def __init__(self, instrument: str, windows: Sequence[int] = (100, 1000), ewma_alpha: float = 0.05,
+                 quantiles: Sequence[float] = (0.5, 0.95, 0.99), alert_bps: float = 50.0, alert_z: float = 3.0,
+                 on_signal: Optional[Callable[[Dict[str, Any]], None]] = None):
+        self.instrument = instrument
+        self.on_signal = on_signal
+        self.series = {name: SpreadSeries(name, windows, ewma_alpha, quantiles, alert_bps, alert_z)
+                       for name in SPREADS}
+        self.updates = 0
+        self.signals = 0
+        self.stale_ticks = 0
+
+    def on_tick(self, tick: Dict[str, Any]) -> None:
+        if tick.get('stale'):
+            self.stale_ticks += 1
+            return  # One leg is too old for the spread to be meaningful
+        ib_bid, ib_ask = tick.get('ib_bid'), tick.get('ib_ask')
+        if ib_bid is None or ib_ask is None:
+            return
+        mid = (ib_bid + ib_ask) / 2
+        if mid <= 0:
+            return
+        self.updates += 1
+        for name, (sell, buy) in SPREADS.items():
+            sell_price, buy_price = tick.get(sell), tick.get(buy)
+            if sell_price is None or buy_price is None:
+                continue
+            rand = sell_price - buy_price
+            series = self.series[name]
+            for trigger in series.update(rand, rand / mid * 1e4):
+                self._signal(series, trigger, tick)
+
+    def _signal(self, series: SpreadSeries, trigger: str, tick: Dict[str, Any]) -> None:
+        self.signals += 1
+        if self.on_signal is None:
+            return
+        event = {
+            'timestamp': tick['timestamp'],
+            'instrument': self.instrument,
+            'spread': series.name,
+            'trigger': trigger,
+            'rand': series.last_rand,
+            'bps': series.last_bps,
+            'zscore': series.last_z,
+            'quote_skew': tick.get('quote_skew'),
+        }
+        try:
+            self.on_signal(event)
+        except Exception as e:
+            logger.error(f"Error handling spread signal: {str(e)}")
+
+    def summary(self) -> Dict[str, Dict[str, Any]]:
+        return {name: series.summary() for name, series in self.series.items()}
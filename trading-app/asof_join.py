@@ -0,0 +1,141 @@
+import logging
+from typing import Any, Dict, Optional, Tuple
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+SKEW_POLICIES = ('flag', 'drop')
+SOURCES = ('ib', 'valr')
+
+
+def _check_policy(policy: str) -> str:
+    if policy not in SKEW_POLICIES:
+        raise ValueError(f"Unknown skew policy: {policy} (expected one of {', '.join(SKEW_POLICIES)})")
+    return policy
+
+
+class AsofJoiner:
+    """Streaming as-of join of IB and VALR quotes.
+
+    Every quote update produces a row holding the latest quote from each
+    venue, the time of each, and the skew between them. When the skew
+    exceeds `max_skew` seconds the row is flagged as stale or, with
+    policy 'drop', not produced at all. Times may be on any clock as long
+    as both venues use the same one (the collector uses time.monotonic()).
+
+    asof_join() applies the same rule to whole arrays of historical quotes.
+    """
+
+    __slots__ = ('max_skew', 'policy', '_quotes', 'joined', 'flagged', 'dropped', 'out_of_order')
+
+    def __init__(self, max_skew: Optional[float] = None, policy: str = 'flag'):
+        self.max_skew = max_skew
+        self.policy = _check_policy(policy)
+        # venue -> (time, bid, ask)
+        self._quotes: Dict[str, Optional[Tuple[float, float, float]]] = {'ib': None, 'valr': None}
+
+        self.joined = 0
+        self.flagged = 0
+        self.dropped = 0
+        self.out_of_order = 0
+
+    def quote(self, venue: str) -> Optional[Tuple[float, float, float]]:
+        return self._quotes[venue]
+
+    def touch(self, venue: str, t: float) -> None:
+        """Record that the venue re-confirmed its current quote at time t"""
+        quote = self._quotes[venue]
+        if quote is not None and t > quote[0]:
+            self._quotes[venue] = (t, quote[1], quote[2])
+
+    def update(self, venue: str, t: float, bid: float, ask: float) -> Optional[Dict[str, Any]]:
+        """Apply a new quote and return the joined row, or None"""
+        quote = self._quotes[venue]
+        if quote is not None and t < quote[0]:
+            self.out_of_order += 1
+            return None
+        self._quotes[venue] = (t, bid, ask)
+        return self.join(venue)
+
+    def join(self, source: str = 'sample') -> Optional[Dict[str, Any]]:
+        """Row from the latest quotes; None until both venues have quoted or if dropped for skew"""
+        ib, valr = self._quotes['ib'], self._quotes['valr']
+        if ib is None or valr is None:
+            return None
+        skew = abs(ib[0] - valr[0])
+        stale = self.max_skew is not None and skew > self.max_skew
+        if stale:
+            if self.policy == 'drop':
+                self.dropped += 1
+                return None
+            self.flagged += 1
+        self.joined += 1
+        return {
+            'source': source,
+            'ib_bid': ib[1],
+            'ib_ask': ib[2],
+            'valr_bid': valr[1],
+            'valr_ask': valr[2],
+            'ib_time': ib[0],
+            'valr_time': valr[0],
+            'quote_skew': skew,
+            'stale': stale
+        }
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'joined': self.joined,
+            'flagged': self.flagged,
+            'dropped': self.dropped,
+            'out_of_order': self.out_of_order
+        }
+
+
+def asof_join(ib_time: np.ndarray, ib_bid: np.ndarray, ib_ask: np.ndarray,
+              valr_time: np.ndarray, valr_bid: np.ndarray, valr_ask: np.ndarray,
+              max_skew: Optional[float] = None, policy: str = 'flag') -> Dict[str, np.ndarray]:
+    """Vectorised as-of join over two time-sorted quote streams.
+
+    Produces one row per quote in merged time order (IB first on equal
+    times), the rows feeding the quotes one by one through
+    AsofJoiner.update would give. Rows before both venues have quoted are
+    omitted. Only quote updates are modelled: a live joiner that is also
+    sent touch() calls holds fresher quote times, so its skew and stale
+    flags can differ.
+
+    Returns:
+        dict of arrays: time, source ('ib'/'valr'), ib_bid, ib_ask,
+        valr_bid, valr_ask, ib_time, valr_time, quote_skew, stale
+    """
+    _check_policy(policy)
+    ib_time = np.asarray(ib_time, dtype=float)
+    valr_time = np.asarray(valr_time, dtype=float)
+    times = np.concatenate((ib_time, valr_time))
+    is_valr = np.concatenate((np.zeros(len(ib_time), dtype=bool), np.ones(len(valr_time), dtype=bool)))
+    order = np.argsort(times, kind='stable')
+    times, is_valr = times[order], is_valr[order]
+
+    # Index of the latest quote from each venue at every merged event
+    i = np.cumsum(~is_valr) - 1
+    j = np.cumsum(is_valr) - 1
+    keep = (i >= 0) & (j >= 0)
+    i, j, times, is_valr = i[keep], j[keep], times[keep], is_valr[keep]
+
+    skew = np.abs(ib_time[i] - valr_time[j])
+    stale = skew > max_skew if max_skew is not None else np.zeros(len(skew), dtype=bool)
+    if policy == 'drop':
+        keep = ~stale
+        i, j, times, is_valr, skew, stale = i[keep], j[keep], times[keep], is_valr[keep], skew[keep], stale[keep]
+
+    return {
+        'time': times,
+        'source': np.where(is_valr, SOURCES[1], SOURCES[0]),
+        'ib_bid': np.asarray(ib_bid)[i],
+        'ib_ask': np.asarray(ib_ask)[i],
+        'valr_bid': np.asarray(valr_bid)[j],
+        'valr_ask': np.asarray(valr_ask)[j],
+        'ib_time': ib_time[i],
+        'valr_time': valr_time[j],
+        'quote_skew': skew,
+        'stale': stale
+    }
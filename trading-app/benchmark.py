@@ -0,0 +1,391 @@
+"""Benchmarks for the capture -> store pipeline."""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import subprocess
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+from types import SimpleNamespace
+from typing import Any, Callable, Dict, List, Optional, Tuple
+import numpy as np
+import psutil
+import mongodb
+import usdzar_db
+from db_writer import BatchWriter
+from replay import iter_frames
+from spool import TickSpool
+from tick_capture import TickCapture
+from valr_ws import ValrWebSocket
+
+try:
+    import mongomock
+except ImportError:  # only needed for --db memory
+    mongomock = None
+
+logger = logging.getLogger(__name__)
+
+STAGES = ('decode', 'handoff', 'write')
+PERCENTILES = (50, 99, 99.9)
+
+# Feed event: ('valr', raw websocket frame) or ('ib', {'symbol', 'bid', 'ask'})
+Event = Tuple[str, Any]
+
+
+def synthetic_events(n: int, levels: int = 40, seed: int = 1) -> List[Event]:
+    """A USDZAR / USDTZAR feed: two VALR book frames for every IB quote.
+
+    About half of the VALR frames move the top of the book; the rest only
+    change quantities deeper in the book, as most real updates do.
+    """
+    rng = random.Random(seed)
+    ib_mid, valr_mid = 18.45, 18.52
+    bid_qty = [round(rng.uniform(50, 5000), 2) for _ in range(levels)]
+    ask_qty = [round(rng.uniform(50, 5000), 2) for _ in range(levels)]
+    last_change = 1760000000000
+    events: List[Event] = []
+    for i in range(n):
+        if i % 3 == 0:
+            ib_mid += rng.gauss(0, 0.0005)
+            events.append(('ib', {'symbol': 'USDZAR', 'bid': round(ib_mid - 0.001, 5),
+                                  'ask': round(ib_mid + 0.001, 5)}))
+            continue
+        if rng.random() < 0.5:
+            valr_mid = round(valr_mid + rng.choice((-0.001, 0.001)), 3)
+        else:
+            side = bid_qty if rng.random() < 0.5 else ask_qty
+            side[rng.randrange(1, levels)] = round(rng.uniform(50, 5000), 2)
+        last_change += rng.randint(1, 200)
+        bids = [{'side': 'buy', 'quantity': str(q), 'price': f'{valr_mid - 0.005 - 0.001 * k:.3f}',
+                 'currencyPair': 'USDTZAR', 'orderCount': 1 + k % 4} for k, q in enumerate(bid_qty)]
+        asks = [{'side': 'sell', 'quantity': str(q), 'price': f'{valr_mid + 0.005 + 0.001 * k:.3f}',
+                 'currencyPair': 'USDTZAR', 'orderCount': 1 + k % 4} for k, q in enumerate(ask_qty)]
+        events.append(('valr', json.dumps({
+            'type': 'AGGREGATED_ORDERBOOK_UPDATE',
+            'currencyPairSymbol': 'USDTZAR',
+            'data': {'Asks': asks, 'Bids': bids, 'LastChange': last_change, 'SequenceNumber': i}
+        })))
+    return events
+
+
+def recorded_events(path: str, limit: Optional[int] = None) -> List[Event]:
+    """Feed events from a capture written with RECORD_FILE, in recorded order"""
+    events: List[Event] = []
+    for frame in iter_frames(path):
+        if frame['src'] == 'valr':
+            events.append(('valr', frame['msg']))
+        elif frame['src'] == 'ib':
+            events.append(('ib', frame))
+        if limit and len(events) >= limit:
+            break
+    return events
+
+
+def summarize(latencies_ns: np.ndarray, elapsed: float) -> Dict[str, Any]:
+    """Throughput and latency percentiles (microseconds) for one stage"""
+    n = len(latencies_ns)
+    result: Dict[str, Any] = {
+        'messages': n,
+        'elapsed_seconds': round(elapsed, 4),
+        'messages_per_second': round(n / elapsed, 1) if elapsed > 0 else None,
+    }
+    if n:
+        p50, p99, p999 = np.percentile(latencies_ns, PERCENTILES) / 1000
+        result.update({'p50_us': round(float(p50), 2), 'p99_us': round(float(p99), 2),
+                       'p999_us': round(float(p999), 2),
+                       'max_us': round(float(latencies_ns.max()) / 1000, 2)})
+    return result
+
+
+# -- stages ------------------------------------------------------------------
+# Each stage builds its own state so it can be run again for the memory pass,
+# and returns (per-message latencies in ns, elapsed seconds, extra details).
+
+async def bench_decode(events: List[Event], **_) -> Tuple[np.ndarray, float, Dict[str, Any]]:
+    frames = [payload for src, payload in events if src == 'valr']
+    ws = ValrWebSocket(pairs=['USDTZAR'])
+    ws.updates = asyncio.Queue()  # unbounded, so no update is dropped
+    latencies = np.empty(len(frames), dtype=np.int64)
+    clock = time.perf_counter_ns
+    start = time.perf_counter()
+    for i, frame in enumerate(frames):
+        t0 = clock()
+        await ws.on_message(frame)
+        latencies[i] = clock() - t0
+    elapsed = time.perf_counter() - start
+    return latencies, elapsed, {'json_backend': ws.decoder.backend, 'top_of_book_changes': ws.updates.qsize()}
+
+
+async def _valr_updates(events: List[Event]) -> List[Event]:
+    """Replace VALR frames with the top-of-book updates decoding them produces"""
+    ws = ValrWebSocket(pairs=['USDTZAR'])
+    ws.updates = asyncio.Queue()
+    out: List[Event] = []
+    for src, payload in events:
+        if src == 'ib':
+            out.append((src, payload))
+            continue
+        await ws.on_message(payload)
+        while not ws.updates.empty():
+            _, _, pair, bid, ask, event_time = ws.updates.get_nowait()
+            out.append(('valr', (pair, bid, ask, event_time)))
+    return out
+
+
+def _make_collector(spool_dir: Optional[str]):
+    """A PriceCollector configured from the environment, with storage discarded"""
+    os.environ['SPOOL_DIR'] = spool_dir or ''
+    os.environ.setdefault('VALR_API_KEY', 'benchmark')
+    os.environ.setdefault('VALR_API_SECRET', 'benchmark')
+    import collector as collector_module
+    collector = collector_module.PriceCollector()
+    collector.writer.write_batch = lambda batch, retry=False: len(batch)
+    collector.rollups._write = lambda pending: {}
+    return collector
+
+
+async def bench_handoff(events: List[Event], spool: bool = False, **_) -> Tuple[np.ndarray, float, Dict[str, Any]]:
+    updates = await _valr_updates(events)
+    spool_dir = tempfile.mkdtemp(prefix='bench-spool-') if spool else None
+    collector = _make_collector(spool_dir)
+    if isinstance(collector.writer, BatchWriter):
+        collector.writer.max_queue = len(updates) + 1  # measure the handoff, not queue-full drops
+    collector.writer.start()
+    captures = list(collector.captures.values())
+    by_pair = collector.captures_by_pair
+    latencies = np.empty(len(updates), dtype=np.int64)
+    clock = time.perf_counter_ns
+    try:
+        start = time.perf_counter()
+        for i, (src, payload) in enumerate(updates):
+            if src == 'valr':
+                pair, bid, ask, event_time = payload
+                recv_time, recv_mono = datetime.now(timezone.utc), time.monotonic()
+                t0 = clock()
+                for capture in by_pair.get(pair, ()):
+                    capture.on_valr_price(bid, ask, recv_time, recv_mono, event_time)
+            else:
+                ticker = SimpleNamespace(bid=payload['bid'], ask=payload['ask'], tickByTicks=())
+                capture = collector.captures.get(payload['symbol'], captures[0])
+                t0 = clock()
+                capture.on_ib_ticker(ticker)
+            latencies[i] = clock() - t0
+        elapsed = time.perf_counter() - start
+    finally:
+        await collector.writer.stop()
+        if spool_dir:
+            shutil.rmtree(spool_dir, ignore_errors=True)
+    return latencies, elapsed, {
+        'writer': type(collector.writer).__name__,
+        'ticks': sum(c.ticks_emitted for c in captures),
+    }
+
+
+async def _ticks(events: List[Event]) -> List[Dict[str, Any]]:
+    """The tick documents the capture emits for a feed"""
+    ticks: List[Dict[str, Any]] = []
+    capture = TickCapture(on_tick=ticks.append)
+    for src, payload in await _valr_updates(events):
+        if src == 'valr':
+            _, bid, ask, event_time = payload
+            capture.on_valr_price(bid, ask, event_time=event_time)
+        else:
+            capture.on_ib_ticker(SimpleNamespace(bid=payload['bid'], ask=payload['ask'], tickByTicks=()))
+    return ticks
+
+
+def _use_database(db: str) -> Optional[Callable[[List[Dict[str, Any]]], int]]:
+    """Point mongodb at the benchmark target; returns a write function or None for --db none"""
+    if db == 'none':
+        return None
+    if db == 'memory':
+        if mongomock is None:
+            raise SystemExit("--db memory needs mongomock (pip install mongomock); "
+                             "use --db none or a MongoDB URL instead")
+        mongodb.DATABASE_URL = 'mongodb://memory'
+        mongodb._mongo_client = mongomock.MongoClient()
+    else:
+        mongodb.close_connection()
+        mongodb.DATABASE_URL = db
+    collections = {'USDZAR': 'bench_usdzar'}
+
+    def write(batch: List[Dict[str, Any]], retry: bool = False) -> int:
+        return usdzar_db.insert_tick_batch(batch, collections, retry=retry)
+    return write
+
+
+def _drop_bench_collections() -> None:
+    with mongodb.db_connection() as database:
+        for name in database.list_collection_names():
+            if name.startswith('bench_'):
+                database.drop_collection(name)
+
+
+async def bench_write(events: List[Event], db: str = 'memory', spool: bool = False, batch_size: int = 500,
+                      batch_delay: float = 1.0, rate: float = 0, **_) -> Tuple[np.ndarray, float, Dict[str, Any]]:
+    docs = await _ticks(events)
+    insert = _use_database(db) or (lambda batch, retry=False: len(batch))
+    acks: List[Tuple[int, int]] = []  # (ack time ns, batch size), in write order
+
+    def write_batch(batch: List[Dict[str, Any]], retry: bool = False) -> int:
+        written = insert(batch, retry=retry)
+        acks.append((time.perf_counter_ns(), len(batch)))
+        return written
+
+    spool_dir = tempfile.mkdtemp(prefix='bench-spool-') if spool else None
+    if spool_dir:
+        writer = TickSpool(spool_dir, write_batch, segment_records=len(docs) + 1, replay_batch=batch_size)
+    else:
+        writer = BatchWriter(write_batch, max_batch=batch_size, max_delay=batch_delay, max_queue=len(docs) + 1)
+    submitted = np.empty(len(docs), dtype=np.int64)
+    clock = time.perf_counter_ns
+    try:
+        writer.start()
+        start = time.perf_counter()
+        for i, doc in enumerate(docs):
+            if rate:
+                delay = start + i / rate - time.perf_counter()
+                await asyncio.sleep(max(delay, 0))
+            else:
+                await asyncio.sleep(0)  # let the writer run between ticks, as it does live
+            submitted[i] = clock()
+            writer.submit(doc)
+        await writer.stop()
+        elapsed = time.perf_counter() - start
+    finally:
+        if spool_dir:
+            shutil.rmtree(spool_dir, ignore_errors=True)
+        if db != 'none':
+            _drop_bench_collections()
+    acked = np.repeat([t for t, _ in acks], [n for _, n in acks]).astype(np.int64)
+    n = min(len(acked), len(submitted))
+    return acked[:n] - submitted[:n], elapsed, {
+        'writer': type(writer).__name__,
+        'database': 'none' if db == 'none' else ('mongomock' if db == 'memory' else 'mongodb'),
+        'storage_mode': usdzar_db.STORAGE_MODE,
+        'batches': len(acks),
+        'mean_batch': round(n / len(acks), 1) if acks else 0,
+        'acknowledged': n,
+    }
+
+
+BENCHES = {'decode': bench_decode, 'handoff': bench_handoff, 'write': bench_write}
+
+
+async def run_stage(name: str, events: List[Event], memory: bool = True, **options) -> Dict[str, Any]:
+    bench = BENCHES[name]
+    latencies, elapsed, details = await bench(events, **options)
+    result = summarize(latencies, elapsed)
+    result.update(details)
+    if memory:
+        rss_before = psutil.Process().memory_info().rss
+        tracemalloc.start()
+        try:
+            await bench(events, **options)
+            current, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        result['memory_peak_kib'] = round(peak / 1024, 1)
+        result['memory_retained_kib'] = round(current / 1024, 1)
+        result['memory_peak_bytes_per_message'] = round(peak / len(latencies), 1) if len(latencies) else None
+        result['rss_growth_kib'] = round((psutil.Process().memory_info().rss - rss_before) / 1024, 1)
+    return result
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _last_run(path: str) -> Optional[Dict[str, Any]]:
+    try:
+        with open(path) as f:
+            lines = [line for line in f if line.strip()]
+    except FileNotFoundError:
+        return None
+    return json.loads(lines[-1]) if lines else None
+
+
+def print_report(run: Dict[str, Any], previous: Optional[Dict[str, Any]]) -> None:
+    print(f"{'stage':<8} {'msgs/s':>12} {'p50 us':>9} {'p99 us':>9} {'p999 us':>9} {'peak KiB':>10}  vs previous")
+    for name, stage in run['stages'].items():
+        change = ''
+        before = (previous or {}).get('stages', {}).get(name)
+        if before and before.get('messages_per_second') and stage.get('messages_per_second'):
+            ratio = stage['messages_per_second'] / before['messages_per_second'] - 1
+            change = f"{ratio:+.1%} msgs/s, p99 {before.get('p99_us')} -> {stage.get('p99_us')} us"
+        print(f"{name:<8} {stage.get('messages_per_second') or 0:>12,.0f} {stage.get('p50_us', 0):>9.1f} "
+              f"{stage.get('p99_us', 0):>9.1f} {stage.get('p999_us', 0):>9.1f} "
+              f"{stage.get('memory_peak_kib', 0):>10,.0f}  {change}")
+
+
+async def main(args) -> Dict[str, Any]:
+    if args.file:
+        events = recorded_events(args.file, args.messages)
+        feed = {'file': args.file}
+    else:
+        events = synthetic_events(args.messages, args.levels, args.seed)
+        feed = {'synthetic': True, 'levels': args.levels, 'seed': args.seed}
+    feed['events'] = len(events)
+    feed['write_rate'] = args.rate
+    stages = {}
+    for name in args.stages:
+        logger.info(f"Running {name} benchmark")
+        stages[name] = await run_stage(name, events, memory=not args.no_memory, db=args.db,
+                                       spool=args.spool, batch_size=args.batch_size,
+                                       batch_delay=args.batch_delay, rate=args.rate)
+    return {
+        'time': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'label': args.label,
+        'commit': _git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'numpy': np.__version__,
+        'feed': feed,
+        'stages': stages,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the capture -> store pipeline")
+    parser.add_argument('--file', help="Replay a capture written with RECORD_FILE instead of a synthetic feed")
+    parser.add_argument('--messages', type=int, default=30000, help="Feed events (synthetic) or limit (--file)")
+    parser.add_argument('--levels', type=int, default=40, help="Synthetic order book levels per side")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--stages', type=lambda s: [x.strip() for x in s.split(',') if x.strip()],
+                        default=list(STAGES), help=f"Comma-separated subset of {','.join(STAGES)}")
+    parser.add_argument('--db', default='memory', help="memory (mongomock), none, or a MongoDB URL")
+    parser.add_argument('--spool', action='store_true', help="Use the write-ahead spool instead of BatchWriter")
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument('--batch-delay', type=float, default=1.0, help="BatchWriter max_delay in seconds")
+    parser.add_argument('--rate', type=float, default=0,
+                        help="Ticks per second submitted in the write stage; 0 = as fast as possible")
+    parser.add_argument('--no-memory', action='store_true', help="Skip the tracemalloc pass")
+    parser.add_argument('--label', default=None, help="Name stored with the results, e.g. a branch")
+    parser.add_argument('--output', default='bench_results.jsonl', help="JSON-lines file results are appended to")
+    parser.add_argument('--json-backend', default=None, help="VALR decode backend (msgspec, orjson, json)")
+    parser.add_argument('--log-level', default='WARNING')
+    args = parser.parse_args()
+    unknown = set(args.stages) - set(STAGES)
+    if unknown:
+        parser.error(f"Unknown stage(s): {', '.join(sorted(unknown))}")
+    logging.getLogger().setLevel(args.log_level.upper())
+    if args.json_backend:
+        os.environ['VALR_JSON_BACKEND'] = args.json_backend
+
+    previous = _last_run(args.output)
+    run = asyncio.run(main(args))
+    with open(args.output, 'a') as f:
+        f.write(json.dumps(run) + '\n')
+    print_report(run, previous)
+    print(f"Results appended to {args.output}")
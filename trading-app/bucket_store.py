@@ -0,0 +1,100 @@
+import logging
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+from pymongo import UpdateOne
+
+logger = logging.getLogger(__name__)
+
+# Columns stored in each bucket, one array per field, aligned with 'timestamp'
+BUCKET_FIELDS = ['ib_bid', 'ib_ask', 'valr_bid', 'valr_ask', 'source',
+                 'ib_recv_time', 'valr_recv_time', 'valr_event_time', 'ib_recv_mono', 'valr_recv_mono',
+                 'quote_skew', 'stale', 'ib_mode', 'persist_time']
+MAX_BUCKET_SIZE = 5000  # Start a new document for the same minute beyond this
+
+
+def bucket_start(ts: datetime) -> datetime:
+    """Floor a timestamp to the start of its minute bucket"""
+    return ts.replace(second=0, microsecond=0)
+
+
+def _naive_utc(ts: Optional[datetime]) -> Optional[datetime]:
+    """Convert an aware datetime to the naive UTC form pymongo returns"""
+    if ts is None or ts.tzinfo is None:
+        return ts
+    return ts.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+def bucket_updates(docs: Iterable[Dict[str, Any]]) -> List[UpdateOne]:
+    """Build upserts appending UTC-timestamped documents to their minute buckets.
+
+    Documents for the same bucket are pushed in a single update so each
+    column array gains the same number of entries. Their _ids go into 'ids',
+    so a retried write can tell which rows are already stored.
+    """
+    groups: Dict[datetime, List[Dict[str, Any]]] = {}
+    for doc in docs:
+        groups.setdefault(bucket_start(doc['timestamp']), []).append(doc)
+
+    updates = []
+    for start, group in groups.items():
+        timestamps = [doc['timestamp'] for doc in group]
+        push = {'timestamp': {'$each': timestamps}, 'ids': {'$each': [doc['_id'] for doc in group]}}
+        for field in BUCKET_FIELDS:
+            push[field] = {'$each': [doc.get(field) for doc in group]}
+        updates.append(UpdateOne(
+            {'bucket_start': start, 'count': {'$lte': MAX_BUCKET_SIZE - len(group)}},
+            {
+                '$push': push,
+                '$inc': {'count': len(group)},
+                '$min': {'first': min(timestamps)},
+                '$max': {'last': max(timestamps)}
+            },
+            upsert=True
+        ))
+    return updates
+
+
+def unpack_bucket(bucket: Dict[str, Any], start_time: Optional[datetime] = None,
+                  end_time: Optional[datetime] = None, fields: Optional[List[str]] = None) -> Iterator[Dict[str, Any]]:
+    """Yield the row documents held in a bucket, optionally filtered by time"""
+    start_time = _naive_utc(start_time)
+    end_time = _naive_utc(end_time)
+    timestamps = bucket.get('timestamp', [])
+    columns = {}
+    for field in (fields or BUCKET_FIELDS):
+        if field == 'timestamp':
+            continue
+        values = bucket.get(field)
+        # Columns added after the bucket was started are not aligned; leave them out
+        if values is not None and len(values) == len(timestamps):
+            columns[field] = values
+    include_ts = not fields or 'timestamp' in fields
+
+    for i, ts in enumerate(timestamps):
+        if start_time is not None and ts < start_time:
+            continue
+        if end_time is not None and ts > end_time:
+            continue
+        row = {'timestamp': ts} if include_ts else {}
+        for field, values in columns.items():
+            row[field] = values[i]
+        yield row
+
+
+def latest_row(bucket: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Return the newest row in a bucket"""
+    timestamps = bucket.get('timestamp') or []
+    if not timestamps:
+        return None
+    newest = max(range(len(timestamps)), key=timestamps.__getitem__)
+    row = {'timestamp': timestamps[newest]}
+    for field in BUCKET_FIELDS:
+        values = bucket.get(field)
+        if values is not None and len(values) == len(timestamps):
+            row[field] = values[newest]
+    return row
+
+
+def range_query(start_time: datetime, end_time: datetime) -> Dict[str, Any]:
+    """Query matching every bucket that overlaps [start_time, end_time]"""
+    return {'first': {'$lte': end_time}, 'last': {'$gte': start_time}}
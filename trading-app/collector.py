@@ -1,4 +1,5 @@
 import asyncio
+import functools
 import logging
 import os
 import signal
@@ -6,14 +7,30 @@ import sys
 import subprocess
 import time
 import traceback
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 from zoneinfo import ZoneInfo
-import nest_asyncio
-import threading
+from typing import Dict, List, Optional
 from ib_insync import *
+import psutil
 from valr_ws import ValrWebSocket
-from usdzar_db import insert_usdzar_data
-from status import status
+from tick_capture import TickCapture, Downsampler
+from ib_failover import IBFailover, IBLink
+from market_data import TICK_MODES
+from usdzar_db import insert_tick_batch
+from instruments import load_instruments
+from db_writer import BatchWriter
+from spool import TickSpool
+from status import status, IB_GATEWAY_CONTAINER
+from supervisor import RecoveryStep, Supervisor
+from mongodb import close_connection, get_mongo_client
+from readiness import wait_for_gateway
+from gap_backfill import Pacer, backfill_gaps
+from tick_pubsub import TickPublisher
+import metrics
+import tick_store
+from analytics import SpreadAnalytics
+from rollups import RollupBuilder, parse_resolutions
+from replay import FrameRecorder
 
 # Configure logging
 logging.basicConfig(
@@ -21,299 +38,611 @@ logging.basicConfig(
     format='%(asctime)s - %(levelname)s - %(message)s'
 )
 
-# Allow nested event loops
-nest_asyncio.apply()
-
 class PriceCollector:
     def __init__(self):
-        # Initialize IB connection
-        self.ib = IB()
+        # IB connections: the primary gateway and, with IB_STANDBY_HOST set, a warm standby (see ib_failover.py)
+        self.ib_factory = IB  # replay.py swaps in a FakeIB
         self.connected_to_ib = False
+        # Tick-by-tick BidAsk quotes where entitled, falling back to reqMktData (see market_data.py)
+        tick_mode = os.environ.get('IB_TICK_MODE', 'tick_by_tick').lower()
+        self.market_data_type = int(os.environ.get('IB_MARKET_DATA_TYPE', '3'))  # 1 live, 3 delayed if not entitled
+        self.ib_link = IBLink('primary', os.environ.get('IB_HOST', '127.0.0.1'), int(os.environ.get('IB_PORT', '4002')),
+                              int(os.environ.get('IB_CLIENT_ID', '1')), IB_GATEWAY_CONTAINER, tick_mode)
+        self.ib_links = [self.ib_link]
+        standby_host = os.environ.get('IB_STANDBY_HOST')
+        if standby_host:
+            self.ib_links.append(IBLink('standby', standby_host,
+                                        int(os.environ.get('IB_STANDBY_PORT', str(self.ib_link.port))),
+                                        int(os.environ.get('IB_STANDBY_CLIENT_ID', '2')),
+                                        os.environ.get('IB_STANDBY_CONTAINER') or None, tick_mode))
+        self.failover = IBFailover(self.ib_links,
+                                   stale_after=float(os.environ.get('IB_FAILOVER_STALE_AFTER', '0.5')),
+                                   interval=float(os.environ.get('IB_FAILOVER_CHECK_INTERVAL', '0.2')),
+                                   dedup_window=float(os.environ.get('IB_DEDUP_WINDOW', '5')))
+        # Startup waits until the gateway answers an API handshake instead of sleeping a fixed time
+        self.probe_gateway = True  # replay.py turns this off
+        self.ib_ready_timeout = float(os.environ.get('IB_READY_TIMEOUT', '300'))
+        self.startup_delay = float(os.environ.get('IB_STARTUP_DELAY', '0'))  # optional extra fixed delay
+        # Seconds from process start to each startup milestone, up to the first tick stored in MongoDB
+        self.started_at = psutil.Process().create_time()
+        self.startup: Dict[str, float] = {}
         
-        # Store latest prices
-        self.ib_bid = None
-        self.ib_ask = None
-        self.valr_bid = None
-        self.valr_ask = None
-        self.last_timestamp = None
-
-        # Define callback before creating ValrWebSocket
-        def _on_valr_price_update(bid: float, ask: float):
-            self.valr_bid = bid
-            self.valr_ask = ask
-            # logging.info(f"VALR Price Update - Bid: {bid}, Ask: {ask}")
-
-        self.valr_ws = ValrWebSocket(on_price_update=_on_valr_price_update)
-        self.valr_ws_thread = None
+        # Instruments served over the IB connection(s) and VALR socket
+        self.instruments = load_instruments()
+        collections = {inst.name: inst.collection for inst in self.instruments}
+        write_batch = functools.partial(insert_tick_batch, collections=collections)
+
+        # Event-driven tick capture per instrument; 'sample' mode stores one downsampled row per interval
+        self.capture_mode = os.environ.get('CAPTURE_MODE', 'event').lower()
+        # IB and VALR quotes further apart than MAX_QUOTE_SKEW seconds are flagged stale (or dropped)
+        max_skew = os.environ.get('MAX_QUOTE_SKEW', '10')
+        self.captures = {inst.name: TickCapture(on_tick=self._on_tick, instrument=inst.name,
+                                                max_skew=float(max_skew) if max_skew else None,
+                                                skew_policy=os.environ.get('SKEW_POLICY', 'flag').lower())
+                         for inst in self.instruments}
+        self.captures_by_pair: Dict[str, List[TickCapture]] = {}
+        for inst in self.instruments:
+            self.captures_by_pair.setdefault(inst.valr_pair, []).append(self.captures[inst.name])
+        # Recent ticks are kept in memory per collection for fast in-process reads
+        buffer_size = int(os.environ.get('TICK_BUFFER_SIZE', '200000'))
+        self.rings = {inst.name: tick_store.register_ring(inst.collection, buffer_size)
+                      for inst in self.instruments}
+        # Cross-venue spread statistics over every captured tick
+        windows = [int(w) for w in os.environ.get('SPREAD_WINDOWS', '100,1000').split(',') if w.strip()]
+        self.analytics = {inst.name: SpreadAnalytics(inst.name, windows=windows,
+                                                     alert_bps=float(os.environ.get('SPREAD_ALERT_BPS', '50')),
+                                                     alert_z=float(os.environ.get('SPREAD_ALERT_Z', '3')),
+                                                     on_signal=self._on_spread_signal)
+                          for inst in self.instruments}
+        # OHLC / spread bars maintained from the same ticks
+        self.rollups = RollupBuilder(collections,
+                                     parse_resolutions(os.environ.get('ROLLUP_RESOLUTIONS', '1s,1m,5m,1h')),
+                                     flush_interval=float(os.environ.get('ROLLUP_FLUSH_INTERVAL', '1.0')))
+        self.rollup_task = None
+        self.downsampler = Downsampler(list(self.captures.values()), on_sample=self._on_sample,
+                                       interval=float(os.environ.get('SAMPLE_INTERVAL', '15')))
+        spool_dir = os.environ.get('SPOOL_DIR')
+        if spool_dir:
+            # Ticks go to a local write-ahead spool first and are replayed into MongoDB
+            self.writer = TickSpool(
+                spool_dir,
+                write_batch,
+                replay_batch=int(os.environ.get('WRITE_BATCH_SIZE', '500')),
+                on_flush=self._on_flush,
+                instruments=[inst.name for inst in self.instruments]
+            )
+        else:
+            self.writer = BatchWriter(
+                write_batch,
+                max_batch=int(os.environ.get('WRITE_BATCH_SIZE', '500')),
+                max_delay=float(os.environ.get('WRITE_BATCH_DELAY', '1.0')),
+                max_queue=int(os.environ.get('WRITE_QUEUE_SIZE', '100000')),
+                on_flush=self._on_flush
+            )
+        self.loop = None
+
+        # VALR runs on the same event loop; updates for every pair arrive through valr_ws.updates
+        self.valr_ws = ValrWebSocket(pairs=list(self.captures_by_pair))
+        self.valr_consumer = None
+
+        # RECORD_FILE captures raw feed traffic for replay.py
+        record_file = os.environ.get('RECORD_FILE')
+        self.recorder = FrameRecorder(record_file) if record_file else None
+        if self.recorder is not None:
+            self.valr_ws.on_raw = self.recorder.valr_frame
+        # Only the active IB link's ticker updates reach the captures
+        for inst in self.instruments:
+            handler = self.captures[inst.name].on_ib_ticker
+            if self.recorder is not None:
+                handler = self.recorder.ib_handler(handler)
+            self.failover.route(inst.name, handler)
         self.status = status
+        # Per-component health and recovery (see supervisor.py)
+        self.storage_error = None  # Set by a failed MongoDB write, cleared by the next successful one
+        self.valr_stale_after = float(os.environ.get('VALR_STALE_AFTER', '30'))
+        ib_stale_after = os.environ.get('IB_STALE_AFTER', '')  # off by default: FX is closed at weekends
+        self.ib_stale_after = float(ib_stale_after) if ib_stale_after else None
+        # Gaps in the stored history are backfilled from IB history (see gap_backfill.py)
+        backfill_interval = os.environ.get('BACKFILL_INTERVAL', '900')
+        self.backfill_interval = float(backfill_interval) if backfill_interval else None
+        self.backfill_lookback = float(os.environ.get('BACKFILL_LOOKBACK', '21600'))
+        self.backfill_min_gap = float(os.environ.get('BACKFILL_MIN_GAP', '60'))
+        self.backfill_method = os.environ.get('BACKFILL_METHOD', 'ticks').lower()
+        self.backfill_wakeup = None  # set when an outage ends, to backfill it without waiting for the interval
+        self.backfilled_rows = 0
+        # Live ticks are fanned out to local subscribers on TICK_SOCKET (see tick_pubsub.py); empty disables
+        tick_socket = os.environ.get('TICK_SOCKET')
+        self.publisher = TickPublisher(tick_socket,
+                                       max_buffer=int(os.environ.get('TICK_SOCKET_MAX_BUFFER', str(1 << 20))),
+                                       disconnect_after=float(os.environ.get('TICK_SOCKET_DISCONNECT_AFTER', '10'))
+                                       ) if tick_socket else None
+        self.exit_code = 0
+        self.main_task = None
+        self.supervisor = Supervisor(interval=float(os.environ.get('HEALTH_CHECK_INTERVAL', '1')),
+                                     outage_log=os.environ.get('OUTAGE_LOG') or None,
+                                     on_change=self._on_health_change)
+        self._register_components()
+        self._latency_marks = {}
+        self._register_metrics()
         
 
         # Setup signal handlers
         
 
-    async def connect_to_ib(self, max_retries=5):
-        """Connect to IB Gateway with retries and data farm verification"""
-        await asyncio.sleep(60)  # Initial delay to ensure IB Gateway is ready
-        retry_delay = 5  # Initial delay in seconds
+    @property
+    def ib(self) -> IB:
+        """The IB connection market data is currently taken from"""
+        return self.failover.active.ib
 
-        while True:  # Keep trying to connect indefinitely
-            for attempt in range(max_retries):
-                try:
-                    if hasattr(self, 'ib') and self.ib.isConnected():
-                        self.ib.disconnect()
-
-                    self.ib = IB()
-                    host = os.environ.get('IB_HOST', '127.0.0.1')
-                    port = int(os.environ.get('IB_PORT', '4002'))
-                    logging.info(f"Attempting to connect to IB Gateway (attempt {attempt + 1}/{max_retries})")
-                    
-                    await self.ib.connectAsync(host, port, clientId=1)
-                    await asyncio.sleep(2)  # Wait for connection to stabilize
-                    
-                    if not self.ib.isConnected():
-                        raise ConnectionError("Failed to connect to IB Gateway")
-                    
-                    # Check data farm connections
-                    account = self.ib.managedAccounts()[0]
-                    self.ib.reqMarketDataType(3)  # Request delayed market data
-                    
-                    logging.info("Successfully connected to IB Gateway")
-                    self.connected_to_ib = True
-                    return True
-                    
-                except Exception as e:
-                    logging.error(f"Failed to connect to IB Gateway (attempt {attempt + 1}): {str(e)}")
-                    self.status.set_inactive() 
-                    
-                    if attempt < max_retries - 1:
-                        await asyncio.sleep(retry_delay)
-                        retry_delay = min(retry_delay * 2, 60)
-                        # Double delay up to 60 seconds
-                    else:
-                        logging.error("Failed all immediate retries, waiting 60 seconds before starting over")
-                        await asyncio.sleep(60)
-                        retry_delay = 5  # Reset delay
-                        break  # Break inner loop to start fresh retry sequence
-                    
-            # If we get here, all retries in this round failed
-            logging.error("All connection attempts failed, waiting 60 seconds before next round")
-            await asyncio.sleep(60)
-            retry_delay = 5  # Reset delay
+    async def connect_ib(self, link: Optional[IBLink] = None):
+        """Open a fresh IB API connection and subscribe market data on it; raises on failure"""
+        link = link or self.ib_link
+        if link.connected:
+            link.ib.disconnect()
+        link.ib = self.ib_factory()
+        link.ib.disconnectedEvent += lambda: self.failover.on_disconnected(link)
+        logging.info(f"Connecting to IB Gateway {link}")
+        await link.ib.connectAsync(link.host, link.port, clientId=link.client_id)
+        if not link.ib.isConnected():
+            raise ConnectionError(f"Failed to connect to IB Gateway {link}")
+
+        # Check data farm connections
+        account = link.ib.managedAccounts()[0]
+        link.ib.reqMarketDataType(self.market_data_type)
+        logging.info(f"Successfully connected to IB Gateway {link}")
+        self.connected_to_ib = True
+        self._mark('ib_connected')
+        await self.subscribe_ib(link)
 
     def start_valr_websocket(self):
-        """Start VALR websocket connection in a separate thread"""
-        if self.valr_ws_thread is None or not self.valr_ws_thread.is_alive():
-            self.valr_ws_thread = threading.Thread(target=self.valr_ws.connect)
-            self.valr_ws_thread.daemon = True
-            self.valr_ws_thread.start()
+        """Start the VALR websocket task and the consumer feeding its updates to the capture"""
+        if not self.valr_ws.running:
+            self.valr_ws.start()
             logging.info("VALR websocket connection started")
-            
-    def get_valr_prices(self):
-        """Get VALR USDTZAR prices from websocket with retry mechanism"""
-        # Check if we need to restart the websocket
-        if self.valr_ws_thread is None or not self.valr_ws_thread.is_alive():
-            self.start_valr_websocket()
-            time.sleep(2)  # Give websocket time to connect
-        
-        # Check if we have valid prices
-        if self.valr_bid is None or self.valr_ask is None:
-            error_msg = "No valid VALR prices available"
-            raise ValueError(error_msg)
-            
-        # Check for stale prices (no updates in last 30 seconds)
-        if hasattr(self, 'last_valr_update') and time.time() - self.last_valr_update > 30:
-            error_msg = "VALR prices are stale"
-            # Force websocket restart
-            if self.valr_ws and self.valr_ws.ws:
-                self.valr_ws.unsubscribe_from_orderbook()
-            self.valr_ws_thread = None
-            raise ValueError(error_msg)
-            
-        return self.valr_bid, self.valr_ask
+        if self.valr_consumer is None or self.valr_consumer.done():
+            self.valr_consumer = asyncio.ensure_future(self.consume_valr_updates())
 
-    async def collect_prices(self):
-        """Collect and print prices from both sources"""
+    async def consume_valr_updates(self):
+        """Hand VALR top-of-book updates from the websocket queue to each pair's captures"""
+        while True:
+            recv_time, recv_mono, pair, bid, ask, event_time = await self.valr_ws.updates.get()
+            if event_time is not None:
+                metrics.valr_feed_latency_seconds.observe(recv_time.timestamp() - event_time)
+            for capture in self.captures_by_pair.get(pair, ()):
+                capture.on_valr_price(bid, ask, recv_time, recv_mono, event_time)
+
+    # -- supervision ---------------------------------------------------------
+
+    def _register_components(self):
+        """Health checks and recovery ladders for each IB link, VALR and MongoDB"""
+        for link in self.ib_links:
+            steps = [
+                RecoveryStep('resubscribe', functools.partial(self.resubscribe_ib, link), cooldown=15),
+                RecoveryStep('reconnect', functools.partial(self.connect_ib, link), attempts=3, cooldown=30),
+            ]
+            if link.container:
+                steps.append(RecoveryStep('restart_gateway', functools.partial(self.restart_gateway, link), cooldown=180))
+            # The standby is recovered the same way while the failover keeps data flowing from the other link
+            self.supervisor.register('ib' if link is self.ib_link else f'ib_{link.name}',
+                                     functools.partial(self._ib_problem, link), steps, threshold=2)
+        self.supervisor.register('valr', self._valr_problem, [
+            RecoveryStep('resubscribe', self.resubscribe_valr, cooldown=15),
+            RecoveryStep('reconnect', self.reconnect_valr, attempts=3, cooldown=30),
+            RecoveryStep('restart_app', self.restart_app, cooldown=300),
+        ], threshold=3)
+        # Restarting a container cannot fix the database and would lose queued ticks
+        self.supervisor.register('mongo', lambda: self.storage_error, [
+            RecoveryStep('reconnect', self.reconnect_mongo, cooldown=30),
+        ], threshold=1)
+
+    def _ib_problem(self, link: IBLink):
+        if not link.connected:
+            return "not connected"
+        if not link.subscriptions.open_subscriptions:
+            return "no market-data subscriptions"
+        if self.ib_stale_after and link.last_update:
+            age = time.monotonic() - max(link.last_update.values())
+            if age > self.ib_stale_after:
+                return f"no IB quotes for {age:.0f}s"
+        return None
+
+    def _valr_problem(self):
+        if not self.valr_ws.running:
+            return "websocket task stopped"
+        if self.valr_consumer is None or self.valr_consumer.done():
+            return "update consumer stopped"
+        if not self.valr_ws.connected:
+            return "not connected"
+        # Stale prices: no updates on any pair within VALR_STALE_AFTER seconds
+        updates = [c.last_valr_update for c in self.captures.values() if c.last_valr_update]
+        if updates:
+            age = (datetime.now(ZoneInfo("Africa/Johannesburg")) - max(updates)).total_seconds()
+            if age > self.valr_stale_after:
+                return f"no VALR quotes for {age:.0f}s"
+        return None
+
+    async def resubscribe_ib(self, link: IBLink):
+        if not link.connected:
+            return False
+        link.subscriptions.unsubscribe_all()
+        await self.subscribe_ib(link)
+
+    async def restart_gateway(self, link: IBLink):
+        await asyncio.get_running_loop().run_in_executor(None, self.status.restart_container, link.container)
+        if link.connected:
+            link.ib.disconnect()
+        await wait_for_gateway(link.host, link.port, timeout=self.ib_ready_timeout)
+        await self.connect_ib(link)
+
+    async def resubscribe_valr(self):
+        if not self.valr_ws.connected:
+            return False
+        await self.valr_ws.subscribe_to_orderbook()
+
+    async def reconnect_valr(self):
+        await self.valr_ws.restart()
+        self.start_valr_websocket()
+
+    async def reconnect_mongo(self):
+        """Drop the MongoDB client; the next write creates and pings a new one"""
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, close_connection)
+        await loop.run_in_executor(None, get_mongo_client)
+
+    async def restart_app(self):
+        """Exit with an error so Docker restarts this container; queued ticks are flushed first"""
+        logging.error("Restarting the trading-app container")
+        self.exit_code = 1
+        if self.main_task is not None:
+            self.main_task.cancel()
+
+    async def _connect_mongo(self):
+        """Create and ping the MongoDB client ahead of the first write"""
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, get_mongo_client)
+            self._mark('mongo_ready')
+        except Exception as e:
+            logging.error(f"MongoDB not reachable at startup: {str(e)}")
+
+    async def _start_ib_link(self, link: IBLink):
+        """Wait for the link's gateway to answer, then connect; failures are left to the supervisor"""
+        try:
+            if self.probe_gateway:
+                await wait_for_gateway(link.host, link.port, timeout=self.ib_ready_timeout)
+                self._mark('gateway_ready')
+            await self.connect_ib(link)
+        except Exception as e:
+            logging.error(f"Initial IB connection to {link} failed, leaving it to the supervisor: {str(e)}")
+
+    def _mark(self, milestone: str):
+        if milestone not in self.startup:
+            self.startup[milestone] = time.time() - self.started_at
+            logging.info(f"Startup milestone {milestone} after {self.startup[milestone]:.1f}s")
+
+    def _on_health_change(self, component):
+        if component.healthy:
+            if self.supervisor.all_healthy:
+                self.status.set_running()
+            if self.backfill_wakeup is not None and component.outages:
+                self.backfill_wakeup.set()
+        else:
+            self.status.set_inactive(f"{component.name}: {component.problem}")
+
+    def log_latency(self):
+        """Log mean VALR feed latency and IB/VALR quote skew since the last report"""
+        parts = []
+        for label, histogram in (('VALR feed latency', metrics.valr_feed_latency_seconds),
+                                 ('IB/VALR quote skew', metrics.quote_skew_seconds)):
+            last_sum, last_count = self._latency_marks.get(label, (0.0, 0))
+            count = histogram.count - last_count
+            if count:
+                parts.append(f"{label} {(histogram.sum - last_sum) / count * 1000:.0f} ms avg over {count}")
+            self._latency_marks[label] = (histogram.sum, histogram.count)
+        if parts:
+            logging.info(' | '.join(parts))
+
+    def log_valr_depth(self):
+        """Log executable VALR prices for each instrument's trade size from the full order book"""
+        for inst in self.instruments:
+            book = self.valr_ws.books.get(inst.valr_pair)
+            if book is None:
+                continue
+            sell = book.vwap('bid', quantity=inst.trade_size)
+            buy = book.vwap('ask', quantity=inst.trade_size)
+            imbalance = book.imbalance()
+            logging.info(f"VALR {inst.valr_pair} {inst.trade_size:g} | "
+                         f"Sell VWAP: {sell if sell is None else f'{sell:.4f}'} | "
+                         f"Buy VWAP: {buy if buy is None else f'{buy:.4f}'} | "
+                         f"Imbalance: {imbalance if imbalance is None else f'{imbalance:+.2f}'}")
+
+    def _register_metrics(self):
+        """Expose the counters the components already keep; read only when scraped.
+
+        Scrapes run on the metrics HTTP thread while the event loop changes
+        these dicts, so callbacks iterate list copies of them.
+        """
+        registry = metrics.registry
+        captures = self.captures.values()
+        registry.register_callback('collector_valr_messages_total', 'Messages received on the VALR websocket',
+                                   lambda: self.valr_ws.messages, kind='counter')
+        registry.register_callback('collector_valr_reconnects_total', 'VALR websocket reconnects',
+                                   lambda: self.valr_ws.reconnects, kind='counter')
+        registry.register_callback('collector_valr_dropped_updates_total', 'VALR updates dropped on a full queue',
+                                   lambda: self.valr_ws.dropped_updates, kind='counter')
+        registry.register_callback('collector_valr_queue_depth', 'VALR updates waiting for the consumer',
+                                   lambda: self.valr_ws.updates.qsize() if self.valr_ws.updates else 0)
+        registry.register_callback('collector_ib_updates_total', 'IB top-of-book changes per instrument',
+                                   lambda: [({'instrument': c.instrument}, c.ib_updates) for c in list(captures)],
+                                   kind='counter')
+        registry.register_callback('collector_ib_invalid_updates_total', 'IB ticker updates rejected as invalid',
+                                   lambda: [({'instrument': c.instrument}, c.invalid_ib_updates) for c in list(captures)],
+                                   kind='counter')
+        registry.register_callback('collector_valr_updates_total', 'VALR top-of-book changes per instrument',
+                                   lambda: [({'instrument': c.instrument}, c.valr_updates) for c in list(captures)],
+                                   kind='counter')
+        registry.register_callback('collector_ticks_total', 'Ticks captured per instrument',
+                                   lambda: [({'instrument': c.instrument}, c.ticks_emitted) for c in list(captures)],
+                                   kind='counter')
+        registry.register_callback('collector_seconds_since_update', 'Seconds since the last quote per source',
+                                   self._update_ages)
+        registry.register_callback('collector_ib_connected', 'Whether the active IB API connection is up',
+                                   lambda: 1 if self.failover.active.connected else 0)
+        registry.register_callback('collector_ib_resubscribes_total', 'IB market-data resubscriptions',
+                                   lambda: sum(link.subscriptions.resubscribes for link in self.ib_links),
+                                   kind='counter')
+        registry.register_callback('collector_ib_link_connected', 'Whether each IB link is connected',
+                                   lambda: [({'link': link.name}, 1 if link.connected else 0) for link in self.ib_links])
+        registry.register_callback('collector_ib_link_active', 'Which IB link market data is taken from',
+                                   lambda: [({'link': link.name}, 1 if link is self.failover.active else 0)
+                                            for link in self.ib_links])
+        registry.register_callback('collector_ib_link_updates_total', 'IB ticker updates received per link',
+                                   lambda: [({'link': link.name}, link.updates) for link in self.ib_links],
+                                   kind='counter')
+        registry.register_callback('collector_ib_tick_mode', 'IB subscriptions per link and delivery mode',
+                                   lambda: [({'link': link.name, 'mode': mode},
+                                             sum(1 for m in list(link.subscriptions.modes.values()) if m == mode))
+                                            for link in self.ib_links for mode in TICK_MODES])
+        registry.register_callback('collector_ib_tick_by_tick_fallbacks_total',
+                                   'Instruments moved from tick-by-tick to reqMktData after an IB error',
+                                   lambda: sum(link.subscriptions.fallbacks for link in self.ib_links), kind='counter')
+        registry.register_callback('collector_ib_failovers_total', 'Switches between IB links',
+                                   lambda: self.failover.failovers, kind='counter')
+        registry.register_callback('collector_ib_duplicate_updates_total',
+                                   'IB updates dropped as repeats after a failover',
+                                   lambda: self.failover.duplicates, kind='counter')
+        registry.register_callback('collector_writer', 'Storage writer statistics',
+                                   lambda: [({'stat': k}, v) for k, v in self.writer.stats().items()])
+        registry.register_callback('collector_rollups', 'Bar rollup statistics',
+                                   lambda: [({'stat': k}, v) for k, v in self.rollups.stats().items()])
+        registry.register_callback('collector_backfilled_rows_total', 'Rows backfilled from IB history into gaps',
+                                   lambda: self.backfilled_rows, kind='counter')
+        if self.publisher is not None:
+            registry.register_callback('collector_tick_subscribers', 'Processes subscribed to the live tick socket',
+                                       lambda: self.publisher.subscribers)
+            registry.register_callback('collector_ticks_published_total', 'Ticks published on the live tick socket',
+                                       lambda: self.publisher.seq, kind='counter')
+            registry.register_callback('collector_ticks_publish_dropped_total',
+                                       'Ticks skipped for subscribers that fell behind',
+                                       lambda: self.publisher.dropped, kind='counter')
+            registry.register_callback('collector_tick_subscriber_disconnects_total',
+                                       'Subscribers disconnected for falling behind',
+                                       lambda: self.publisher.disconnects, kind='counter')
+        registry.register_callback('collector_error_count', 'Components that went unhealthy since all were last healthy',
+                                   lambda: self.status.error_count)
+        registry.register_callback('collector_startup_seconds', 'Seconds from process start to each startup milestone',
+                                   lambda: [({'milestone': k}, v) for k, v in list(self.startup.items())])
+        components = self.supervisor.components.values()
+        registry.register_callback('collector_component_healthy', 'Whether each supervised component is healthy',
+                                   lambda: [({'component': c.name}, 1 if c.healthy else 0) for c in list(components)])
+        registry.register_callback('collector_component_breaker_open', 'Whether a component circuit breaker is open',
+                                   lambda: [({'component': c.name}, 0 if c.breaker.state == 'closed' else 1)
+                                            for c in list(components)])
+        registry.register_callback('collector_outages_total', 'Finished outages per component',
+                                   lambda: [({'component': c.name}, c.outages) for c in list(components)],
+                                   kind='counter')
+        registry.register_callback('collector_outage_seconds_total', 'Time spent in finished outages per component',
+                                   lambda: [({'component': c.name}, c.outage_seconds) for c in list(components)],
+                                   kind='counter')
+        registry.register_callback('collector_recovery_actions_total', 'Recovery actions run per component and step',
+                                   lambda: [({'component': c.name, 'action': a}, n)
+                                            for c in list(components) for a, n in list(c.actions.items())],
+                                   kind='counter')
+
+    def _update_ages(self):
+        now = datetime.now(ZoneInfo("Africa/Johannesburg"))
+        for capture in list(self.captures.values()):
+            for source, last in (('ib', capture.last_ib_update), ('valr', capture.last_valr_update)):
+                if last is not None:
+                    yield {'instrument': capture.instrument, 'source': source}, (now - last).total_seconds()
+
+    def _on_tick(self, tick):
+        """Queue a captured tick for storage (event mode stores every tick)"""
+        if 'first_tick' not in self.startup:
+            self._mark('first_tick')
+        if self.publisher is not None:
+            self.publisher.publish(tick)
+        metrics.quote_skew_seconds.observe(tick['quote_skew'])
+        self.analytics[tick['instrument']].on_tick(tick)
+        if self.rollups.resolutions:
+            self.rollups.on_tick(tick)
+        if self.capture_mode == 'event':
+            self._store(tick)
+
+    def _on_spread_signal(self, event):
+        zscore = f"{event['zscore']:.2f}" if event['zscore'] is not None else 'n/a'
+        skew = f"{event['quote_skew'] * 1000:.0f} ms" if event['quote_skew'] is not None else 'n/a'
+        logging.info(f"Spread {event['trigger']}: {event['instrument']} {event['spread']} "
+                     f"{event['rand']:.4f} ZAR ({event['bps']:.1f} bps, z {zscore}, quote skew {skew})")
+
+    def _on_sample(self, sample):
+        """Queue a downsampled row for storage (sample mode)"""
+        logging.info(f"{sample['instrument']} | IB Bid: {sample['ib_bid']:.4f} | IB Ask: {sample['ib_ask']:.4f} | "
+                     f"VALR Bid: {sample['valr_bid']:.4f} | VALR Ask: {sample['valr_ask']:.4f}")
+        self._store(sample)
+
+    def _store(self, doc):
+        """Buffer a row in memory and queue it for MongoDB"""
+        self.rings[doc['instrument']].append_doc(doc)
+        self.writer.submit(doc)
+
+    def _on_flush(self, ok: bool):
+        """Track storage health from each acknowledged batch"""
+        if ok:
+            self.storage_error = None
+            if 'first_stored_tick' not in self.startup:
+                self._mark('first_stored_tick')
+                logging.info("Startup: " + ', '.join(f"{name} {seconds:.1f}s" for name, seconds in self.startup.items()))
+        else:
+            logging.error("Failed to store price data in MongoDB")
+            self.storage_error = "MongoDB write failed"
+
+    async def subscribe_ib(self, link: Optional[IBLink] = None):
+        """Ensure every instrument's market-data subscription is live on the link's connection"""
+        link = link or self.ib_link
+        link.subscriptions.attach(link.ib)
+        for inst in self.instruments:
+            await link.subscriptions.subscribe(inst.name, inst.ib_contract(), self.failover.handler(link, inst.name))
+
+    async def backfill_loop(self):
+        """Backfill recent gaps in each instrument's history from the active IB connection"""
+        pacer = Pacer()
+        self.backfill_wakeup = asyncio.Event()
         while True:
             try:
-                # Check connection status
-                if not self.ib.isConnected():
-                    logging.warning("IB connection lost, attempting to reconnect...")
-                    connected = await self.connect_to_ib()
-                    if not connected:
-                        logging.error("Failed to reconnect to IB")
-                        await asyncio.sleep(20)
-                        continue
-
-                # Set up IB contract
+                await asyncio.wait_for(self.backfill_wakeup.wait(), self.backfill_interval)
+                # An outage just ended: give the first ticks after it time to be stored and close the gap
+                await asyncio.sleep(max(self.backfill_min_gap, 30))
+            except asyncio.TimeoutError:
+                pass
+            self.backfill_wakeup.clear()
+            link = self.failover.active
+            if not link.live:
+                continue
+            end = datetime.now(timezone.utc)
+            start = end - timedelta(seconds=self.backfill_lookback)
+            for inst in self.instruments:
                 try:
-                    usdzar = Forex('USDZAR')
-                    self.ib.qualifyContracts(usdzar)
-                    ticker = self.ib.reqMktData(usdzar)
+                    contract = await link.subscriptions.qualify(inst.name, inst.ib_contract())
+                    summary = await backfill_gaps(link.ib, contract, self.backfill_min_gap, start, end,
+                                                  inst.collection, self.backfill_method, pacer=pacer)
+                    self.backfilled_rows += summary['rows']
+                    if summary['gaps']:
+                        logging.info(f"Backfill {inst.name}: {summary}")
                 except Exception as e:
-                    if 'No security definition has been found for the request' in str(e):
-                        logging.error(f"IB contract error: {str(e)}")
-                        self.status.set_inactive()  # Track contract errors
-                        await asyncio.sleep(20)
-                        continue
-                
-                # Wait for initial market data
-                data_received = False
-                for _ in range(10):  # Try for up to 10 seconds
-                    if not self.ib.isConnected():
-                        break
-                    await asyncio.sleep(0.5)
-                    if ticker.bid and ticker.ask:
-                        data_received = True
-                        break
-                
-                if not data_received:
-                    logging.warning("No market data received, retrying...")
-                    await asyncio.sleep(20)
-                    continue
-
-                # Get VALR prices with retry mechanism
-                self.valr_bid, self.valr_ask = self.get_valr_prices()
-                
-                # Get IB prices with validation
-                if ticker.bid is not None and ticker.ask is not None:
-                    bid = abs(ticker.bid) if ticker.bid < 0 else ticker.bid  # Convert negative to positive
-                    ask = abs(ticker.ask) if ticker.ask < 0 else ticker.ask  # Convert negative to positive
-                    # Validate prices are above minimum threshold
-                    if bid >= 2 and ask >= 2:
-                        self.ib_bid = bid
-                        self.ib_ask = ask
-                        # Clear any previous errors and mark as running when prices are valid
-
-                    else:
-                        self.ib_bid = None
-                        self.ib_ask = None
-                        error_msg = f"Invalid IB prices detected: bid={bid}, ask={ask} (values below 2)"
-                        self.status.set_inactive()
-                        logging.info(error_msg)
-                        # logging.info(f"IB   USD/ZAR | Bid: {self.ib_bid:.4f} | Ask: {self.ib_ask:.4f}")
-                        logging.info(f"VALR USDTZAR | Bid: {self.valr_bid:.4f} | Ask: {self.valr_ask:.4f}")
-                        logging.info("Not storing data...")
-
-                        await asyncio.sleep(20)
-                        continue
-                
-                # Helper function to check if price is valid
-                def is_valid_price(p):
-                    return p is not None and not (isinstance(p, float) and (p != p))  # Check for None and NaN
-                    
-                # Store data in MongoDB if all prices are available and valid
-                if all(is_valid_price(x) for x in [self.ib_bid, self.ib_ask, self.valr_bid, self.valr_ask]):
-                    # Record timestamp right before storing
-                    current_time = datetime.now(ZoneInfo("Africa/Johannesburg"))
-                    
-                    # Log the valid prices
-                    logging.info(f"\nPrices at {current_time.strftime('%H:%M:%S')}:")
-                    logging.info(f"IB   USD/ZAR | Bid: {self.ib_bid:.4f} | Ask: {self.ib_ask:.4f}")
-                    logging.info(f"VALR USDTZAR | Bid: {self.valr_bid:.4f} | Ask: {self.valr_ask:.4f}")
-                    
-                    price_data = {
-                        'timestamp': current_time,
-                        'ib_bid': self.ib_bid,
-                        'ib_ask': self.ib_ask,
-                        'valr_bid': self.valr_bid,
-                        'valr_ask': self.valr_ask
-                    }
-                    
-                    try:
-                        if insert_usdzar_data(price_data):
-                            self.status.set_running()
-                            logging.info(f"Data stored successfully at {current_time.strftime('%H:%M:%S')} - IB: {self.ib_bid:.4f}/{self.ib_ask:.4f}, VALR: {self.valr_bid:.4f}/{self.valr_ask:.4f}")
-                        else:
-                            error_msg = "Failed to store price data in MongoDB"
-                            self.health_monitor.record_error(error_msg)
-                            logging.error(error_msg)
-                            self.telegram.telegram(f"⚠️ MongoDB Error: {error_msg}")
-                            await asyncio.sleep(20)
-                            continue
-                    except Exception as e:
-                        error_msg = f"Database error: {str(e)}"
-
-                        logging.error(error_msg)
-                        await asyncio.sleep(20)
-                        continue
-                else:
-                    missing = []
-                    if not is_valid_price(self.ib_bid) or not is_valid_price(self.ib_ask):
-                        missing.append("IB prices")
-                        logging.error("Invalid IB prices detected: bid={}, ask={}".format(self.ib_bid, self.ib_ask))
-                        self.status.set_inactive()  # Track IB price errors
-                    if not is_valid_price(self.valr_bid) or not is_valid_price(self.valr_ask):
-                        missing.append("VALR prices")
-                        logging.error("Invalid VALR prices detected: bid={}, ask={}".format(self.valr_bid, self.valr_ask))
-                        self.status.set_inactive()  # Track VALR price errors
-                    error_msg = f"Missing valid prices for: {', '.join(missing)}"
-                    logging.error(error_msg)
-                    await asyncio.sleep(20)
-                    continue
-
-            except Exception as e:
-                error_msg = f"Unexpected error in price collection: {str(e)}"
-
-                logging.error(error_msg)
- 
-                await asyncio.sleep(20)
-                continue
-            
-            # Wait for next update if everything was successful
-            await asyncio.sleep(15)
+                    logging.error(f"Backfill of {inst.name} failed: {str(e)}")
 
+    async def collect_prices(self):
+        """Report capture statistics while the supervisor keeps the feeds healthy"""
+        sampler_task = None
+        if self.capture_mode == 'sample':
+            logging.info(f"Downsampling ticks every {self.downsampler.interval} seconds")
+            sampler_task = asyncio.ensure_future(self.downsampler.run())
+        try:
+            while True:
+                await asyncio.sleep(60)
+                try:
+                    self.log_stats()
+                except Exception as e:
+                    logging.error(f"Error reporting statistics: {str(e)}")
+        finally:
+            if sampler_task:
+                sampler_task.cancel()
 
+    def log_stats(self):
+        for capture in self.captures.values():
+            logging.info(f"{capture.instrument}: captured {capture.ticks_emitted} ticks "
+                         f"(IB updates: {capture.ib_updates}, VALR updates: {capture.valr_updates}, "
+                         f"join: {capture.joiner.stats()})")
+        logging.info(f"Writer: {self.writer.stats()}")
+        for link in self.ib_links:
+            logging.info(f"IB subscriptions ({link.name}): {link.subscriptions.stats()}")
+        if len(self.ib_links) > 1:
+            logging.info(f"IB failover: {self.failover.stats()}")
+        logging.info(f"Rollups: {self.rollups.stats()}")
+        if self.publisher is not None:
+            logging.info(f"Tick publisher: {self.publisher.stats()}")
+        logging.info(f"Health: {self.supervisor.stats()}")
+        self.log_latency()
+        self.log_valr_depth()
+        for name, analytics in self.analytics.items():
+            for spread, stats in analytics.summary().items():
+                if stats['bps'] is not None:
+                    window = max(analytics.series[spread].windows)
+                    logging.info(f"{name} {spread}: {stats['bps']:.1f} bps "
+                                 f"(EWMA {stats['ewma_bps']:.1f}, p95 of last {window} {stats[f'p95_{window}']:.1f})")
 
     async def run(self):
         """Main run function"""
+        supervisor_task = None
+        mongo_task = None
+        failover_task = None
+        backfill_task = None
         try:
-            logging.info("Starting USD/ZAR price streaming service...")
-            logging.info("Waiting 60 seconds for IB Gateway to be fully ready...")
-            await asyncio.sleep(60)  # Initial delay to ensure IB Gateway is ready
-            
-            retry_count = 0
-            stable_connection_time = 0
-            
-            while True:
+            logging.info(f"Starting price streaming service for {', '.join(self.captures)}...")
+            self.loop = asyncio.get_running_loop()
+            metrics_port = os.environ.get('METRICS_PORT', '9108')
+            if metrics_port:
+                metrics.start_http_server(int(metrics_port))
+            self.writer.start()
+            if self.publisher is not None:
                 try:
-                    # Start VALR websocket
-                    self.start_valr_websocket()
-                    
-                    # Connect to IB
-                    if not await self.connect_to_ib():
-                        retry_count += 1
-                        wait_time = min(30 * retry_count, 300)  # Exponential backoff, max 5 minutes
-                        logging.error(f"Connection failed. Retrying in {wait_time} seconds... (Attempt {retry_count})")
-                        await asyncio.sleep(wait_time)
-                        continue
-                    
-                    # Reset retry count if we've been connected for more than 5 minutes
-                    current_time = time.time()
-                    if current_time - stable_connection_time > 300:
-                        retry_count = 0
-                        stable_connection_time = current_time
-                    
-                    logging.info("Starting price collection...")
-                    await self.collect_prices()
-                    
-                except Exception as e:
-                    logging.error(f"Error occurred: {e}")
-                    retry_count += 1
-                    wait_time = min(30 * retry_count, 300)  # Exponential backoff, max 5 minutes
-                    logging.error(f"Reconnecting in {wait_time} seconds... (Attempt {retry_count})")
-                    if self.ib and self.ib.isConnected():
-                        self.ib.disconnect()
-                    await asyncio.sleep(wait_time)
-                    
+                    await self.publisher.start()
+                except OSError as e:
+                    # Subscribers are optional; capture and storage carry on without them
+                    logging.error(f"Could not publish ticks on {self.publisher.path}: {str(e)}")
+            self.rollup_task = asyncio.ensure_future(self.rollups.run())
+            self.main_task = asyncio.current_task()
+            for sig in (signal.SIGTERM, signal.SIGINT):
+                self.loop.add_signal_handler(sig, self.main_task.cancel)
+            if self.startup_delay:
+                logging.info(f"Waiting {self.startup_delay:.0f} seconds before connecting...")
+                await asyncio.sleep(self.startup_delay)
+
+            # VALR and MongoDB come up while the gateway is still starting
+            self.start_valr_websocket()
+            mongo_task = asyncio.ensure_future(self._connect_mongo())
+            await asyncio.gather(*(self._start_ib_link(link) for link in self.ib_links))
+            if len(self.ib_links) > 1:
+                logging.info(f"IB standby: {self.failover.standby}, failover after "
+                             f"{self.failover.stale_after}s without updates")
+                failover_task = asyncio.ensure_future(self.failover.run())
+            # From here on IB, VALR and MongoDB are each recovered by the supervisor
+            supervisor_task = asyncio.ensure_future(self.supervisor.run())
+            if self.backfill_interval:
+                backfill_task = asyncio.ensure_future(self.backfill_loop())
+            logging.info("Starting price collection...")
+            await self.collect_prices()
+
+        except asyncio.CancelledError:
+            logging.info("Shutdown requested")
         except Exception as e:
             error_msg = f"Fatal error in price collector: {str(e)}"
             logging.error(error_msg)
             raise
+        finally:
+            if mongo_task and not mongo_task.done():
+                mongo_task.cancel()
+            if failover_task:
+                failover_task.cancel()
+            if backfill_task:
+                backfill_task.cancel()
+            if supervisor_task:
+                supervisor_task.cancel()
+                await asyncio.gather(supervisor_task, return_exceptions=True)
+            if self.rollup_task:
+                self.rollup_task.cancel()
+                await asyncio.gather(self.rollup_task, return_exceptions=True)
+            await self.writer.stop()
+            if self.publisher is not None:
+                await self.publisher.stop()
+            if self.recorder is not None:
+                self.recorder.close()
 
 if __name__ == "__main__":
     collector = PriceCollector()
     try:
         asyncio.run(collector.run())
+        sys.exit(collector.exit_code)  # non-zero when the supervisor asked for a container restart
 
     except Exception as e:
         error_msg = f"❌ Fatal error: {str(e)}\n{traceback.format_exc()}"
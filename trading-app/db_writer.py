@@ -0,0 +1,164 @@
+import asyncio
+import functools
+import logging
+import time
+from typing import Any, Callable, Dict, List, Optional
+import metrics
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()  # Queue sentinel telling the flush task to finish
+
+
+class BatchWriter:
+    """Background MongoDB writer fed through a bounded queue.
+
+    `submit` never blocks: the capture path hands a document over and moves
+    on. A background task collects documents into batches and flushes them
+    with `write_batch` (run in a worker thread, since pymongo is blocking)
+    once `max_batch` documents are pending or `max_delay` seconds have
+    passed since the first one arrived. When the queue is full new documents
+    are dropped and counted rather than stalling market-data handling.
+
+    A batch is retried until every document is acknowledged. Retries call
+    `write_batch(batch, retry=True)`, so the store can skip what an earlier
+    attempt already wrote.
+    """
+
+    def __init__(self, write_batch: Callable[..., int],
+                 max_batch: int = 500, max_delay: float = 1.0, max_queue: int = 100000,
+                 max_retries: int = 3, on_flush: Optional[Callable[[bool], None]] = None):
+        self.write_batch = write_batch
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.max_queue = max_queue
+        self.max_retries = max_retries
+        self.on_flush = on_flush
+        self.queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = False
+
+        # Backpressure / throughput metrics
+        self.submitted = 0
+        self.dropped = 0
+        self.written = 0
+        self.failed = 0
+        self.batches = 0
+        self.high_watermark = 0
+        self.last_batch_size = 0
+        self.last_flush_seconds = 0.0
+
+    def start(self) -> None:
+        """Start the flush task on the running event loop"""
+        if self._task is None or self._task.done():
+            self.queue = asyncio.Queue(maxsize=self.max_queue)
+            self._stopping = False
+            self._task = asyncio.ensure_future(self.run())
+
+    def submit(self, doc: Dict[str, Any]) -> bool:
+        """Queue a document for writing; returns False if it had to be dropped"""
+        if self.queue is None or self._stopping:
+            self.dropped += 1
+            return False
+        try:
+            self.queue.put_nowait(doc)
+        except asyncio.QueueFull:
+            self.dropped += 1
+            if self.dropped == 1 or self.dropped % 1000 == 0:
+                logger.warning(f"Writer queue full ({self.max_queue}), {self.dropped} documents dropped so far")
+            return False
+        self.submitted += 1
+        depth = self.queue.qsize()
+        if depth > self.high_watermark:
+            self.high_watermark = depth
+        return True
+
+    async def run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            first = await self.queue.get()
+            if first is _STOP:
+                return
+            batch = [first]
+            deadline = loop.time() + self.max_delay
+            stop = False
+            while len(batch) < self.max_batch:
+                # Take whatever is already queued before waiting on the clock
+                try:
+                    doc = self.queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        doc = await asyncio.wait_for(self.queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                if doc is _STOP:
+                    stop = True
+                    break
+                batch.append(doc)
+            await self._flush(batch)
+            if stop:
+                return
+
+    async def _flush(self, batch: List[Dict[str, Any]]) -> None:
+        loop = asyncio.get_running_loop()
+        for attempt in range(self.max_retries):
+            start = time.perf_counter()
+            try:
+                if attempt:
+                    inserted = await loop.run_in_executor(None, functools.partial(self.write_batch, batch, retry=True))
+                else:
+                    inserted = await loop.run_in_executor(None, self.write_batch, batch)
+            except Exception as e:
+                logger.error(f"Batch write failed (attempt {attempt + 1}/{self.max_retries}): {str(e)}")
+                inserted = 0
+            self.last_flush_seconds = time.perf_counter() - start
+            metrics.mongo_write_seconds.observe(self.last_flush_seconds)
+            if inserted == len(batch) or attempt == self.max_retries - 1:
+                break
+            await asyncio.sleep(min(2 ** attempt, 10))
+
+        self.batches += 1
+        self.last_batch_size = len(batch)
+        self.written += inserted
+        self.failed += len(batch) - inserted
+        metrics.mongo_batch_size.observe(len(batch))
+        if inserted:
+            metrics.observe_stored(batch)
+        if inserted < len(batch):
+            metrics.mongo_write_failures.inc()
+            logger.error(f"Only {inserted}/{len(batch)} documents acknowledged by MongoDB")
+        if self.on_flush:
+            self.on_flush(inserted == len(batch))
+
+    async def stop(self, timeout: float = 30) -> None:
+        """Stop accepting documents and flush everything still queued"""
+        if self._task is None:
+            return
+        self._stopping = True
+        logger.info(f"Draining {self.queue.qsize()} queued documents")
+        try:
+            # A full queue only takes the sentinel once the flush task has made room
+            await asyncio.wait_for(self._drain(), timeout)
+        except asyncio.TimeoutError:
+            logger.error(f"Timed out draining writer queue, {self.queue.qsize()} documents not written")
+        self._task = None
+
+    async def _drain(self) -> None:
+        await self.queue.put(_STOP)
+        await self._task
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'queue_depth': self.queue.qsize() if self.queue else 0,
+            'high_watermark': self.high_watermark,
+            'submitted': self.submitted,
+            'written': self.written,
+            'failed': self.failed,
+            'dropped': self.dropped,
+            'batches': self.batches,
+            'last_batch_size': self.last_batch_size,
+            'last_flush_ms': round(self.last_flush_seconds * 1000, 1)
+        }
@@ -0,0 +1,381 @@
+"""Find holes in the stored price history and backfill the IB side."""
+import argparse
+import asyncio
+import functools
+import itertools
+import logging
+import math
+import os
+import time
+from collections import deque
+from datetime import datetime, timedelta, timezone
+from typing import Any, Awaitable, Callable, Deque, Dict, Iterator, List, Optional, Tuple
+from ib_insync import Contract
+from mongodb import db_connection, close_connection
+import usdzar_db
+
+logger = logging.getLogger(__name__)
+
+BACKFILL_SOURCE = 'backfill'
+METHODS = ('ticks', 'bars')
+TICKS_PER_REQUEST = 1000
+EPOCH = datetime(1970, 1, 1)
+MAX_BAR_REQUEST = timedelta(days=1)  # IB caps the duration of one request for intraday bars
+BUCKET_SECONDS = 60  # Span of one bucket_store document
+
+
+class Gap:
+    """An interval without stored rows; both ends are aware UTC datetimes"""
+
+    __slots__ = ('start', 'end')
+
+    def __init__(self, start: datetime, end: datetime):
+        self.start = _aware(start)
+        self.end = _aware(end)
+
+    @property
+    def seconds(self) -> float:
+        return (self.end - self.start).total_seconds()
+
+    def __repr__(self) -> str:
+        return f"Gap({self.start.isoformat()} -> {self.end.isoformat()}, {self.seconds:.0f}s)"
+
+
+def _aware(value: datetime) -> datetime:
+    """pymongo returns naive UTC datetimes; make them aware so IB gets the right instant"""
+    return value.replace(tzinfo=timezone.utc) if value.tzinfo is None else value.astimezone(timezone.utc)
+
+
+def _naive(value: Optional[datetime]) -> Optional[datetime]:
+    return value.astimezone(timezone.utc).replace(tzinfo=None) if value is not None and value.tzinfo else value
+
+
+def backfill_log(db, collection: str = usdzar_db.DEFAULT_COLLECTION):
+    return db[f"{collection}_backfills"]
+
+
+def _spans(db, start: Optional[datetime], end: Optional[datetime], collection: str, mode: str,
+           width: float) -> Iterator[Tuple[datetime, datetime]]:
+    """First and last stored timestamp of each non-empty `width`-second slot, oldest first.
+
+    The slots are computed by MongoDB, so only one document per slot (one per
+    minute bucket in buckets mode) leaves the server. In buckets mode with
+    slots shorter than a bucket the bucket timestamps are slotted here.
+    """
+    coll = usdzar_db._collection(db, mode, collection)
+    if mode == 'buckets':
+        query: Dict[str, Any] = {}
+        if start is not None:
+            query['last'] = {'$gte': _naive(start)}
+        if end is not None:
+            query['first'] = {'$lte': _naive(end)}
+        if width < BUCKET_SECONDS:
+            # A gap inside one minute bucket can be longer than the slot
+            buckets = coll.find(query, projection={'_id': 0, 'bucket_start': 1, 'timestamp': 1}).sort('bucket_start', 1)
+            yield from _bucket_slots(buckets, _naive(start), _naive(end), width)
+            return
+        for bucket in coll.find(query, projection={'_id': 0, 'first': 1, 'last': 1}).sort('bucket_start', 1):
+            yield bucket['first'], bucket['last']
+        return
+    query = {}
+    if start is not None or end is not None:
+        query['timestamp'] = {}
+        if start is not None:
+            query['timestamp']['$gte'] = _naive(start)
+        if end is not None:
+            query['timestamp']['$lte'] = _naive(end)
+    millis = {'$subtract': ['$timestamp', EPOCH]}  # milliseconds since the epoch
+    pipeline = [
+        {'$match': query},
+        {'$project': {'_id': 0, 'timestamp': 1}},
+        {'$group': {'_id': {'$subtract': [millis, {'$mod': [millis, max(int(width * 1000), 1)]}]},
+                    'first': {'$min': '$timestamp'}, 'last': {'$max': '$timestamp'}}},
+        {'$sort': {'_id': 1}},
+    ]
+    for slot in coll.aggregate(pipeline, allowDiskUse=True):
+        yield slot['first'], slot['last']
+
+
+def _bucket_slots(buckets, start: Optional[datetime], end: Optional[datetime],
+                  width: float) -> Iterator[Tuple[datetime, datetime]]:
+    """First and last timestamp of each non-empty `width`-second slot in buckets sorted by bucket_start"""
+    slot_width = timedelta(milliseconds=max(int(width * 1000), 1))
+    for _, group in itertools.groupby(buckets, key=lambda bucket: bucket['bucket_start']):
+        # One minute can be split over several documents whose rows interleave
+        timestamps = sorted(ts for bucket in group for ts in bucket.get('timestamp', ())
+                            if (start is None or ts >= start) and (end is None or ts <= end))
+        for _, slot in itertools.groupby(timestamps, key=lambda ts: (ts - EPOCH) // slot_width):
+            slot = list(slot)
+            yield slot[0], slot[-1]
+
+
+def find_gaps(db, min_gap: float, start: Optional[datetime] = None, end: Optional[datetime] = None,
+              collection: str = usdzar_db.DEFAULT_COLLECTION, mode: Optional[str] = None,
+              skip_attempted: bool = True) -> List[Gap]:
+    """Intervals of more than `min_gap` seconds without stored rows between `start` and `end`.
+
+    Only gaps between two stored rows are reported: time before the first
+    and after the last row in the range counts as not collected yet.
+    """
+    mode = mode or usdzar_db.STORAGE_MODE
+    threshold = timedelta(seconds=min_gap)
+    gaps = []
+    previous = None
+    # Rows in one slot are at most min_gap apart, so every gap runs from a slot's last row to a later slot's first
+    for first, last in _spans(db, start, end, collection, mode, min_gap):
+        if previous is not None and first - previous > threshold:
+            gaps.append(Gap(previous, first))
+        if previous is None or last > previous:
+            previous = last
+    if skip_attempted and gaps:
+        attempts = list(backfill_log(db, collection).find(
+            {'start': {'$lte': _naive(gaps[-1].start)}, 'end': {'$gte': _naive(gaps[0].end)}},
+            projection={'_id': 0, 'start': 1, 'end': 1}))
+        gaps = [gap for gap in gaps
+                if not any(_aware(a['start']) <= gap.start and _aware(a['end']) >= gap.end for a in attempts)]
+    return gaps
+
+
+def record_attempt(db, gap: Gap, rows: int, requests: int, method: str,
+                   collection: str = usdzar_db.DEFAULT_COLLECTION, error: Optional[str] = None) -> None:
+    backfill_log(db, collection).insert_one({
+        'start': gap.start, 'end': gap.end, 'rows': rows, 'requests': requests, 'method': method,
+        'error': error, 'at': datetime.now(timezone.utc)
+    })
+
+
+class Pacer:
+    """Spaces out requests to stay within IB's historical data pacing limits.
+
+    At most `max_requests` in any `window` seconds and at least
+    `min_interval` seconds between two requests.
+    """
+
+    def __init__(self, max_requests: int = 60, window: float = 600, min_interval: float = 0.5,
+                 clock: Callable[[], float] = time.monotonic, sleep=asyncio.sleep):
+        self.max_requests = max_requests
+        self.window = window
+        self.min_interval = min_interval
+        self.clock = clock
+        self.sleep = sleep
+        self._sent: Deque[float] = deque()
+        self._lock: Optional[asyncio.Lock] = None  # created on first use, inside the running loop
+        self.waited = 0.0
+
+    async def acquire(self, weight: int = 1) -> None:
+        """Wait until `weight` more requests may be sent"""
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            while True:
+                now = self.clock()
+                while self._sent and now - self._sent[0] >= self.window:
+                    self._sent.popleft()
+                delay = 0.0
+                excess = len(self._sent) + weight - self.max_requests
+                if excess > 0:
+                    delay = self._sent[excess - 1] + self.window - now
+                if self._sent:
+                    delay = max(delay, self._sent[-1] + self.min_interval - now)
+                if delay <= 0:
+                    break
+                self.waited += delay
+                await self.sleep(delay)
+            self._sent.extend([self.clock()] * weight)
+
+
+class GapBackfiller:
+    """Fetch IB history for gaps and write it as backfilled rows.
+
+    `ib` needs reqHistoricalTicksAsync / reqHistoricalDataAsync (an
+    ib_insync.IB or a stub); `write` stores a list of rows and returns the
+    number written, by default usdzar_db.insert_usdzar_batch, run in a thread.
+    """
+
+    def __init__(self, ib, contract: Contract, collection: str = usdzar_db.DEFAULT_COLLECTION,
+                 method: str = 'ticks', bar_size: str = '1 min', concurrency: int = 4,
+                 pacer: Optional[Pacer] = None, write: Optional[Callable[[List[Dict[str, Any]]], int]] = None):
+        if method not in METHODS:
+            raise ValueError(f"Unknown backfill method: {method}")
+        self.ib = ib
+        self.contract = contract
+        self.collection = collection
+        self.method = method
+        self.bar_size = bar_size
+        self.concurrency = concurrency
+        self.pacer = pacer or Pacer()
+        self.write = write or functools.partial(usdzar_db.insert_usdzar_batch, collection=collection)
+
+        self.requests = 0
+        self.rows = 0
+        self.failed_gaps = 0
+
+    async def fetch(self, gap: Gap) -> List[Dict[str, Any]]:
+        """Backfill rows strictly inside the gap, oldest first"""
+        if self.method == 'bars':
+            return await self._fetch_bars(gap)
+        return await self._fetch_ticks(gap)
+
+    async def _fetch_ticks(self, gap: Gap) -> List[Dict[str, Any]]:
+        rows = []
+        seen = set()
+        start = gap.start
+        while start < gap.end:
+            await self.pacer.acquire()
+            self.requests += 1
+            ticks = await self.ib.reqHistoricalTicksAsync(self.contract, start, '', TICKS_PER_REQUEST,
+                                                          'BID_ASK', useRth=False, ignoreSize=True)
+            if not ticks:
+                break
+            for tick in ticks:
+                ts = _aware(tick.time)
+                if ts >= gap.end:
+                    return rows
+                key = (ts, tick.priceBid, tick.priceAsk)
+                if ts <= gap.start or key in seen:
+                    continue  # Pages overlap on the second they meet
+                seen.add(key)
+                rows.append(_row(ts, tick.priceBid, tick.priceAsk))
+            last = _aware(ticks[-1].time)
+            # A full page within one second would be requested again; move past it
+            start = last if last > start else start + timedelta(seconds=1)
+            if len(ticks) < TICKS_PER_REQUEST:
+                break
+        return rows
+
+    async def _fetch_bars(self, gap: Gap) -> List[Dict[str, Any]]:
+        rows = []
+        end = gap.end
+        while end > gap.start:
+            chunk = min(end - gap.start, MAX_BAR_REQUEST)
+            await self.pacer.acquire(2)  # BID_ASK bars count as two requests
+            self.requests += 1
+            bars = await self.ib.reqHistoricalDataAsync(self.contract, end, f"{math.ceil(chunk.total_seconds())} S",
+                                                        self.bar_size, 'BID_ASK', useRTH=False, formatDate=2)
+            chunk_rows = []
+            for bar in bars or ():
+                ts = _aware(bar.date) if isinstance(bar.date, datetime) else None
+                if ts is not None and gap.start < ts < gap.end:
+                    chunk_rows.append(_row(ts, bar.open, bar.close))  # time-average bid and ask
+            rows[:0] = chunk_rows
+            end -= chunk
+        return rows
+
+    async def backfill(self, gap: Gap) -> int:
+        """Fetch and store one gap; returns the rows written"""
+        rows = await self.fetch(gap)
+        if not rows:
+            logger.info(f"No IB history for {gap}")
+            return 0
+        written = await asyncio.get_running_loop().run_in_executor(None, self.write, rows)
+        self.rows += written
+        logger.info(f"Backfilled {written} rows into {gap}")
+        return written
+
+    async def run(self, gaps: List[Gap],
+                  on_done: Optional[Callable[[Gap, int, int, Optional[str]], Awaitable[None]]] = None) -> Dict[str, Any]:
+        """Backfill gaps in parallel; on_done(gap, rows, requests, error) is awaited after each one"""
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def one(gap: Gap) -> int:
+            async with semaphore:
+                before = self.requests
+                try:
+                    written, error = await self.backfill(gap), None
+                except Exception as e:
+                    written, error = 0, f"{type(e).__name__}: {e}"
+                    self.failed_gaps += 1
+                    logger.error(f"Backfill of {gap} failed: {error}")
+                if on_done is not None:
+                    await on_done(gap, written, self.requests - before, error)
+                return written
+
+        started = time.monotonic()
+        written = sum(await asyncio.gather(*(one(gap) for gap in gaps)))
+        return {'gaps': len(gaps), 'rows': written, 'requests': self.requests, 'failed_gaps': self.failed_gaps,
+                'paced_seconds': round(self.pacer.waited, 1), 'seconds': round(time.monotonic() - started, 1)}
+
+
+def _row(ts: datetime, bid: float, ask: float) -> Dict[str, Any]:
+    return {'timestamp': ts, 'ib_bid': bid, 'ib_ask': ask, 'valr_bid': None, 'valr_ask': None,
+            'source': BACKFILL_SOURCE}
+
+
+async def backfill_gaps(ib, contract: Contract, min_gap: float = 60, start: Optional[datetime] = None,
+                        end: Optional[datetime] = None, collection: str = usdzar_db.DEFAULT_COLLECTION,
+                        method: str = 'ticks', bar_size: str = '1 min', concurrency: int = 4,
+                        pacer: Optional[Pacer] = None, dry_run: bool = False) -> Dict[str, Any]:
+    """Scan a collection for gaps and backfill them from `ib`; returns a summary"""
+    loop = asyncio.get_running_loop()
+
+    def scan() -> List[Gap]:
+        with db_connection() as db:
+            return find_gaps(db, min_gap, start, end, collection)
+
+    def record(gap: Gap, rows: int, requests: int, error: Optional[str]) -> None:
+        with db_connection() as db:
+            record_attempt(db, gap, rows, requests, method, collection, error)
+
+    async def log(gap: Gap, rows: int, requests: int, error: Optional[str]) -> None:
+        # Failed gaps without any rows are not logged, so the next scan tries them again
+        if error is None or rows:
+            await loop.run_in_executor(None, record, gap, rows, requests, error)
+
+    gaps = await loop.run_in_executor(None, scan)
+    missing = sum(gap.seconds for gap in gaps)
+    logger.info(f"{collection}: {len(gaps)} gap(s) over {min_gap:g}s, {missing / 3600:.2f} hours in total")
+    if dry_run or not gaps:
+        for gap in gaps:
+            logger.info(f"  {gap}")
+        return {'gaps': len(gaps), 'missing_seconds': round(missing, 1), 'rows': 0}
+    backfiller = GapBackfiller(ib, contract, collection, method, bar_size, concurrency, pacer)
+    summary = await backfiller.run(gaps, log)
+    summary['missing_seconds'] = round(missing, 1)
+    return summary
+
+
+def _parse_time(value: str) -> datetime:
+    return _aware(datetime.fromisoformat(value))
+
+
+async def _main(args) -> Dict[str, Any]:
+    from ib_insync import IB
+    from instruments import load_instruments
+    instrument = next((inst for inst in load_instruments() if inst.collection == args.collection), None)
+    if instrument is None:
+        raise SystemExit(f"No instrument is stored in collection {args.collection}")
+    ib = IB()
+    await ib.connectAsync(args.host, args.port, clientId=args.client_id)
+    try:
+        qualified = await ib.qualifyContractsAsync(instrument.ib_contract())
+        if not qualified:
+            raise SystemExit(f"Could not qualify the IB contract for {instrument.name}")
+        return await backfill_gaps(ib, qualified[0], args.min_gap,
+                                   _parse_time(args.start) if args.start else None,
+                                   _parse_time(args.until) if args.until else None,
+                                   args.collection, args.method, args.bar_size, args.concurrency,
+                                   dry_run=args.dry_run)
+    finally:
+        ib.disconnect()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Find gaps in stored prices and backfill them from IB history")
+    parser.add_argument('--collection', default=usdzar_db.DEFAULT_COLLECTION, help="Instrument collection to scan")
+    parser.add_argument('--min-gap', type=float, default=60, help="Report gaps longer than this many seconds")
+    parser.add_argument('--from', dest='start', help="Scan from this ISO time (UTC unless an offset is given)")
+    parser.add_argument('--until', help="Scan until this ISO time")
+    parser.add_argument('--method', choices=METHODS, default='ticks')
+    parser.add_argument('--bar-size', default='1 min', help="IB bar size for --method bars")
+    parser.add_argument('--concurrency', type=int, default=4, help="Gaps fetched in parallel")
+    parser.add_argument('--dry-run', action='store_true', help="Only list the gaps")
+    parser.add_argument('--host', default=os.environ.get('IB_HOST', '127.0.0.1'))
+    parser.add_argument('--port', type=int, default=int(os.environ.get('IB_PORT', '4002')))
+    parser.add_argument('--client-id', type=int, default=int(os.environ.get('IB_BACKFILL_CLIENT_ID', '3')),
+                        help="Must differ from the collector's client ids")
+    args = parser.parse_args()
+    try:
+        logger.info(f"Backfill summary: {asyncio.run(_main(args))}")
+    finally:
+        close_connection()
@@ -0,0 +1,172 @@
+"""Hot-standby failover between two IB Gateway connections."""
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Callable, Deque, Dict, List, Optional, Set, Tuple
+from ib_insync import IB, Ticker
+from market_data import SubscriptionManager
+
+logger = logging.getLogger(__name__)
+
+
+class IBLink:
+    """One IB Gateway API connection and the subscriptions made over it"""
+
+    def __init__(self, name: str, host: str, port: int, client_id: int, container: Optional[str] = None,
+                 tick_mode: str = 'mktdata'):
+        self.name = name
+        self.host = host
+        self.port = port
+        self.client_id = client_id
+        self.container = container  # restarted as the last recovery step, if set
+        self.ib: Optional[IB] = None
+        self.subscriptions = SubscriptionManager(tick_mode)
+        self.last_update: Dict[str, float] = {}  # monotonic time of the last ticker update per instrument
+        self.last_change: Dict[str, float] = {}  # ...and of the last change of bid or ask
+        self.quotes: Dict[str, Deque[Tuple[float, float]]] = {}  # recent distinct (bid, ask) per instrument
+        self.updates = 0
+
+    def on_update(self, symbol: str, ticker: Ticker, now: float, depth: int) -> None:
+        self.last_update[symbol] = now
+        self.updates += 1
+        quote = (ticker.bid, ticker.ask)
+        recent = self.quotes.get(symbol)
+        if recent is None:
+            recent = self.quotes[symbol] = deque(maxlen=depth)
+        if not recent or recent[-1] != quote:
+            recent.append(quote)
+            self.last_change[symbol] = now
+
+    @property
+    def connected(self) -> bool:
+        return self.ib is not None and self.ib.isConnected()
+
+    @property
+    def live(self) -> bool:
+        """Connected with market data subscribed"""
+        return self.connected and self.subscriptions.open_subscriptions > 0
+
+    def __repr__(self) -> str:
+        return f"{self.name} ({self.host}:{self.port}, clientId {self.client_id})"
+
+
+class IBFailover:
+    """Routes ticker updates from the active IBLink and switches links when it fails"""
+
+    def __init__(self, links: List[IBLink], stale_after: float = 0.5, interval: float = 0.2,
+                 dedup_depth: int = 256, dedup_window: float = 5.0):
+        self.links = links
+        self.active = links[0]
+        self.stale_after = stale_after
+        self.interval = interval
+        self.dedup_window = dedup_window
+        self._routes: Dict[str, Callable[[Ticker, str], None]] = {}
+        self._forwarded: Dict[str, Tuple[float, float]] = {}  # last quote handed to the capture
+        self._dedup_depth = dedup_depth
+        # Instruments still deduplicating after a switchover: the old link's recent quotes and until when
+        self._dedup: Dict[str, Tuple[Set[Tuple[float, float]], float]] = {}
+        self._behind_since: Dict[str, float] = {}  # instruments on which the active link is behind the other
+
+        self.failovers = 0
+        self.duplicates = 0
+        self.last_failover: Optional[str] = None
+
+    @property
+    def standby(self) -> Optional[IBLink]:
+        return next((link for link in self.links if link is not self.active), None)
+
+    def route(self, symbol: str, handler: Callable[[Ticker, str], None]) -> None:
+        """Where the active link's updates for `symbol` go, with the mode of its subscription"""
+        self._routes[symbol] = handler
+
+    def handler(self, link: IBLink, symbol: str) -> Callable[[Ticker], None]:
+        """Ticker.updateEvent handler for `symbol` on `link`"""
+        def on_update(ticker: Ticker) -> None:
+            link.on_update(symbol, ticker, time.monotonic(), self._dedup_depth)
+            if link is self.active:
+                self._forward(symbol, ticker)
+        return on_update
+
+    def _forward(self, symbol: str, ticker: Ticker) -> None:
+        quote = (ticker.bid, ticker.ask)
+        dedup = self._dedup.get(symbol)
+        if dedup is not None:
+            seen, until = dedup
+            if quote != self._forwarded.get(symbol) and quote in seen and time.monotonic() < until:
+                self.duplicates += 1
+                return
+            del self._dedup[symbol]  # Caught up with (or past) the old link
+        self._forwarded[symbol] = quote
+        self._routes[symbol](ticker, self.active.subscriptions.modes.get(symbol, 'mktdata'))
+
+    def on_disconnected(self, link: IBLink) -> None:
+        """Switch straight away when the active link drops instead of waiting for the next check"""
+        # ib_insync emits disconnectedEvent before the client state is reset, so do not re-check the link
+        standby = self.standby
+        if link is self.active and standby is not None and standby.live:
+            self.switch(standby, "disconnected")
+
+    def problem(self, now: Optional[float] = None) -> Optional[str]:
+        """Why the active link should be replaced by the standby, or None"""
+        link, other = self.active, self.standby
+        if not link.connected:
+            return "disconnected"
+        if not link.subscriptions.open_subscriptions:
+            return "no market-data subscriptions"
+        if other is None or not other.live:
+            return None
+        now = time.monotonic() if now is None else now
+        for symbol, theirs in other.last_change.items():
+            ours = link.last_change.get(symbol)
+            # Behind: the other link changed quote after we last did, to one we have not had
+            if ours is None or theirs <= ours or other.quotes[symbol][-1] in link.quotes[symbol]:
+                self._behind_since.pop(symbol, None)
+                continue
+            since = self._behind_since.setdefault(symbol, now)
+            if now - since >= self.stale_after:
+                return f"{symbol} ticker {now - since:.2f}s behind {other.name}"
+        return None
+
+    def check(self) -> bool:
+        """Switch to the standby if the active link failed and the standby is live; True if switched"""
+        standby = self.standby
+        if standby is None or not standby.live:
+            return False
+        reason = self.problem()
+        if reason is None:
+            return False
+        self.switch(standby, reason)
+        return True
+
+    def switch(self, link: IBLink, reason: str = '') -> None:
+        previous, self.active = self.active, link
+        self._behind_since.clear()
+        self.failovers += 1
+        self.last_failover = f"{previous.name} -> {link.name}: {reason}"
+        logger.warning(f"IB failover from {previous} to {link}{': ' + reason if reason else ''}")
+        until = time.monotonic() + self.dedup_window
+        for symbol in self._routes:
+            if previous.quotes.get(symbol):
+                self._dedup[symbol] = (set(previous.quotes[symbol]), until)
+            # Hand over the new link's current quote without waiting for its next update
+            ticker = link.subscriptions.ticker(symbol)
+            if ticker is not None:
+                self._forward(symbol, ticker)
+
+    async def run(self) -> None:
+        while True:
+            try:
+                self.check()
+            except Exception as e:
+                logger.error(f"IB failover check failed: {str(e)}")
+            await asyncio.sleep(self.interval)
+
+    def stats(self) -> Dict[str, object]:
+        return {
+            'active': self.active.name,
+            'failovers': self.failovers,
+            'duplicates': self.duplicates,
+            'last_failover': self.last_failover,
+            'updates': {link.name: link.updates for link in self.links},
+        }
@@ -0,0 +1,97 @@
+import logging
+import os
+from typing import Any, Dict, List, Optional
+from ib_insync import Contract, Forex
+
+logger = logging.getLogger(__name__)
+
+
+class Instrument:
+    """One collected instrument: an IB contract paired with a VALR pair and a collection"""
+
+    __slots__ = ('name', 'ib_symbol', 'ib_sec_type', 'ib_exchange', 'ib_currency',
+                 'valr_pair', 'collection', 'trade_size')
+
+    def __init__(self, name: str, ib_symbol: str, valr_pair: str, collection: Optional[str] = None,
+                 ib_sec_type: str = 'CASH', ib_exchange: str = 'IDEALPRO', ib_currency: str = '',
+                 trade_size: float = 10000):
+        self.name = name
+        self.ib_symbol = ib_symbol
+        self.ib_sec_type = ib_sec_type
+        self.ib_exchange = ib_exchange
+        self.ib_currency = ib_currency
+        self.valr_pair = valr_pair
+        self.collection = collection or name.lower()
+        self.trade_size = trade_size
+
+    def ib_contract(self) -> Contract:
+        if self.ib_sec_type == 'CASH':
+            return Forex(self.ib_symbol, exchange=self.ib_exchange)
+        return Contract(symbol=self.ib_symbol, secType=self.ib_sec_type,
+                        exchange=self.ib_exchange, currency=self.ib_currency)
+
+    def __repr__(self) -> str:
+        return f"Instrument({self.name}: IB {self.ib_symbol} <-> VALR {self.valr_pair} -> {self.collection})"
+
+
+DEFAULT_INSTRUMENTS = [Instrument('USDZAR', 'USDZAR', 'USDTZAR', 'usdzar')]
+
+
+def _from_mapping(entry: Dict[str, Any]) -> Instrument:
+    ib = entry.get('ib', {})
+    if isinstance(ib, str):
+        ib = {'symbol': ib}
+    name = entry['name']
+    return Instrument(
+        name=name,
+        ib_symbol=ib.get('symbol', name),
+        valr_pair=entry['valr_pair'],
+        collection=entry.get('collection'),
+        ib_sec_type=ib.get('sec_type', 'CASH'),
+        ib_exchange=ib.get('exchange', 'IDEALPRO'),
+        ib_currency=ib.get('currency', ''),
+        trade_size=float(entry.get('trade_size', 10000))
+    )
+
+
+def _from_env(spec: str) -> List[Instrument]:
+    """Parse INSTRUMENTS="IB_SYMBOL:VALR_PAIR[:collection];..." """
+    instruments = []
+    for item in spec.split(';'):
+        item = item.strip()
+        if not item:
+            continue
+        parts = item.split(':')
+        if len(parts) < 2:
+            raise ValueError(f"Invalid INSTRUMENTS entry '{item}', expected IB_SYMBOL:VALR_PAIR[:collection]")
+        instruments.append(Instrument(parts[0], parts[0], parts[1], parts[2] if len(parts) > 2 else None))
+    return instruments
+
+
+def load_instruments() -> List[Instrument]:
+    """Load the instrument map.
+
+    Sources, in order of precedence:
+      INSTRUMENTS_FILE - YAML file with an 'instruments' list (see instruments.example.yml)
+      INSTRUMENTS      - "USDZAR:USDTZAR:usdzar;EURZAR:EURTZAR"
+      default          - USDZAR on IB <-> USDTZAR on VALR -> db.usdzar
+    """
+    path = os.environ.get('INSTRUMENTS_FILE')
+    if path:
+        import yaml  # Only needed when a config file is used
+        with open(path) as f:
+            config = yaml.safe_load(f) or {}
+        instruments = [_from_mapping(entry) for entry in config.get('instruments', [])]
+    elif os.environ.get('INSTRUMENTS'):
+        instruments = _from_env(os.environ['INSTRUMENTS'])
+    else:
+        instruments = list(DEFAULT_INSTRUMENTS)
+
+    if not instruments:
+        raise ValueError("No instruments configured")
+    names = [inst.name for inst in instruments]
+    if len(set(names)) != len(names):
+        raise ValueError(f"Duplicate instrument names in {names}")
+    for inst in instruments:
+        logger.info(f"Collecting {inst}")
+    return instruments
@@ -0,0 +1,154 @@
+import logging
+from typing import Callable, Dict, Optional, Set
+from ib_insync import IB, Contract, Ticker
+
+logger = logging.getLogger(__name__)
+
+TICK_MODES = ('tick_by_tick', 'mktdata')
+# Error codes ib_insync reports as warnings; anything else on a tick-by-tick request means it failed
+WARNING_CODES = {110, 165, 202, 399, 404, 434, 492, 10167}
+
+
+class SubscriptionManager:
+    """Persistent IB market-data subscriptions.
+
+    Each contract is qualified once and cached for the life of the process,
+    so reconnects do not repeat the contract-details round trip. One live
+    Ticker is kept per instrument; it is only re-requested after the IB
+    connection actually dropped.
+
+    In 'tick_by_tick' mode quotes are requested with reqTickByTickData
+    BidAsk, which delivers every top-of-book change instead of the throttled
+    and conflated reqMktData stream. If IB rejects the request (no
+    entitlement, too many tick-by-tick subscriptions, ...) the instrument
+    falls back to reqMktData on the same Ticker and stays there for the life
+    of the manager. `modes` holds the mode each instrument currently uses.
+    """
+
+    def __init__(self, tick_mode: str = 'mktdata'):
+        if tick_mode not in TICK_MODES:
+            raise ValueError(f"Unknown IB tick mode: {tick_mode}")
+        self.tick_mode = tick_mode
+        self.ib: Optional[IB] = None
+        self._contracts: Dict[str, Contract] = {}
+        self._tickers: Dict[str, Ticker] = {}
+        self._handlers: Dict[str, Callable[[Ticker], None]] = {}
+        self.modes: Dict[str, str] = {}
+        self._no_tick_by_tick: Set[str] = set()
+
+        self.qualify_requests = 0
+        self.subscribe_requests = 0
+        self.cancel_requests = 0
+        self.resubscribes = 0
+        self.fallbacks = 0
+
+    def attach(self, ib: IB) -> None:
+        """Use a (re)connected IB instance; subscriptions on a previous one are gone"""
+        if ib is self.ib:
+            return
+        if self.ib is not None:
+            self.ib.disconnectedEvent -= self._on_disconnected
+            self.ib.errorEvent -= self._on_error
+        self._drop_tickers()
+        self.ib = ib
+        ib.disconnectedEvent += self._on_disconnected
+        ib.errorEvent += self._on_error
+
+    def _on_disconnected(self) -> None:
+        logger.warning(f"IB disconnected, {len(self._tickers)} market-data subscriptions lost")
+        self._drop_tickers()
+
+    def _drop_tickers(self) -> None:
+        for symbol, ticker in self._tickers.items():
+            ticker.updateEvent -= self._handlers[symbol]
+        self._tickers.clear()
+        self.modes.clear()
+
+    def _on_error(self, reqId: int, errorCode: int, errorString: str, contract: Optional[Contract]) -> None:
+        """Fall back to reqMktData when IB rejects an instrument's tick-by-tick request"""
+        if contract is None or errorCode in WARNING_CODES or 2100 <= errorCode < 2200:
+            return
+        for symbol, ticker in self._tickers.items():
+            if ticker.contract is contract and self.modes.get(symbol) == 'tick_by_tick':
+                break
+        else:
+            return
+        logger.warning(f"Tick-by-tick data for {symbol} unavailable (error {errorCode}: {errorString}), "
+                       f"falling back to reqMktData")
+        self._no_tick_by_tick.add(symbol)
+        self.fallbacks += 1
+        if self.ib.isConnected():
+            self.ib.cancelTickByTickData(contract, 'BidAsk')
+            self.ib.reqMktData(contract)  # Same contract object, so updates arrive on the same Ticker
+        self.modes[symbol] = 'mktdata'
+
+    async def qualify(self, symbol: str, contract: Contract) -> Contract:
+        """Qualify a contract once and return the cached result afterwards"""
+        cached = self._contracts.get(symbol)
+        if cached is not None:
+            return cached
+        self.qualify_requests += 1
+        qualified = await self.ib.qualifyContractsAsync(contract)
+        if not qualified or not qualified[0].conId:
+            raise ValueError(f"Could not qualify contract for {symbol}")
+        self._contracts[symbol] = qualified[0]
+        logger.info(f"Qualified {symbol} (conId {qualified[0].conId})")
+        return qualified[0]
+
+    async def subscribe(self, symbol: str, contract: Contract, on_update: Callable[[Ticker], None]) -> Ticker:
+        """Return the live Ticker for `symbol`, subscribing only if there is none"""
+        ticker = self._tickers.get(symbol)
+        if ticker is not None and self.ib.isConnected():
+            return ticker
+
+        qualified = await self.qualify(symbol, contract)
+        if self.subscribe_requests:
+            self.resubscribes += 1
+        self.subscribe_requests += 1
+        mode = 'mktdata' if symbol in self._no_tick_by_tick else self.tick_mode
+        if mode == 'tick_by_tick':
+            ticker = self.ib.reqTickByTickData(qualified, 'BidAsk')
+        else:
+            ticker = self.ib.reqMktData(qualified)
+        self._handlers[symbol] = on_update
+        ticker.updateEvent += on_update
+        self._tickers[symbol] = ticker
+        self.modes[symbol] = mode
+        logger.info(f"Subscribed to {symbol} market data, {mode} ({self.open_subscriptions} open)")
+        return ticker
+
+    def unsubscribe(self, symbol: str) -> None:
+        ticker = self._tickers.pop(symbol, None)
+        if ticker is None:
+            return
+        ticker.updateEvent -= self._handlers[symbol]
+        mode = self.modes.pop(symbol, 'mktdata')
+        if self.ib is not None and self.ib.isConnected():
+            self.cancel_requests += 1
+            if mode == 'tick_by_tick':
+                self.ib.cancelTickByTickData(ticker.contract, 'BidAsk')
+            else:
+                self.ib.cancelMktData(ticker.contract)
+
+    def unsubscribe_all(self) -> None:
+        for symbol in list(self._tickers):
+            self.unsubscribe(symbol)
+
+    def ticker(self, symbol: str) -> Optional[Ticker]:
+        return self._tickers.get(symbol)
+
+    @property
+    def open_subscriptions(self) -> int:
+        return len(self._tickers)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'open_subscriptions': self.open_subscriptions,
+            'cached_contracts': len(self._contracts),
+            'qualify_requests': self.qualify_requests,
+            'subscribe_requests': self.subscribe_requests,
+            'cancel_requests': self.cancel_requests,
+            'resubscribes': self.resubscribes,
+            'tick_by_tick': sum(1 for mode in self.modes.values() if mode == 'tick_by_tick'),
+            'fallbacks': self.fallbacks
+        }
@@ -0,0 +1,203 @@
+"""In-process metrics exposed in Prometheus text format."""
+import logging
+import threading
+import time
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple, Union
+
+logger = logging.getLogger(__name__)
+
+Labels = Tuple[Tuple[str, str], ...]
+Sample = Union[float, Iterable[Tuple[Dict[str, str], float]]]
+
+
+def _format_labels(labels: Labels, extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = list(labels) + ([extra] if extra else [])
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{k}="{v}"' for k, v in pairs) + '}'
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Counter:
+    """Monotonic counter"""
+
+    __slots__ = ('name', 'help', 'value')
+    kind = 'counter'
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self.value = 0
+
+    def inc(self, amount: float = 1) -> None:
+        self.value += amount
+
+    def render(self) -> List[str]:
+        return [f'{self.name} {_format_value(self.value)}']
+
+
+class Gauge:
+    """Value that can go up and down"""
+
+    __slots__ = ('name', 'help', 'value')
+    kind = 'gauge'
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self.value = 0.0
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+    def render(self) -> List[str]:
+        return [f'{self.name} {_format_value(self.value)}']
+
+
+class Histogram:
+    """Cumulative histogram over fixed bucket bounds.
+
+    Bucket counts live in a list allocated up front; observe() is a binary
+    search and two integer increments.
+    """
+
+    __slots__ = ('name', 'help', 'bounds', 'counts', 'sum', 'count')
+    kind = 'histogram'
+
+    def __init__(self, name: str, help: str, buckets: Sequence[float]):
+        self.name = name
+        self.help = help
+        self.bounds = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.bounds) + 1)  # last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self) -> List[str]:
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.bounds + (float('inf'),), self.counts):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{{le="{_format_value(bound)}"}} {cumulative}')
+        lines.append(f'{self.name}_sum {_format_value(self.sum)}')
+        lines.append(f'{self.name}_count {self.count}')
+        return lines
+
+
+class CallbackMetric:
+    """Metric whose value(s) are read from `fn` when scraped.
+
+    `fn` returns either a number or an iterable of (labels dict, value).
+    """
+
+    __slots__ = ('name', 'help', 'kind', 'fn')
+
+    def __init__(self, name: str, help: str, kind: str, fn: Callable[[], Sample]):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.fn = fn
+
+    def render(self) -> List[str]:
+        value = self.fn()
+        if isinstance(value, (int, float)):
+            return [f'{self.name} {_format_value(value)}']
+        return [f'{self.name}{_format_labels(tuple(labels.items()))} {_format_value(v)}'
+                for labels, v in value if v is not None]
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, object] = {}
+
+    def _add(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} already registered")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str) -> Counter:
+        return self._add(Counter(name, help))
+
+    def gauge(self, name: str, help: str) -> Gauge:
+        return self._add(Gauge(name, help))
+
+    def histogram(self, name: str, help: str, buckets: Sequence[float]) -> Histogram:
+        return self._add(Histogram(name, help, buckets))
+
+    def register_callback(self, name: str, help: str, fn: Callable[[], Sample], kind: str = 'gauge') -> None:
+        """Add or replace a metric read from `fn` at scrape time"""
+        self._metrics[name] = CallbackMetric(name, help, kind, fn)
+
+    def render(self) -> str:
+        lines = []
+        for metric in list(self._metrics.values()):
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            try:
+                lines.extend(metric.render())
+            except Exception as e:
+                logger.error(f"Error rendering metric {metric.name}: {str(e)}")
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+# Hot-path metrics: storage (recorded by the writers) and feed timing (by the collector)
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+tick_to_store_seconds = registry.histogram(
+    'collector_tick_to_store_seconds', 'Time from receiving a tick to MongoDB acknowledging it', LATENCY_BUCKETS)
+mongo_write_seconds = registry.histogram(
+    'collector_mongo_write_seconds', 'Duration of MongoDB batch writes', LATENCY_BUCKETS)
+mongo_batch_size = registry.histogram(
+    'collector_mongo_batch_size', 'Documents per MongoDB batch write', (1, 5, 10, 50, 100, 250, 500, 1000, 2500, 5000))
+mongo_write_failures = registry.counter(
+    'collector_mongo_write_failures_total', 'MongoDB batch writes that did not store every document')
+valr_feed_latency_seconds = registry.histogram(
+    'collector_valr_feed_latency_seconds', 'VALR receive time minus the book LastChange time', LATENCY_BUCKETS)
+quote_skew_seconds = registry.histogram(
+    'collector_quote_skew_seconds', 'Receive-time difference between the IB and VALR quotes in a tick', LATENCY_BUCKETS)
+
+
+def observe_stored(batch: Iterable[dict], now: Optional[float] = None) -> None:
+    """Record tick-to-store latency for a batch MongoDB has just acknowledged"""
+    now = now or time.time()
+    for doc in batch:
+        tick_to_store_seconds.observe(now - doc['timestamp'].timestamp())
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/metrics', '/'):
+            self.send_error(404)
+            return
+        body = registry.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # Scrapes would otherwise flood the log
+
+
+def start_http_server(port: int = 9108, host: str = '0.0.0.0') -> ThreadingHTTPServer:
+    """Serve /metrics from a daemon thread"""
+    server = ThreadingHTTPServer((host, port), _Handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True)
+    thread.start()
+    logger.info(f"Serving metrics on http://{host}:{port}/metrics")
+    return server
@@ -0,0 +1,78 @@
+"""Copy USDZAR price history between storage modes."""
+import argparse
+import logging
+from datetime import timezone
+from typing import Optional
+from mongodb import db_connection, close_connection
+import usdzar_db
+import bucket_store
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+
+
+def latest_timestamp(db, mode: str, collection: str = usdzar_db.DEFAULT_COLLECTION):
+    """Newest timestamp stored in a mode's collection, or None if empty"""
+    collection = usdzar_db._collection(db, mode, collection)
+    if mode == 'buckets':
+        bucket = collection.find_one(sort=[('last', -1)], projection={'last': 1})
+        return bucket['last'] if bucket else None
+    doc = collection.find_one(sort=[('timestamp', -1)], projection={'timestamp': 1})
+    return doc['timestamp'] if doc else None
+
+
+def iter_source(db, mode: str, after=None, batch_size: int = 1000, collection: str = usdzar_db.DEFAULT_COLLECTION):
+    """Yield documents from a mode's collection in ascending timestamp order"""
+    collection = usdzar_db._collection(db, mode, collection)
+    if mode == 'buckets':
+        query = {'last': {'$gt': after}} if after else {}
+        for bucket in collection.find(query).sort('bucket_start', 1).batch_size(batch_size):
+            for row in bucket_store.unpack_bucket(bucket):
+                if after is None or row['timestamp'] > after:
+                    yield row
+        return
+    query = {'timestamp': {'$gt': after}} if after else {}
+    for doc in collection.find(query, projection={'_id': 0, 'meta': 0}).sort('timestamp', 1).batch_size(batch_size):
+        yield doc
+
+
+def migrate(source: str, target: str, batch_size: int = 1000, resume: bool = True,
+            collection: str = usdzar_db.DEFAULT_COLLECTION) -> int:
+    """Copy all documents from `source` to `target`; returns the number copied"""
+    if source == target:
+        raise ValueError("Source and target storage modes must differ")
+    with db_connection() as db:
+        after: Optional[object] = latest_timestamp(db, target, collection) if resume else None
+        if after:
+            logging.info(f"Resuming after {after} (already in {target})")
+
+        copied = 0
+        batch = []
+        for doc in iter_source(db, source, after, batch_size, collection):
+            # pymongo returns naive UTC datetimes; mark them so they are not shifted again
+            doc['timestamp'] = doc['timestamp'].replace(tzinfo=timezone.utc)
+            batch.append(doc)
+            if len(batch) >= batch_size:
+                copied += usdzar_db.insert_usdzar_batch(batch, mode=target, collection=collection)
+                logging.info(f"Copied {copied} documents (up to {batch[-1]['timestamp']})")
+                batch = []
+        if batch:
+            copied += usdzar_db.insert_usdzar_batch(batch, mode=target, collection=collection)
+        logging.info(f"Migration {source} -> {target} complete: {copied} documents copied")
+        return copied
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Migrate USDZAR price data between storage modes")
+    parser.add_argument('--from', dest='source', default='documents', choices=sorted(usdzar_db.COLLECTION_SUFFIXES))
+    parser.add_argument('--to', dest='target', required=True, choices=sorted(usdzar_db.COLLECTION_SUFFIXES))
+    parser.add_argument('--collection', default=usdzar_db.DEFAULT_COLLECTION, help="Instrument collection to migrate")
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--no-resume', action='store_true', help="Copy everything even if the target has data")
+    args = parser.parse_args()
+    try:
+        migrate(args.source, args.target, args.batch_size, resume=not args.no_resume, collection=args.collection)
+    finally:
+        close_connection()
@@ -0,0 +1,186 @@
+import logging
+from typing import Optional, Sequence, Tuple
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class OrderBook:
+    """In-memory aggregated L2 order book for one VALR pair.
+
+    Each side is held in preallocated numpy arrays of price and quantity,
+    sorted best-first, together with cumulative quantity and notional so
+    depth and VWAP queries are a binary search rather than a walk over the
+    levels. The cumulative arrays are brought up to date by the first query
+    after a change rather than on every update. `apply_levels` diffs a
+    snapshot, as the flat lists produced by valr_decode, against the current
+    state and only rewrites a side whose levels actually changed.
+    """
+
+    def __init__(self, pair: str, max_levels: int = 100):
+        self.pair = pair
+        self.max_levels = max_levels
+        self.sequence: Optional[int] = None
+        self.last_change: Optional[str] = None
+        self.updates = 0
+        self.changed_levels = 0  # Levels that differed in the last update
+        self._bids = _BookSide(max_levels)
+        self._asks = _BookSide(max_levels)
+
+    def apply_levels(self, bid_prices: Sequence, bid_quantities: Sequence, ask_prices: Sequence,
+                     ask_quantities: Sequence, sequence: Optional[int] = None, last_change=None) -> bool:
+        """Apply a book snapshot given as flat price / quantity lists (see valr_decode).
+
+        Returns True if the best bid or ask price changed.
+        """
+        old_top = (self.best_bid, self.best_ask)
+        self.changed_levels = (self._bids.update_arrays(bid_prices, bid_quantities)
+                               + self._asks.update_arrays(ask_prices, ask_quantities))
+        if sequence is not None:
+            self.sequence = sequence
+        if last_change is not None:
+            self.last_change = last_change
+        self.updates += 1
+        return (self.best_bid, self.best_ask) != old_top
+
+    @property
+    def best_bid(self) -> Optional[float]:
+        return self._bids.best
+
+    @property
+    def best_ask(self) -> Optional[float]:
+        return self._asks.best
+
+    @property
+    def mid(self) -> Optional[float]:
+        if self.best_bid is None or self.best_ask is None:
+            return None
+        return (self.best_bid + self.best_ask) / 2
+
+    def levels(self, side: str) -> Tuple[np.ndarray, np.ndarray]:
+        """Copies of (prices, quantities) for 'bid' or 'ask', best first"""
+        book_side = self._side(side)
+        # The side's arrays are reused as scratch space by the next update
+        return book_side.prices[:book_side.n].copy(), book_side.quantities[:book_side.n].copy()
+
+    def vwap(self, side: str, quantity: Optional[float] = None, notional: Optional[float] = None) -> Optional[float]:
+        """Average price to trade against one side of the book.
+
+        side: 'bid' to sell into the bids, 'ask' to buy from the asks
+        quantity: size in base currency (e.g. USDT), or
+        notional: size in quote currency (e.g. ZAR)
+
+        Returns None if the book is not deep enough to fill the size.
+        """
+        if (quantity is None) == (notional is None):
+            raise ValueError("Specify exactly one of quantity or notional")
+        return self._side(side).vwap(quantity, notional)
+
+    def depth(self, side: str, levels: Optional[int] = None, price_limit: Optional[float] = None) -> float:
+        """Total quantity in the first `levels` levels, or at prices no worse than `price_limit`"""
+        return self._side(side).depth(levels, price_limit, side == 'bid')
+
+    def imbalance(self, levels: int = 5) -> Optional[float]:
+        """(bid qty - ask qty) / (bid qty + ask qty) over the top `levels` levels"""
+        bid_qty = self._bids.depth(levels)
+        ask_qty = self._asks.depth(levels)
+        total = bid_qty + ask_qty
+        if total == 0:
+            return None
+        return (bid_qty - ask_qty) / total
+
+    def _side(self, side: str) -> '_BookSide':
+        if side == 'bid':
+            return self._bids
+        if side == 'ask':
+            return self._asks
+        raise ValueError(f"Unknown book side: {side}")
+
+
+class _BookSide:
+    """Sorted price/quantity arrays for one side of the book"""
+
+    def __init__(self, max_levels: int):
+        self.max_levels = max_levels
+        self.prices = np.zeros(max_levels)
+        self.quantities = np.zeros(max_levels)
+        self.cum_qty = np.zeros(max_levels)
+        self.cum_notional = np.zeros(max_levels)
+        self.n = 0
+        self._cum_stale = False
+        self._scratch_prices = np.zeros(max_levels)
+        self._scratch_qty = np.zeros(max_levels)
+
+    @property
+    def best(self) -> Optional[float]:
+        return float(self.prices[0]) if self.n else None
+
+    def update_arrays(self, prices: Sequence, quantities: Sequence) -> int:
+        """Replace the side with parallel price / quantity lists (floats or numeric strings)"""
+        n = min(len(prices), self.max_levels)
+        try:
+            # One bulk conversion into the preallocated scratch arrays
+            self._scratch_prices[:n] = prices[:n]
+            self._scratch_qty[:n] = quantities[:n]
+        except (TypeError, ValueError) as e:
+            logger.error(f"Invalid order book level: {e}")
+            return 0
+        return self._swap_in(n)
+
+    def _swap_in(self, n: int) -> int:
+        """Make the first n scratch levels the side's levels if they differ; returns how many changed"""
+        prices, qty = self._scratch_prices, self._scratch_qty
+        common = min(n, self.n)
+        changed = int(np.count_nonzero(
+            (prices[:common] != self.prices[:common]) | (qty[:common] != self.quantities[:common])
+        )) + abs(n - self.n)
+        if changed == 0:
+            return 0
+
+        # Swap in the freshly parsed arrays and keep the old ones as scratch space
+        self._scratch_prices, self.prices = self.prices, prices
+        self._scratch_qty, self.quantities = self.quantities, qty
+        self.n = n
+        self._cum_stale = True
+        return changed
+
+    def _refresh_cumulative(self) -> None:
+        """Recompute cumulative quantity and notional, which only depth / VWAP queries need"""
+        if self._cum_stale:
+            n = self.n
+            np.cumsum(self.quantities[:n], out=self.cum_qty[:n])
+            np.multiply(self.prices[:n], self.quantities[:n], out=self.cum_notional[:n])
+            np.cumsum(self.cum_notional[:n], out=self.cum_notional[:n])
+            self._cum_stale = False
+
+    def depth(self, levels: Optional[int] = None, price_limit: Optional[float] = None, descending: bool = False) -> float:
+        self._refresh_cumulative()
+        n = self.n if levels is None else min(levels, self.n)
+        if price_limit is not None:
+            prices = self.prices[:n]
+            if descending:  # Bids: best (highest) first
+                n = int(np.searchsorted(-prices, -price_limit, side='right'))
+            else:
+                n = int(np.searchsorted(prices, price_limit, side='right'))
+        return float(self.cum_qty[n - 1]) if n else 0.0
+
+    def vwap(self, quantity: Optional[float], notional: Optional[float]) -> Optional[float]:
+        self._refresh_cumulative()
+        n = self.n
+        if n == 0:
+            return None
+        if quantity is not None:
+            if quantity <= 0 or quantity > self.cum_qty[n - 1]:
+                return None
+            i = int(np.searchsorted(self.cum_qty[:n], quantity))
+            filled_qty = self.cum_qty[i - 1] if i else 0.0
+            filled_notional = self.cum_notional[i - 1] if i else 0.0
+            return float((filled_notional + (quantity - filled_qty) * self.prices[i]) / quantity)
+
+        if notional <= 0 or notional > self.cum_notional[n - 1]:
+            return None
+        i = int(np.searchsorted(self.cum_notional[:n], notional))
+        filled_qty = self.cum_qty[i - 1] if i else 0.0
+        filled_notional = self.cum_notional[i - 1] if i else 0.0
+        qty = filled_qty + (notional - filled_notional) / self.prices[i]
+        return float(notional / qty)
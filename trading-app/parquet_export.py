@@ -0,0 +1,201 @@
+"""Export collected prices to Parquet for offline research."""
+import argparse
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta, timezone
+from typing import List, Optional, Tuple
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.fs
+import pyarrow.parquet as pq
+from mongodb import db_connection, close_connection
+import usdzar_db
+
+logger = logging.getLogger(__name__)
+
+EXPORT_DIR = os.environ.get('EXPORT_DIR', 'exports')
+FIELDS = ['timestamp', 'ib_bid', 'ib_ask', 'valr_bid', 'valr_ask', 'source']
+SCHEMA = pa.schema([
+    ('timestamp', pa.timestamp('us', tz='UTC')),
+    ('ib_bid', pa.float64()),
+    ('ib_ask', pa.float64()),
+    ('valr_bid', pa.float64()),
+    ('valr_ask', pa.float64()),
+    ('source', pa.string()),
+])
+STATE_FILE = '_state.json'
+
+
+def _load_state(root: str) -> dict:
+    try:
+        with open(os.path.join(root, STATE_FILE)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def _save_state(root: str, state: dict) -> None:
+    path = os.path.join(root, STATE_FILE)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(state, f, indent=2)
+    os.replace(path + '.tmp', path)
+
+
+def _naive_utc(ts: Optional[datetime]) -> Optional[datetime]:
+    """Convert an aware datetime to the naive UTC form used for ranges and state"""
+    if ts is None or ts.tzinfo is None:
+        return ts
+    return ts.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+def _earliest_timestamp(collection: str) -> Optional[datetime]:
+    with db_connection() as db:
+        coll = usdzar_db._collection(db, collection=collection)
+        if usdzar_db.STORAGE_MODE == 'buckets':
+            doc = coll.find_one(sort=[('first', 1)], projection={'first': 1})
+            return doc['first'] if doc else None
+        doc = coll.find_one(sort=[('timestamp', 1)], projection={'timestamp': 1})
+        return doc['timestamp'] if doc else None
+
+
+def day_ranges(start: datetime, end: datetime) -> List[Tuple[datetime, datetime]]:
+    """Split [start, end) at UTC midnights"""
+    ranges = []
+    while start < end:
+        midnight = datetime.combine(start.date() + timedelta(days=1), datetime.min.time())
+        ranges.append((start, min(midnight, end)))
+        start = midnight
+    return ranges
+
+
+def partition_dir(root: str, instrument: str, day) -> str:
+    return os.path.join(root, f'instrument={instrument}', f'date={day.isoformat()}')
+
+
+def export_partition(root: str, collection: str, instrument: str, start: datetime, end: datetime,
+                     batch_size: int = 50000) -> int:
+    """Write the rows in [start, end) to one Parquet file; returns the row count"""
+    directory = partition_dir(root, instrument, start.date())
+    filename = f'part-{int(start.replace(tzinfo=timezone.utc).timestamp() * 1000)}.parquet'
+    path = os.path.join(directory, filename)
+    tmp_path = os.path.join(directory, f'.{filename}.tmp')  # hidden from readers until complete
+    rows = 0
+    writer = None
+    # Stored timestamps have millisecond precision, so this keeps `end` exclusive
+    last = end - timedelta(microseconds=1)
+    try:
+        for batch in usdzar_db.iter_price_data_range(start, last, fields=FIELDS, batch_size=batch_size,
+                                                     output='arrow', collection=collection):
+            table = pa.Table.from_batches([batch]).cast(SCHEMA)
+            if writer is None:
+                os.makedirs(directory, exist_ok=True)
+                writer = pq.ParquetWriter(tmp_path, SCHEMA, compression='zstd')
+            writer.write_table(table)
+            rows += table.num_rows
+    finally:
+        if writer is not None:
+            writer.close()
+    if writer is not None:
+        os.replace(tmp_path, path)
+    return rows
+
+
+def export(collection: str = usdzar_db.DEFAULT_COLLECTION, instrument: Optional[str] = None,
+           root: str = EXPORT_DIR, start: Optional[datetime] = None, until: Optional[datetime] = None,
+           workers: int = 4, batch_size: int = 50000) -> int:
+    """Export new rows up to `until` (naive values are UTC); returns the number of rows written"""
+    instrument = instrument or collection.upper()
+    start = _naive_utc(start)
+    until = _naive_utc(until) or datetime.utcnow() - timedelta(minutes=5)  # leave room for ticks still being written
+    os.makedirs(root, exist_ok=True)
+    state = _load_state(root)
+
+    if start is None and collection in state:
+        start = datetime.fromisoformat(state[collection])
+    if start is None:
+        start = _earliest_timestamp(collection)
+        if start is None:
+            logger.info(f"No data in {collection}, nothing to export")
+            return 0
+    if start >= until:
+        logger.info(f"{collection} already exported up to {start}")
+        return 0
+
+    ranges = day_ranges(start, until)
+    logger.info(f"Exporting {collection} from {start} to {until} ({len(ranges)} partitions, {workers} workers)")
+    done = {}
+    total = 0
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(export_partition, root, collection, instrument, lo, hi, batch_size): (lo, hi)
+                   for lo, hi in ranges}
+        for future in as_completed(futures):
+            lo, hi = futures[future]
+            try:
+                rows = future.result()
+            except Exception as e:
+                logger.error(f"Export of {collection} {lo.date()} failed: {str(e)}")
+                continue
+            done[lo] = hi
+            total += rows
+            logger.info(f"Exported {rows} rows for {instrument} {lo.date()}")
+
+    # Advance the state over the partitions that completed without a gap
+    exported_until = start
+    for lo, hi in ranges:
+        if lo not in done:
+            break
+        exported_until = hi
+    state[collection] = exported_until.isoformat()
+    _save_state(root, state)
+    logger.info(f"{collection} exported up to {exported_until}: {total} rows")
+    return total
+
+
+def read_range(start: datetime, end: datetime, instrument: str = 'USDZAR', columns: Optional[List[str]] = None,
+               root: str = EXPORT_DIR) -> pa.Table:
+    """Read exported rows with start <= timestamp <= end (naive values are UTC), oldest first.
+
+    Files are memory-mapped and only the partitions and columns needed are read.
+    """
+    start = start if start.tzinfo else start.replace(tzinfo=timezone.utc)
+    end = end if end.tzinfo else end.replace(tzinfo=timezone.utc)
+    dataset = ds.dataset(
+        os.path.join(root, f'instrument={instrument}'),
+        format='parquet',
+        schema=SCHEMA.append(pa.field('date', pa.string())),
+        partitioning=ds.partitioning(pa.schema([('date', pa.string())]), flavor='hive'),
+        filesystem=pyarrow.fs.LocalFileSystem(use_mmap=True),
+    )
+    condition = ((ds.field('date') >= start.astimezone(timezone.utc).date().isoformat())
+                 & (ds.field('date') <= end.astimezone(timezone.utc).date().isoformat())
+                 & (ds.field('timestamp') >= pa.scalar(start, pa.timestamp('us', tz='UTC')))
+                 & (ds.field('timestamp') <= pa.scalar(end, pa.timestamp('us', tz='UTC'))))
+    columns = columns or FIELDS
+    table = dataset.to_table(columns=columns, filter=condition)
+    if 'timestamp' in columns:
+        table = table.sort_by('timestamp')
+    return table
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s'
+    )
+    parser = argparse.ArgumentParser(description="Export price data to partitioned Parquet files")
+    parser.add_argument('--collection', default=usdzar_db.DEFAULT_COLLECTION, help="Instrument collection")
+    parser.add_argument('--instrument', default=None, help="Partition name (default: collection upper-cased)")
+    parser.add_argument('--dir', default=EXPORT_DIR, help="Export root directory")
+    parser.add_argument('--from', dest='start', type=datetime.fromisoformat, default=None,
+                        help="Start (UTC); default resumes from the last export")
+    parser.add_argument('--until', type=datetime.fromisoformat, default=None,
+                        help="End (UTC, exclusive); default five minutes ago")
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--batch-size', type=int, default=50000)
+    args = parser.parse_args()
+    try:
+        export(args.collection, args.instrument, args.dir, args.start, args.until, args.workers, args.batch_size)
+    finally:
+        close_connection()
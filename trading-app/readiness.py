@@ -0,0 +1,68 @@
+"""Readiness probes for the IB Gateway API."""
+import asyncio
+import logging
+import struct
+import time
+from typing import Optional
+from ib_insync.client import Client
+
+logger = logging.getLogger(__name__)
+
+_HANDSHAKE = b'v%d..%d' % (Client.MinClientVersion, Client.MaxClientVersion)
+
+
+async def probe_gateway(host: str, port: int, timeout: float = 5.0) -> Optional[int]:
+    """Return the gateway's API server version, or None if it is not ready.
+
+    Raises OSError / asyncio.TimeoutError when nothing accepts the TCP
+    connection; returns None when the port is open but the API does not
+    answer the handshake (e.g. socat is up but the gateway is still starting).
+    """
+    reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+    try:
+        writer.write(b'API\0' + struct.pack('>I', len(_HANDSHAKE)) + _HANDSHAKE)
+        await writer.drain()
+        try:
+            size = struct.unpack('>I', await asyncio.wait_for(reader.readexactly(4), timeout))[0]
+            fields = (await asyncio.wait_for(reader.readexactly(size), timeout)).split(b'\0')
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+            return None
+        try:
+            return int(fields[0])
+        except ValueError:
+            return None
+    finally:
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except (ConnectionError, OSError):
+            pass
+
+
+async def wait_for_gateway(host: str, port: int, timeout: Optional[float] = None, interval: float = 1.0,
+                           probe_timeout: float = 5.0) -> float:
+    """Probe until the gateway API answers; returns the seconds waited.
+
+    Raises asyncio.TimeoutError if it is not ready within `timeout` seconds.
+    """
+    start = time.monotonic()
+    attempts = 0
+    last_state = None
+    while True:
+        attempts += 1
+        try:
+            version = await probe_gateway(host, port, probe_timeout)
+            state = 'api' if version is not None else 'port open, API not answering'
+        except (OSError, asyncio.TimeoutError) as e:
+            version, state = None, f'port closed ({type(e).__name__})'
+        waited = time.monotonic() - start
+        if version is not None:
+            logger.info(f"IB Gateway API at {host}:{port} ready (server version {version}) "
+                        f"after {waited:.1f}s, {attempts} probe(s)")
+            return waited
+        if state != last_state:
+            logger.info(f"Waiting for IB Gateway at {host}:{port}: {state}")
+            last_state = state
+        if timeout is not None and waited + interval > timeout:
+            raise asyncio.TimeoutError(f"IB Gateway at {host}:{port} not ready after {waited:.0f}s ({state})")
+        await asyncio.sleep(interval)
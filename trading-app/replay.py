@@ -0,0 +1,329 @@
+"""Record live feed traffic and replay it against the collector offline."""
+import argparse
+import asyncio
+import gzip
+import json
+import logging
+import math
+import os
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, Iterator, List, Optional, Set
+import websockets
+from eventkit import Event
+from ib_insync import Contract, Ticker, TickAttribBidAsk, TickByTickBidAsk
+
+logger = logging.getLogger(__name__)
+
+
+class FrameRecorder:
+    """Append raw VALR frames and IB ticker updates to a gzip JSON-lines log"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = gzip.open(path, 'wt', encoding='utf-8')
+        self._start = time.monotonic()
+        self.frames = 0
+        self._write({'src': 'start', 'wall': time.time()})
+
+    def _write(self, record: Dict[str, Any]) -> None:
+        record['t'] = round(time.monotonic() - self._start, 6)
+        self._file.write(json.dumps(record, separators=(',', ':')) + '\n')
+        self.frames += 1
+
+    def valr_frame(self, message: str) -> None:
+        self._write({'src': 'valr', 'msg': message})
+
+    def ib_handler(self, handler: Callable[[Ticker, str], None]) -> Callable[[Ticker, str], None]:
+        """Wrap an IB update handler so every update is recorded before it is handled"""
+        def record(ticker: Ticker, mode: str = 'mktdata') -> None:
+            symbol = contract_key(ticker.contract)
+            entries = [tick for tick in ticker.tickByTicks if hasattr(tick, 'bidPrice')] if mode == 'tick_by_tick' else []
+            # Each tick-by-tick quote in the update becomes its own frame
+            for bid, ask, bid_size, ask_size in ([(t.bidPrice, t.askPrice, t.bidSize, t.askSize) for t in entries]
+                                                 or [(ticker.bid, ticker.ask, ticker.bidSize, ticker.askSize)]):
+                self._write({'src': 'ib', 'symbol': symbol, 'bid': _json_float(bid), 'ask': _json_float(ask),
+                             'bidSize': _json_float(bid_size), 'askSize': _json_float(ask_size)})
+            handler(ticker, mode)
+        return record
+
+    def close(self) -> None:
+        if not self._file.closed:
+            self._file.close()
+            logger.info(f"Recorded {self.frames} frames to {self.path}")
+
+
+def contract_key(contract: Contract) -> str:
+    """Name identifying a contract in a recording (e.g. USDZAR for a Forex pair)"""
+    if contract.secType == 'CASH':
+        return contract.symbol + contract.currency
+    return contract.localSymbol or contract.symbol
+
+
+def _json_float(value) -> Optional[float]:
+    return None if value is None or (isinstance(value, float) and math.isnan(value)) else value
+
+
+def iter_frames(path: str, src: Optional[str] = None) -> Iterator[Dict[str, Any]]:
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        for line in f:
+            record = json.loads(line)
+            if src is None or record['src'] == src:
+                yield record
+
+
+def _recorded_sources(path: str) -> Set[str]:
+    """Venues with frames in a log, reading only until both have been seen"""
+    found = set()
+    for frame in iter_frames(path):
+        if frame['src'] in ('ib', 'valr'):
+            found.add(frame['src'])
+            if len(found) == 2:
+                break
+    return found
+
+
+@contextmanager
+def _environ(overrides: Dict[str, str]) -> Iterator[None]:
+    """Set environment variables for the duration of a block"""
+    saved = {name: os.environ.get(name) for name in overrides}
+    os.environ.update(overrides)
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+
+class ReplayClock:
+    """Shared replay timeline; speed 0 replays as fast as possible"""
+
+    def __init__(self, speed: float = 1.0):
+        self.speed = speed
+        self._origin: Optional[float] = None
+
+    def start(self) -> None:
+        if self._origin is None:
+            self._origin = time.monotonic()
+
+    async def wait_until(self, t: float) -> None:
+        self.start()
+        if self.speed <= 0:
+            await asyncio.sleep(0)  # Let the collector run between frames
+            return
+        delay = self._origin + t / self.speed - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+class ReplayValrServer:
+    """Local websocket server sending recorded VALR frames to each connection"""
+
+    def __init__(self, path: str, clock: ReplayClock, host: str = '127.0.0.1', port: int = 8765):
+        self.path = path
+        self.clock = clock
+        self.host = host
+        self.port = port
+        self.sent = 0
+        self.done = asyncio.Event()
+        self._server = None
+
+    @property
+    def url(self) -> str:
+        return f"ws://{self.host}:{self.port}"
+
+    async def start(self) -> None:
+        self._server = await websockets.serve(self._handler, self.host, self.port)
+
+    async def stop(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+
+    async def _handler(self, ws, path=None) -> None:
+        reader = asyncio.ensure_future(self._answer_pings(ws))
+        try:
+            for frame in iter_frames(self.path, 'valr'):
+                await self.clock.wait_until(frame['t'])
+                await ws.send(frame['msg'])
+                self.sent += 1
+            self.done.set()
+            await ws.wait_closed()
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            reader.cancel()
+
+    async def _answer_pings(self, ws) -> None:
+        async for message in ws:
+            try:
+                if json.loads(message).get('type') == 'PING':
+                    await ws.send(json.dumps({'type': 'PONG'}))
+            except ValueError:
+                pass
+
+
+class FakeIB:
+    """Stand-in for ib_insync.IB that replays recorded ticker updates.
+
+    Implements the part of the IB API the collector uses. Updates are
+    emitted on the subscribed Ticker objects at their recorded times; for
+    contracts requested with reqTickByTickData they also carry a BidAsk
+    entry in tickByTicks, as a tick-by-tick subscription would.
+    """
+
+    def __init__(self, path: str, clock: ReplayClock):
+        self.path = path
+        self.clock = clock
+        self.disconnectedEvent = Event('disconnectedEvent')
+        self.errorEvent = Event('errorEvent')
+        self.done = asyncio.Event()
+        self.sent = 0
+        self._connected = False
+        self._tickers: Dict[str, Ticker] = {}
+        self._tick_by_tick = set()
+        self._task: Optional[asyncio.Task] = None
+
+    async def connectAsync(self, host: str = '127.0.0.1', port: int = 4002, clientId: int = 1, **kwargs):
+        self._connected = True
+        return self
+
+    def isConnected(self) -> bool:
+        return self._connected
+
+    def disconnect(self) -> None:
+        if self._connected:
+            self._connected = False
+            if self._task is not None:
+                self._task.cancel()
+            self.disconnectedEvent.emit()
+
+    def managedAccounts(self) -> List[str]:
+        return ['DU0000000']
+
+    def reqMarketDataType(self, marketDataType: int) -> None:
+        pass
+
+    async def qualifyContractsAsync(self, *contracts: Contract) -> List[Contract]:
+        for n, contract in enumerate(contracts, 1):
+            contract.conId = contract.conId or n
+        return list(contracts)
+
+    def reqMktData(self, contract: Contract, *args, **kwargs) -> Ticker:
+        # Like ib_insync, requests for the same contract object share one Ticker
+        ticker = self._tickers.get(contract_key(contract))
+        if ticker is None or ticker.contract is not contract:
+            ticker = self._tickers[contract_key(contract)] = Ticker(contract=contract)
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._replay())
+        return ticker
+
+    def cancelMktData(self, contract: Contract) -> None:
+        pass
+
+    def reqTickByTickData(self, contract: Contract, tickType: str, *args, **kwargs) -> Ticker:
+        self._tick_by_tick.add(contract_key(contract))
+        return self.reqMktData(contract)
+
+    def cancelTickByTickData(self, contract: Contract, tickType: str) -> None:
+        self._tick_by_tick.discard(contract_key(contract))
+
+    async def _replay(self) -> None:
+        for frame in iter_frames(self.path, 'ib'):
+            await self.clock.wait_until(frame['t'])
+            ticker = self._tickers.get(frame['symbol'])
+            if ticker is None:
+                continue
+            ticker.bid = _nan(frame.get('bid'))
+            ticker.ask = _nan(frame.get('ask'))
+            ticker.bidSize = _nan(frame.get('bidSize'))
+            ticker.askSize = _nan(frame.get('askSize'))
+            ticker.tickByTicks = ([TickByTickBidAsk(datetime.now(timezone.utc), ticker.bid, ticker.ask,
+                                                    ticker.bidSize, ticker.askSize, TickAttribBidAsk())]
+                                  if frame['symbol'] in self._tick_by_tick else [])
+            ticker.updateEvent.emit(ticker)
+            self.sent += 1
+        self.done.set()
+
+
+def _nan(value) -> float:
+    return math.nan if value is None else value
+
+
+async def replay(path: str, speed: float = 1.0, store: bool = False, port: int = 8765,
+                 settle: float = 2.0) -> Dict[str, Any]:
+    """Run the collector against a recorded log and return a summary"""
+    sources = _recorded_sources(path)
+    clock = ReplayClock(speed)
+    server = ReplayValrServer(path, clock, port=port)
+    await server.start()
+    # PriceCollector and the VALR client read their settings from the environment
+    overrides = {'VALR_WS_URL': server.url, 'IB_STARTUP_DELAY': '0'}
+    for name in ('VALR_API_KEY', 'VALR_API_SECRET'):
+        if name not in os.environ:
+            overrides[name] = 'replay'
+    if not store:
+        overrides['SPOOL_DIR'] = ''
+
+    with _environ(overrides):
+        import collector as collector_module
+        import metrics
+        collector = collector_module.PriceCollector()
+        fake_ib = FakeIB(path, clock)
+        collector.ib_factory = lambda: fake_ib
+        collector.probe_gateway = False
+        collector.backfill_interval = None  # FakeIB has no history
+        if not store:
+            # Measure the capture pipeline without a database
+            collector.writer.write_batch = lambda batch, retry=False: len(batch)
+            collector.rollups._write = lambda pending: {}
+
+        started = time.perf_counter()
+        task = asyncio.ensure_future(collector.run())
+        try:
+            waiters = [asyncio.ensure_future(server.done.wait()), asyncio.ensure_future(fake_ib.done.wait())]
+            await asyncio.gather(*[w for w, src in zip(waiters, ('valr', 'ib')) if src in sources])
+            for w in waiters:
+                w.cancel()
+            await asyncio.sleep(settle)  # Let queued updates reach the writer
+        finally:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            await server.stop()
+    elapsed = time.perf_counter() - started - settle
+
+    ticks = sum(c.ticks_emitted for c in collector.captures.values())
+    tts = metrics.tick_to_store_seconds
+    return {
+        'speed': speed,
+        'elapsed_seconds': round(elapsed, 3),
+        'valr_frames': server.sent,
+        'ib_updates': fake_ib.sent,
+        'frames_per_second': round((server.sent + fake_ib.sent) / elapsed, 1) if elapsed > 0 else None,
+        'ticks': ticks,
+        'ticks_per_second': round(ticks / elapsed, 1) if elapsed > 0 else None,
+        'writer': collector.writer.stats(),
+        'startup_seconds': {k: round(v, 3) for k, v in collector.startup.items()},
+        'tick_to_store_mean_ms': round(tts.sum / tts.count * 1000, 3) if tts.count else None,
+        'quote_skew_mean_ms': (round(metrics.quote_skew_seconds.sum / metrics.quote_skew_seconds.count * 1000, 3)
+                               if metrics.quote_skew_seconds.count else None),
+    }
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s'
+    )
+    parser = argparse.ArgumentParser(description="Replay a recorded VALR/IB capture through the collector")
+    parser.add_argument('--file', required=True, help="Capture written with RECORD_FILE")
+    parser.add_argument('--speed', type=float, default=1.0, help="Replay speed multiplier; 0 = maximum")
+    parser.add_argument('--store', action='store_true', help="Write ticks to MongoDB instead of discarding them")
+    parser.add_argument('--port', type=int, default=8765, help="Port for the local VALR websocket server")
+    args = parser.parse_args()
+    summary = asyncio.run(replay(args.file, args.speed, args.store, args.port))
+    print(json.dumps(summary, indent=2))
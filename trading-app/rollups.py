@@ -0,0 +1,375 @@
+"""OHLC and spread bars over the tick stream."""
+import argparse
+import asyncio
+import logging
+import time
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+import numpy as np
+from pymongo import ASCENDING, ReplaceOne, UpdateOne
+from pymongo.errors import BulkWriteError
+from mongodb import db_connection, close_connection
+from analytics import SPREADS
+import usdzar_db
+
+logger = logging.getLogger(__name__)
+
+RESOLUTIONS = {'1s': 1, '1m': 60, '5m': 300, '1h': 3600}
+LIVE_MARGIN = 60  # Seconds after a bar ends before backfill rebuilds it; live flushes may still land until then
+# Quote series with open/high/low/close per bar
+SERIES = ['ib_bid', 'ib_ask', 'ib_mid', 'valr_bid', 'valr_ask', 'valr_mid']
+OHLC = ('o', 'h', 'l', 'c')
+
+
+def bars_collection(collection: str, resolution: str) -> str:
+    return f"{collection}_bars_{resolution}"
+
+
+def parse_resolutions(value: str) -> List[str]:
+    resolutions = [r.strip() for r in value.split(',') if r.strip()]
+    unknown = [r for r in resolutions if r not in RESOLUTIONS]
+    if unknown:
+        raise ValueError(f"Unknown rollup resolution(s): {', '.join(unknown)}")
+    return resolutions
+
+
+def _series_values(doc: Dict[str, Any]) -> np.ndarray:
+    ib_bid, ib_ask = doc['ib_bid'], doc['ib_ask']
+    valr_bid, valr_ask = doc['valr_bid'], doc['valr_ask']
+    return np.array([ib_bid, ib_ask, (ib_bid + ib_ask) / 2, valr_bid, valr_ask, (valr_bid + valr_ask) / 2])
+
+
+def _spread_values(doc: Dict[str, Any]) -> np.ndarray:
+    return np.array([doc[sell] - doc[buy] for sell, buy in SPREADS.values()])
+
+
+class Bar:
+    """Aggregate of the ticks seen for one bar (or since its last flush)"""
+
+    __slots__ = ('start', 'first', 'last', 'count', 'open', 'high', 'low', 'close',
+                 'spread_min', 'spread_max', 'spread_sum', 'spread_count')
+
+    def __init__(self, start: float, ts: float, values: np.ndarray, spreads: np.ndarray):
+        self.start = start
+        self.first = self.last = ts
+        self.count = 1
+        self.open = values
+        self.high = values.copy()
+        self.low = values.copy()
+        self.close = values
+        self.spread_min = spreads
+        self.spread_max = spreads.copy()
+        # Spreads are missing (NaN) for rows without a VALR quote, e.g. backfilled ones
+        self.spread_sum = np.nan_to_num(spreads)
+        self.spread_count = (~np.isnan(spreads)).astype(np.int64)
+
+    def add(self, ts: float, values: np.ndarray, spreads: np.ndarray) -> None:
+        self.last = ts
+        self.count += 1
+        np.fmax(self.high, values, out=self.high)
+        np.fmin(self.low, values, out=self.low)
+        self.close = values
+        self.spread_min = np.fmin(self.spread_min, spreads)
+        np.fmax(self.spread_max, spreads, out=self.spread_max)
+        self.spread_sum += np.nan_to_num(spreads)
+        self.spread_count += ~np.isnan(spreads)
+
+    def merge(self, newer: 'Bar') -> None:
+        """Fold in a later aggregate of the same bar"""
+        self.last = newer.last
+        self.count += newer.count
+        np.fmax(self.high, newer.high, out=self.high)
+        np.fmin(self.low, newer.low, out=self.low)
+        self.close = newer.close
+        self.spread_min = np.fmin(self.spread_min, newer.spread_min)
+        np.fmax(self.spread_max, newer.spread_max, out=self.spread_max)
+        self.spread_sum = self.spread_sum + newer.spread_sum
+        self.spread_count = self.spread_count + newer.spread_count
+
+    def _fields(self) -> Dict[str, Dict[str, float]]:
+        fields = {field: {} for field in OHLC}
+        for i, name in enumerate(SERIES):
+            for field, values in zip(OHLC, (self.open, self.high, self.low, self.close)):
+                fields[field][f'{name}_{field}'] = float(values[i])
+        for i, name in enumerate(SPREADS):
+            fields.setdefault('min', {})[f'{name}_min'] = float(self.spread_min[i])
+            fields.setdefault('max', {})[f'{name}_max'] = float(self.spread_max[i])
+            fields.setdefault('sum', {})[f'{name}_sum'] = float(self.spread_sum[i])
+            fields['sum'][f'{name}_count'] = int(self.spread_count[i])
+        return fields
+
+    def to_doc(self) -> Dict[str, Any]:
+        """Complete bar document"""
+        doc = {
+            'bar_start': _utc(self.start),
+            'first': _utc(self.first),
+            'last': _utc(self.last),
+            'count': self.count,
+        }
+        for values in self._fields().values():
+            doc.update(values)
+        return doc
+
+    def to_update(self) -> Dict[str, Any]:
+        """Upsert merging this partial aggregate into whatever is stored"""
+        fields = self._fields()
+        return {
+            '$setOnInsert': fields['o'],
+            '$set': fields['c'],
+            '$max': {**fields['h'], **fields['max'], 'last': _utc(self.last)},
+            '$min': {**fields['l'], **fields['min'], 'first': _utc(self.first)},
+            '$inc': {**fields['sum'], 'count': self.count},
+        }
+
+
+def _utc(ts: float) -> datetime:
+    return datetime.fromtimestamp(ts, timezone.utc)
+
+
+class RollupBuilder:
+    """Live bar aggregation for every instrument and resolution.
+
+    on_tick() only touches in-memory aggregates; run() periodically writes
+    the bars changed since the previous flush. Bars whose write failed are
+    kept and merged into the next attempt; bars that were written are not
+    sent again, since their counts and sums are added with $inc.
+    """
+
+    def __init__(self, collections: Dict[str, str], resolutions: Iterable[str] = RESOLUTIONS,
+                 flush_interval: float = 1.0):
+        self.collections = collections  # instrument name -> price collection
+        self.resolutions = [(r, RESOLUTIONS[r]) for r in resolutions]
+        self.flush_interval = flush_interval
+        self._pending: Dict[Tuple[str, str, float], Bar] = {}
+
+        self.ticks = 0
+        self.bars_written = 0
+        self.failed_flushes = 0
+
+    def on_tick(self, tick: Dict[str, Any]) -> None:
+        ts = tick['timestamp'].timestamp()
+        values = _series_values(tick)
+        spreads = _spread_values(tick)
+        self.ticks += 1
+        for resolution, seconds in self.resolutions:
+            start = ts - ts % seconds
+            key = (tick['instrument'], resolution, start)
+            bar = self._pending.get(key)
+            if bar is None:
+                self._pending[key] = Bar(start, ts, values, spreads)
+            else:
+                bar.add(ts, values, spreads)
+
+    def _write(self, pending: Dict[Tuple[str, str, float], Bar]) -> Dict[Tuple[str, str, float], Bar]:
+        """Merge pending bars into their collections; returns the bars that were not written"""
+        requests: Dict[str, List[Tuple[Tuple[str, str, float], UpdateOne]]] = {}
+        for key, bar in pending.items():
+            instrument, resolution, start = key
+            name = bars_collection(self.collections[instrument], resolution)
+            requests.setdefault(name, []).append(
+                (key, UpdateOne({'bar_start': _utc(start)}, bar.to_update(), upsert=True)))
+        failed = {}
+        with db_connection() as db:
+            names = list(requests)
+            for i, name in enumerate(names):
+                items = requests[name]
+                try:
+                    ensure_bar_indexes(db, name)
+                    db[name].bulk_write([op for _, op in items], ordered=False)
+                except BulkWriteError as e:
+                    # Unordered: every update without a write error was applied and must not be sent again
+                    errors = e.details.get('writeErrors', [])
+                    for error in errors:
+                        key = items[error['index']][0]
+                        failed[key] = pending[key]
+                    logger.error(f"Rollup write to {name} rejected {len(errors)} of {len(items)} bars: "
+                                 f"{errors[0].get('errmsg') if errors else e}")
+                except Exception as e:
+                    # Nothing confirmed for this or the remaining collections
+                    for rest in names[i:]:
+                        failed.update((key, pending[key]) for key, _ in requests[rest])
+                    logger.error(f"Rollup write to {name} failed: {str(e)}")
+                    break
+        return failed
+
+    async def flush(self) -> None:
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, {}
+        loop = asyncio.get_running_loop()
+        try:
+            failed = await loop.run_in_executor(None, self._write, pending)
+        except Exception as e:
+            logger.error(f"Rollup flush failed: {str(e)}")
+            failed = pending
+        self.bars_written += len(pending) - len(failed)
+        if not failed:
+            return
+        self.failed_flushes += 1
+        logger.error(f"Keeping {len(failed)} of {len(pending)} bars for the next rollup flush")
+        # Only the unwritten aggregates are merged with the ticks that arrived meanwhile
+        for key, bar in self._pending.items():
+            if key in failed:
+                failed[key].merge(bar)
+            else:
+                failed[key] = bar
+        self._pending = failed
+
+    async def run(self) -> None:
+        try:
+            while True:
+                await asyncio.sleep(self.flush_interval)
+                await self.flush()
+        finally:
+            await self.flush()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'ticks': self.ticks,
+            'pending_bars': len(self._pending),
+            'bars_written': self.bars_written,
+            'failed_flushes': self.failed_flushes
+        }
+
+
+_indexed = set()
+
+
+def ensure_bar_indexes(db, name: str) -> None:
+    if name not in _indexed:
+        db[name].create_index([('bar_start', ASCENDING)], unique=True, background=True)
+        _indexed.add(name)
+
+
+def bars_from_columns(columns: Dict[str, np.ndarray], seconds: int) -> List[Bar]:
+    """Aggregate ascending tick columns (from iter_price_data_range) into bars"""
+    ts = columns['timestamp'].astype('datetime64[us]').astype('int64') / 1e6
+    if not len(ts):
+        return []
+    values = np.column_stack([
+        columns['ib_bid'], columns['ib_ask'], (columns['ib_bid'] + columns['ib_ask']) / 2,
+        columns['valr_bid'], columns['valr_ask'], (columns['valr_bid'] + columns['valr_ask']) / 2,
+    ])
+    spreads = np.column_stack([columns[sell] - columns[buy] for sell, buy in SPREADS.values()])
+    starts = ts - ts % seconds
+    # Ticks are sorted, so each bar is a contiguous run
+    bounds = np.flatnonzero(np.diff(starts)) + 1
+    idx = np.concatenate(([0], bounds))
+    last_idx = np.concatenate((bounds - 1, [len(ts) - 1]))
+    counts = np.diff(np.concatenate((idx, [len(ts)])))
+
+    high = np.fmax.reduceat(values, idx, axis=0)
+    low = np.fmin.reduceat(values, idx, axis=0)
+    spread_min = np.fmin.reduceat(spreads, idx, axis=0)
+    spread_max = np.fmax.reduceat(spreads, idx, axis=0)
+    spread_sum = np.add.reduceat(np.nan_to_num(spreads), idx, axis=0)
+    spread_count = np.add.reduceat((~np.isnan(spreads)).astype(np.int64), idx, axis=0)
+
+    bars = []
+    for b, (first, last) in enumerate(zip(idx, last_idx)):
+        bar = Bar(starts[first], ts[first], values[first], spread_min[b])
+        bar.last = ts[last]
+        bar.count = int(counts[b])
+        bar.high = high[b]
+        bar.low = low[b]
+        bar.close = values[last]
+        bar.spread_max = spread_max[b]
+        bar.spread_sum = spread_sum[b]
+        bar.spread_count = spread_count[b]
+        bars.append(bar)
+    return bars
+
+
+def _epoch(ts: datetime) -> float:
+    return ts.replace(tzinfo=timezone.utc).timestamp() if ts.tzinfo is None else ts.timestamp()
+
+
+def backfill(start_time: datetime, end_time: datetime, resolutions: Iterable[str] = RESOLUTIONS,
+             collection: str = usdzar_db.DEFAULT_COLLECTION, batch_size: int = 50000) -> Dict[str, int]:
+    """Rebuild bars from stored ticks, replacing any bars already in the range.
+
+    The range is widened to whole bars of the largest resolution, so every
+    bar is rebuilt from all of its ticks, and ends before the bars the
+    collector may still be updating. Naive datetimes are UTC.
+    """
+    resolutions = list(resolutions)
+    carry: Dict[str, Optional[Bar]] = {r: None for r in resolutions}
+    written = {r: 0 for r in resolutions}
+    seconds = max(RESOLUTIONS[r] for r in resolutions)
+    start = _epoch(start_time) // seconds * seconds
+    end = min(_epoch(end_time) // seconds * seconds + seconds,
+              (time.time() - LIVE_MARGIN) // seconds * seconds)
+    if end <= start:
+        logger.info(f"No complete {seconds}s bars between {start_time} and {end_time} to rebuild")
+        return written
+    start_time, end_time = _utc(start), _utc(end - 0.001)  # Stored timestamps have millisecond precision
+    logger.info(f"Rebuilding bars from {start_time} to {end_time}")
+    fields = ['timestamp', 'ib_bid', 'ib_ask', 'valr_bid', 'valr_ask']
+
+    def write(resolution: str, bars: List[Bar]) -> None:
+        if not bars:
+            return
+        name = bars_collection(collection, resolution)
+        with db_connection() as db:
+            ensure_bar_indexes(db, name)
+            db[name].bulk_write([ReplaceOne({'bar_start': _utc(bar.start)}, bar.to_doc(), upsert=True)
+                                 for bar in bars], ordered=False)
+        written[resolution] += len(bars)
+
+    for columns in usdzar_db.iter_price_data_range(start_time, end_time, fields=fields,
+                                                   batch_size=batch_size, collection=collection):
+        for resolution in resolutions:
+            bars = bars_from_columns(columns, RESOLUTIONS[resolution])
+            # The first bar may continue the last one of the previous batch
+            previous = carry[resolution]
+            if previous is not None and bars and bars[0].start == previous.start:
+                previous.merge(bars.pop(0))
+                bars.insert(0, previous)
+            elif previous is not None:
+                bars.insert(0, previous)
+            carry[resolution] = bars.pop() if bars else None
+            write(resolution, bars)
+        logger.info(f"Rolled up ticks to {columns['timestamp'][-1]}: {written}")
+
+    for resolution, bar in carry.items():
+        if bar is not None:
+            write(resolution, [bar])
+    return written
+
+
+def get_bars(start_time: datetime, end_time: datetime, resolution: str = '1m',
+             collection: str = usdzar_db.DEFAULT_COLLECTION) -> List[Dict[str, Any]]:
+    """Bars starting within a time range, oldest first, with mean spreads filled in"""
+    with db_connection() as db:
+        cursor = db[bars_collection(collection, resolution)].find(
+            {'bar_start': {'$gte': start_time, '$lte': end_time}}, projection={'_id': 0}
+        ).sort('bar_start', ASCENDING)
+        bars = list(cursor)
+    for bar in bars:
+        for name in SPREADS:
+            # Bars written before per-spread counts were kept only have the tick count
+            count = bar.get(f'{name}_count', bar.get('count'))
+            bar[f'{name}_mean'] = bar[f'{name}_sum'] / count if count else None
+    return bars
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s'
+    )
+    parser = argparse.ArgumentParser(description="Rebuild OHLC/spread bars from stored ticks")
+    parser.add_argument('--from', dest='start', required=True, type=datetime.fromisoformat,
+                        help="Start of the range (ISO date/time, UTC)")
+    parser.add_argument('--to', dest='end', type=datetime.fromisoformat, default=None,
+                        help="End of the range (default: now)")
+    parser.add_argument('--collection', default=usdzar_db.DEFAULT_COLLECTION, help="Instrument collection")
+    parser.add_argument('--resolutions', default=','.join(RESOLUTIONS), type=parse_resolutions)
+    parser.add_argument('--batch-size', type=int, default=50000)
+    args = parser.parse_args()
+    try:
+        totals = backfill(args.start, args.end or datetime.now(timezone.utc), args.resolutions,
+                          args.collection, args.batch_size)
+        logging.info(f"Backfill complete: {totals}")
+    finally:
+        close_connection()
@@ -0,0 +1,499 @@
+import asyncio
+import functools
+import json
+import logging
+import math
+import mmap
+import os
+import struct
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, timezone
+from zoneinfo import ZoneInfo
+from typing import Any, Callable, Dict, List, Optional
+from bson import ObjectId
+import metrics
+from tick_capture import SOURCE_CODES, SOURCES
+
+logger = logging.getLogger(__name__)
+
+SA_TZ = ZoneInfo("Africa/Johannesburg")
+
+# Segment file layout: a fixed header followed by fixed-width records.
+#   header: magic, format version, record size, record capacity
+#   record: epoch seconds, ib_bid, ib_ask, valr_bid, valr_ask,
+#           ib/valr receive time (epoch), valr event time (epoch), ib/valr receive monotonic time,
+#           source code (index into tick_capture.SOURCES), commit marker,
+#           instrument code (index into instruments.json in the spool directory),
+#           flags (bit 0: stale quote pair, bit 1: IB quote delivered tick-by-tick)
+# Version 1 records lack the timing fields and flags; such segments are still replayed after an upgrade.
+MAGIC = b'USDZSPL1'
+VERSION = 2
+HEADER = struct.Struct('<8sHHI48x')
+RECORD_FORMATS = {
+    # version: (record layout, byte offset of the commit marker inside a record)
+    1: (struct.Struct('<d4dBBH4x'), 41),
+    2: (struct.Struct('<d4d5dBBHB3x'), 81),
+}
+RECORD, COMMIT_OFFSET = RECORD_FORMATS[VERSION]
+COMMITTED = 0xA5
+FLAG_STALE = 0x01
+FLAG_TICK_BY_TICK = 0x02
+_NO_TIMING = (math.nan,) * 5
+
+
+class _Segment:
+    """One memory-mapped, pre-allocated spool segment file"""
+
+    def __init__(self, path: str, seq: int, capacity: int, create: bool = False):
+        self.path = path
+        self.seq = seq
+        if create:
+            size = HEADER.size + capacity * RECORD.size
+            fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0o644)
+            try:
+                # Reserve the disk space now so a full disk fails here, not as SIGBUS on write
+                os.posix_fallocate(fd, 0, size)
+                os.write(fd, HEADER.pack(MAGIC, VERSION, RECORD.size, capacity))
+            except OSError:
+                os.remove(path)  # A later attempt creates the same file
+                raise
+            finally:
+                os.close(fd)
+        with open(path, 'r+b') as f:
+            self.mm = mmap.mmap(f.fileno(), 0)
+        magic, self.version, record_size, self.capacity = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC or self.version not in RECORD_FORMATS or record_size != RECORD_FORMATS[self.version][0].size:
+            self.mm.close()
+            raise ValueError(f"Unsupported spool segment {path} (version {self.version})")
+        self.record, self.commit_offset = RECORD_FORMATS[self.version]
+        self.count = self._committed_count()
+
+    def _committed(self, index: int) -> bool:
+        return self.mm[HEADER.size + index * self.record.size + self.commit_offset] == COMMITTED
+
+    def _committed_count(self) -> int:
+        """Find the end of the committed prefix (records are only ever appended)"""
+        lo, hi = 0, self.capacity
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._committed(mid):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    @property
+    def full(self) -> bool:
+        return self.count >= self.capacity
+
+    @property
+    def writable(self) -> bool:
+        return self.version == VERSION and not self.full
+
+    def append(self, values: tuple) -> None:
+        offset = HEADER.size + self.count * RECORD.size
+        RECORD.pack_into(self.mm, offset, *values)
+        self.mm[offset + COMMIT_OFFSET] = COMMITTED
+        self.count += 1
+
+    def read(self, index: int) -> tuple:
+        """Record at `index` in the current version's field order"""
+        values = self.record.unpack_from(self.mm, HEADER.size + index * self.record.size)
+        if self.version == 1:
+            values = values[:5] + _NO_TIMING + values[5:] + (0,)
+        return values
+
+    def close(self) -> None:
+        if not self.mm.closed:
+            self.mm.flush()
+            self.mm.close()
+
+
+class TickSpool:
+    """Local write-ahead spool for ticks in front of MongoDB.
+
+    `submit` appends a fixed-width record to a memory-mapped segment file
+    and returns immediately, so the capture path never waits on the
+    database. A background task replays committed records into MongoDB in
+    order through `write_batch`, persisting a checkpoint after every
+    acknowledged batch and deleting segments once they are fully replayed.
+    If MongoDB is unavailable the records simply accumulate on disk. A
+    batch MongoDB partly rejects `max_rejections` times in a row is written
+    record by record, and the records it still rejects are appended to
+    dead-letter.jsonl in the spool directory. Once
+    the active segment is half full, `submit` starts allocating the next
+    one in a worker thread, so rotating only switches files.
+
+    Replayed documents get an _id derived from their spool position, so a
+    batch replayed twice (e.g. after a crash before the checkpoint was
+    saved) is rejected as duplicates instead of stored twice. Such batches,
+    the first one after a restart and any retried one, are written with
+    `write_batch(batch, retry=True)`.
+    """
+
+    def __init__(self, directory: str, write_batch: Callable[..., int],
+                 segment_records: int = 1000000, replay_batch: int = 1000,
+                 on_flush: Optional[Callable[[bool], None]] = None, instruments: Optional[List[str]] = None,
+                 max_rejections: int = 5):
+        self.directory = directory
+        self.write_batch = write_batch
+        self.segment_records = segment_records
+        self.replay_batch = replay_batch
+        self.on_flush = on_flush
+        self.max_rejections = max_rejections
+        self.checkpoint_path = os.path.join(directory, 'checkpoint.json')
+        self.instruments_path = os.path.join(directory, 'instruments.json')
+        self.dead_letter_path = os.path.join(directory, 'dead-letter.jsonl')
+        self._segments: Dict[int, _Segment] = {}
+        self._active: Optional[_Segment] = None
+        self._next: Optional[Future] = None  # allocation of the segment after the active one
+        self._allocator = ThreadPoolExecutor(max_workers=1, thread_name_prefix='spool-allocate')
+        self._allocate_after = 0.0  # monotonic time before which a failed allocation is not retried
+        self._task: Optional[asyncio.Task] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._stopping = False
+        self._retry = True  # The first batch may have been written before the last checkpoint was saved
+
+        # Metrics
+        self.appended = 0
+        self.dropped = 0
+        self.replayed = 0
+        self.replay_failures = 0
+        self.dead_lettered = 0
+        self.rotations = 0
+
+        os.makedirs(directory, exist_ok=True)
+        self._instrument_names: List[str] = self._load_instruments()
+        self._instrument_codes = {name: code for code, name in enumerate(self._instrument_names)}
+        for name in instruments or ():
+            self._instrument_code(name)  # Known up front, so submit does not have to write instruments.json
+        self.checkpoint = self._load_checkpoint()
+        self._open_segments()
+
+    # -- files ---------------------------------------------------------------
+
+    def _segment_path(self, seq: int) -> str:
+        return os.path.join(self.directory, f"spool-{seq:08d}.seg")
+
+    def _existing_segments(self) -> List[int]:
+        seqs = []
+        for name in os.listdir(self.directory):
+            if name.startswith('spool-') and name.endswith('.seg'):
+                seqs.append(int(name[6:-4]))
+        return sorted(seqs)
+
+    def _load_checkpoint(self) -> Dict[str, int]:
+        try:
+            with open(self.checkpoint_path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {'segment': 0, 'index': 0}
+        except (ValueError, OSError) as e:
+            logger.error(f"Unreadable spool checkpoint, replaying from the oldest segment: {str(e)}")
+            return {'segment': 0, 'index': 0}
+
+    def _load_instruments(self) -> List[str]:
+        try:
+            with open(self.instruments_path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return []
+
+    def _instrument_code(self, name: Optional[str]) -> int:
+        """Stable code for an instrument name; new names are appended to instruments.json"""
+        code = self._instrument_codes.get(name)
+        if code is None:
+            code = len(self._instrument_names)
+            self._instrument_names.append(name)
+            self._instrument_codes[name] = code
+            tmp = self.instruments_path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(self._instrument_names, f)
+            os.replace(tmp, self.instruments_path)
+        return code
+
+    def _save_checkpoint(self, checkpoint: Dict[str, int], retired: Optional[_Segment] = None) -> None:
+        """Persist a checkpoint and delete the segment it moved past; runs in a worker thread"""
+        tmp = self.checkpoint_path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(checkpoint, f)
+        os.replace(tmp, self.checkpoint_path)
+        if retired is not None:
+            retired.close()
+            os.remove(retired.path)
+
+    def _open_segments(self) -> None:
+        seqs = self._existing_segments()
+        for seq in seqs:
+            if seq < self.checkpoint['segment']:
+                os.remove(self._segment_path(seq))  # Replayed before the last shutdown
+                continue
+            try:
+                self._segments[seq] = _Segment(self._segment_path(seq), seq, self.segment_records)
+            except ValueError as e:
+                logger.error(str(e))
+        if self._segments:
+            oldest = min(self._segments)
+            if self.checkpoint['segment'] < oldest:
+                self.checkpoint = {'segment': oldest, 'index': 0}
+            last = self._segments[max(self._segments)]
+            if last.writable:
+                self._active = last
+        if self._active is None:
+            if self._segments:
+                seq = max(self._segments) + 1
+            else:
+                # Nothing left to replay: start after the last checkpointed segment
+                seq = self.checkpoint['segment'] + 1
+                self.checkpoint = {'segment': seq, 'index': 0}
+            self._active = self._segments[seq] = self._create_segment(seq)
+        pending = self.pending()
+        if pending:
+            logger.info(f"Spool has {pending} records waiting to be replayed")
+
+    def _rotate(self) -> None:
+        if self._next is None:
+            self._prepare_next()
+            if self._next is None:
+                raise RuntimeError("No spool segment available, allocation is retried shortly")
+        future, self._next = self._next, None
+        try:
+            # Started when the active segment was half full, so normally long finished
+            self._active = future.result()
+        except Exception as e:
+            self._allocate_after = time.monotonic() + 1
+            raise RuntimeError(f"Spool segment allocation failed: {str(e)}") from e
+        self._segments[self._active.seq] = self._active
+        self.rotations += 1
+
+    def _create_segment(self, seq: int) -> _Segment:
+        return _Segment(self._segment_path(seq), seq, self.segment_records, create=True)
+
+    def _prepare_next(self) -> None:
+        """Start allocating the segment after the active one in the allocator thread"""
+        if time.monotonic() >= self._allocate_after:
+            self._next = self._allocator.submit(self._create_segment, self._active.seq + 1)
+
+    # -- capture side --------------------------------------------------------
+
+    def submit(self, doc: Dict[str, Any]) -> bool:
+        """Append a tick to the spool; returns False if it could not be recorded"""
+        if self._stopping:
+            self.dropped += 1
+            return False
+        try:
+            if not self._active.writable:
+                self._rotate()
+            self._active.append((
+                doc['timestamp'].timestamp(),
+                _encode_price(doc.get('ib_bid')),
+                _encode_price(doc.get('ib_ask')),
+                _encode_price(doc.get('valr_bid')),
+                _encode_price(doc.get('valr_ask')),
+                _encode_time(doc.get('ib_recv_time')),
+                _encode_time(doc.get('valr_recv_time')),
+                _encode_time(doc.get('valr_event_time')),
+                _encode_price(doc.get('ib_recv_mono')),
+                _encode_price(doc.get('valr_recv_mono')),
+                SOURCE_CODES.get(doc.get('source'), 0),
+                0,
+                self._instrument_code(doc.get('instrument')),
+                (FLAG_STALE if doc.get('stale') else 0)
+                | (FLAG_TICK_BY_TICK if doc.get('ib_mode') == 'tick_by_tick' else 0)
+            ))
+            if self._next is None and self._active.count >= self._active.capacity // 2:
+                self._prepare_next()
+        except Exception as e:
+            self.dropped += 1
+            logger.error(f"Failed to append tick to spool: {str(e)}")
+            return False
+        self.appended += 1
+        if self._wakeup is not None:
+            self._wakeup.set()
+        return True
+
+    # -- replay side ---------------------------------------------------------
+
+    def pending(self) -> int:
+        """Number of committed records not yet replayed into MongoDB"""
+        total = 0
+        for seq, segment in list(self._segments.items()):  # also called from metrics scrapes
+            if seq == self.checkpoint['segment']:
+                total += segment.count - self.checkpoint['index']
+            elif seq > self.checkpoint['segment']:
+                total += segment.count
+        return total
+
+    def _next_batch(self) -> List[Dict[str, Any]]:
+        seq, index = self.checkpoint['segment'], self.checkpoint['index']
+        segment = self._segments.get(seq)
+        if segment is None:
+            return []
+        end = min(segment.count, index + self.replay_batch)
+        return [_decode(segment.read(i), seq, i, self._instrument_names) for i in range(index, end)]
+
+    async def _advance(self, n: int) -> None:
+        """Move the checkpoint past `n` replayed records, retiring finished segments"""
+        self.checkpoint['index'] += n
+        segment = self._segments[self.checkpoint['segment']]
+        retired = None
+        if segment is not self._active and self.checkpoint['index'] >= segment.count:
+            del self._segments[segment.seq]
+            self.checkpoint = {'segment': min(self._segments), 'index': 0}
+            retired = segment
+        await asyncio.get_running_loop().run_in_executor(None, self._save_checkpoint, dict(self.checkpoint), retired)
+
+    def _isolate(self, batch: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Write a repeatedly rejected batch one record at a time; returns the records still rejected"""
+        rejected = [doc for doc in batch if self.write_batch([doc], retry=True) != 1]
+        if rejected:
+            with open(self.dead_letter_path, 'a') as f:
+                for doc in rejected:
+                    f.write(json.dumps(doc, default=str) + '\n')
+        return rejected
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._stopping = False
+            self._task = asyncio.ensure_future(self.replay())
+
+    async def replay(self) -> None:
+        loop = asyncio.get_running_loop()
+        retry_delay = 1
+        rejections = 0  # Consecutive partial acknowledgements of the current batch
+        while True:
+            batch = self._next_batch()
+            if not batch:
+                segment = self._segments.get(self.checkpoint['segment'])
+                if segment is not None and segment is not self._active and self.checkpoint['index'] >= segment.count:
+                    await self._advance(0)
+                    continue
+                if self._stopping:
+                    return
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), 1)
+                except asyncio.TimeoutError:
+                    # Idle: push dirty pages to disk
+                    await loop.run_in_executor(None, self._active.mm.flush)
+                continue
+
+            start = time.perf_counter()
+            stored = batch
+            try:
+                if rejections >= self.max_rejections:
+                    # Rejected every time: set aside the records MongoDB will not take so replay can go on
+                    rejected = await loop.run_in_executor(None, self._isolate, batch)
+                    if rejected:
+                        self.dead_lettered += len(rejected)
+                        logger.error(f"Moved {len(rejected)} spooled records MongoDB keeps rejecting "
+                                     f"to {self.dead_letter_path}")
+                        stored = [doc for doc in batch if doc not in rejected]
+                    written = len(batch)
+                elif self._retry:
+                    written = await loop.run_in_executor(None, functools.partial(self.write_batch, batch, retry=True))
+                else:
+                    written = await loop.run_in_executor(None, self.write_batch, batch)
+                if written < len(batch):
+                    rejections += 1
+            except Exception as e:
+                logger.error(f"Spool replay failed: {str(e)}")
+                written = 0
+            metrics.mongo_write_seconds.observe(time.perf_counter() - start)
+            metrics.mongo_batch_size.observe(len(batch))
+            if written == len(batch):
+                metrics.observe_stored(stored)
+                self.replayed += len(stored)
+                await self._advance(written)
+                self._retry = False
+                rejections = 0
+                retry_delay = 1
+                if self.on_flush:
+                    self.on_flush(True)
+            else:
+                # Keep order: retry the same batch until MongoDB accepts it
+                self._retry = True
+                self.replay_failures += 1
+                metrics.mongo_write_failures.inc()
+                if self.on_flush:
+                    self.on_flush(False)
+                if self._stopping:
+                    return
+                await asyncio.sleep(retry_delay)
+                retry_delay = min(retry_delay * 2, 30)
+
+    async def stop(self, timeout: float = 30) -> None:
+        """Stop accepting ticks, try to replay what is left and close the segments"""
+        if self._task is not None:
+            self._stopping = True
+            self._wakeup.set()
+            try:
+                await asyncio.wait_for(self._task, timeout)
+            except asyncio.TimeoutError:
+                self._task.cancel()
+            self._task = None
+        pending = self.pending()
+        if pending:
+            logger.info(f"{pending} spooled records will be replayed on next start")
+        for segment in self._segments.values():
+            segment.close()
+        if self._next is not None:
+            # Unused pre-allocated segment: empty, so nothing is lost
+            try:
+                segment = self._next.result()
+                segment.close()
+                os.remove(segment.path)
+            except Exception:
+                pass  # Failed allocations leave no file behind
+            self._next = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'pending': self.pending(),
+            'appended': self.appended,
+            'replayed': self.replayed,
+            'dropped': self.dropped,
+            'replay_failures': self.replay_failures,
+            'dead_lettered': self.dead_lettered,
+            'segments': len(self._segments),
+            'rotations': self.rotations
+        }
+
+
+def _encode_price(value) -> float:
+    return math.nan if value is None else value
+
+
+def _encode_time(value: Optional[datetime]) -> float:
+    return math.nan if value is None else value.timestamp()
+
+
+def _decode_time(value: float, tz=SA_TZ) -> Optional[datetime]:
+    return None if value != value else datetime.fromtimestamp(value, tz)
+
+
+def _decode(record: tuple, seq: int, index: int, instruments: List[str]) -> Dict[str, Any]:
+    (ts, ib_bid, ib_ask, valr_bid, valr_ask, ib_recv, valr_recv, valr_event, ib_mono, valr_mono,
+     source, _, instrument, flags) = record
+    # Deterministic _id from the spool position keeps replays idempotent
+    oid = ObjectId(struct.pack('>III', int(ts), seq & 0xFFFFFFFF, index))
+    return {
+        '_id': oid,
+        'timestamp': datetime.fromtimestamp(ts, SA_TZ),
+        'ib_bid': None if ib_bid != ib_bid else ib_bid,
+        'ib_ask': None if ib_ask != ib_ask else ib_ask,
+        'valr_bid': None if valr_bid != valr_bid else valr_bid,
+        'valr_ask': None if valr_ask != valr_ask else valr_ask,
+        'source': SOURCES[source] if source < len(SOURCES) else 'sample',
+        'instrument': instruments[instrument] if instrument < len(instruments) else None,
+        'ib_recv_time': _decode_time(ib_recv),
+        'valr_recv_time': _decode_time(valr_recv),
+        'valr_event_time': _decode_time(valr_event, timezone.utc),
+        'ib_recv_mono': None if ib_mono != ib_mono else ib_mono,
+        'valr_recv_mono': None if valr_mono != valr_mono else valr_mono,
+        'quote_skew': None if ib_mono != ib_mono or valr_mono != valr_mono else abs(ib_mono - valr_mono),
+        'stale': bool(flags & FLAG_STALE),
+        'ib_mode': 'tick_by_tick' if flags & FLAG_TICK_BY_TICK else 'mktdata'
+    }
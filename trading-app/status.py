@@ -1,54 +1,41 @@
-import sys
 import logging
+import os
 import docker
-import logging
-import sys
+
+IB_GATEWAY_CONTAINER = os.environ.get('IB_GATEWAY_CONTAINER', 'ib-gateway-docker_ib-gateway_1')
+
 
 class Status:
+    """Overall collector state, kept up to date by the supervisor.
+
+    The supervisor decides what to restart; this only tracks whether every
+    component is healthy and restarts individual containers on request.
+    """
+
     def __init__(self):
         self.current = "RUNNING"
-        self.error_count = 0
-        self.max_errors = 8
-    
-    def restart_services(self):
-        try:
-            logging.info("Restarting trading-app and ib-gateway services...")
-            # Use Docker Python SDK to restart containers
-            client = docker.from_env()
-            
-            # Restart IB Gateway first
-            ib_container = client.containers.get('ib-gateway-docker_ib-gateway_1')
-            ib_container.restart()
-            logging.info("IB Gateway container restart initiated")
-            
-            # Then restart trading-app
-            trading_container = client.containers.get('ib-gateway-docker_trading-app_1')
-            trading_container.restart()
-            logging.info("Trading app container restart initiated")
-            
-            logging.info("Restart commands sent successfully")
-        except docker.errors.DockerException as e:
-            logging.error(f"Failed to restart services: {str(e)}")
-        finally:
-            # Exit the container to ensure a clean restart
-            sys.exit(1)
-    
-    def set_inactive(self):
+        self.error_count = 0  # Components that went unhealthy since everything was last healthy
+
+    def restart_container(self, name: str = IB_GATEWAY_CONTAINER) -> bool:
+        """Restart one container through the Docker socket; raises docker.errors.DockerException on failure"""
+        logging.info(f"Restarting container {name}...")
+        client = docker.from_env()
+        client.containers.get(name).restart()
+        logging.info(f"Container {name} restart initiated")
+        return True
+
+    def set_inactive(self, reason: str = ''):
         self.current = "INACTIVE"
         self.error_count += 1
-        logging.warning(f"Status set to INACTIVE. Error count: {self.error_count}/{self.max_errors}")
-        
-        if self.error_count >= self.max_errors:
-            logging.error(f"Maximum error count ({self.max_errors}) reached. Restarting services...")
-            self.restart_services()
-    
+        logging.warning(f"Status set to INACTIVE{': ' + reason if reason else ''}. Error count: {self.error_count}")
+
     def set_running(self):
         self.current = "RUNNING"
         if self.error_count > 0:
             logging.info(f"Status back to RUNNING. Resetting error count from {self.error_count} to 0")
         self.error_count = 0
-    
+
     def get_status(self):
         return self.current
 
-status = Status()
\ No newline at end of file
+status = Status()
@@ -0,0 +1,236 @@
+"""Per-component health supervision with escalating recovery."""
+import asyncio
+import json
+import logging
+import time
+from collections import deque
+from datetime import datetime, timezone
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Health check: returns a description of the problem, or None when healthy
+Check = Callable[[], Optional[str]]
+# Recovery action: returns False if it does not apply in the current state (skip to the next step)
+Action = Callable[[], Awaitable[Optional[bool]]]
+
+CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+
+def _now() -> str:
+    return datetime.now(timezone.utc).isoformat(timespec='milliseconds')
+
+
+class RecoveryStep:
+    __slots__ = ('name', 'action', 'attempts', 'cooldown')
+
+    def __init__(self, name: str, action: Action, attempts: int = 1, cooldown: float = 30):
+        self.name = name
+        self.action = action
+        self.attempts = attempts
+        self.cooldown = cooldown
+
+
+class CircuitBreaker:
+    """Opens after `threshold` consecutive failures and stays open until `reopen_at`"""
+
+    __slots__ = ('threshold', 'failures', 'state', 'reopen_at', 'trips')
+
+    def __init__(self, threshold: int = 3):
+        self.threshold = threshold
+        self.failures = 0
+        self.state = CLOSED
+        self.reopen_at = 0.0
+        self.trips = 0
+
+    def record_success(self) -> None:
+        self.failures = 0
+        self.state = CLOSED
+
+    def record_failure(self, now: float) -> bool:
+        """Count a failure; True when a recovery action should run now"""
+        self.failures += 1
+        if self.state == OPEN:
+            if now < self.reopen_at:
+                return False
+            self.state = HALF_OPEN  # cooldown over: this failed probe escalates
+        if self.state == HALF_OPEN or self.failures >= self.threshold:
+            return True
+        return False
+
+    def open(self, now: float, cooldown: float) -> None:
+        self.state = OPEN
+        self.reopen_at = now + cooldown
+        self.trips += 1
+
+
+class Component:
+    """Health and recovery state of one supervised component"""
+
+    def __init__(self, name: str, check: Check, steps: List[RecoveryStep], threshold: int = 3):
+        self.name = name
+        self.check = check
+        self.steps = steps
+        self.breaker = CircuitBreaker(threshold)
+        self.healthy: Optional[bool] = None  # None until the first check
+        self.was_healthy = False  # Outages are only recorded once the component has worked
+        self.problem: Optional[str] = None
+        self.step_index = 0
+        self.step_attempts = 0
+        self.outage: Optional[Dict[str, Any]] = None
+        self._outage_start = 0.0
+        self._recovery_start: Optional[float] = None
+
+        # Totals for monitoring
+        self.outages = 0
+        self.outage_seconds = 0.0
+        self.actions: Dict[str, int] = {step.name: 0 for step in steps}
+        self.action_failures = 0
+
+    def next_step(self) -> RecoveryStep:
+        """The step to run now, escalating once the current one has used its attempts"""
+        if self.step_attempts >= self.steps[self.step_index].attempts:
+            self.step_index = (self.step_index + 1) % len(self.steps)
+            self.step_attempts = 0
+        return self.steps[self.step_index]
+
+    def reset_ladder(self) -> None:
+        self.step_index = 0
+        self.step_attempts = 0
+
+
+class Supervisor:
+    def __init__(self, interval: float = 1.0, history_size: int = 200, outage_log: Optional[str] = None,
+                 on_change: Optional[Callable[['Component'], None]] = None):
+        self.interval = interval
+        self.components: Dict[str, Component] = {}
+        self.history: Deque[Dict[str, Any]] = deque(maxlen=history_size)
+        self.outage_log = outage_log
+        self.on_change = on_change  # called when a component turns healthy or unhealthy
+
+    def register(self, name: str, check: Check, steps: List[RecoveryStep], threshold: int = 3) -> Component:
+        if not steps:
+            raise ValueError(f"Component {name} needs at least one recovery step")
+        component = self.components[name] = Component(name, check, steps, threshold)
+        return component
+
+    async def run(self) -> None:
+        # One loop per component, so a slow recovery action does not hold up the other checks
+        await asyncio.gather(*(self._watch(component) for component in self.components.values()))
+
+    async def _watch(self, component: Component) -> None:
+        while True:
+            await self.evaluate(component)
+            await asyncio.sleep(self.interval)
+
+    async def evaluate(self, component: Component, now: Optional[float] = None) -> None:
+        now = time.monotonic() if now is None else now
+        try:
+            problem = component.check()
+        except Exception as e:
+            problem = f"health check raised {type(e).__name__}: {e}"
+        if problem is None:
+            self._healthy(component, now)
+        else:
+            await self._unhealthy(component, problem, now)
+
+    def _healthy(self, component: Component, now: float) -> None:
+        component.breaker.record_success()
+        if component.healthy:
+            return
+        if component.outage is not None:
+            self._finish_outage(component, now)
+        elif component.healthy is False:
+            logger.info(f"{component.name} is up")
+        component.healthy = True
+        component.was_healthy = True
+        component.problem = None
+        component.reset_ladder()
+        if self.on_change:
+            self.on_change(component)
+
+    async def _unhealthy(self, component: Component, problem: str, now: float) -> None:
+        component.problem = problem
+        if component.healthy is not False:
+            component.healthy = False
+            if component.was_healthy:
+                component.outage = {'component': component.name, 'problem': problem, 'detected': _now(),
+                                    'actions': []}
+                component._outage_start = now
+                component._recovery_start = None
+                logger.warning(f"{component.name} unhealthy: {problem}")
+            else:
+                logger.warning(f"{component.name} not up yet: {problem}")
+            if self.on_change:
+                self.on_change(component)
+        if component.breaker.record_failure(now):
+            await self._recover(component, now)
+
+    async def _recover(self, component: Component, now: float) -> None:
+        # Steps that do not apply right now (returning False) are skipped without waiting
+        for _ in range(len(component.steps)):
+            step = component.next_step()
+            component.step_attempts += 1
+            logger.warning(f"{component.name}: {step.name} (attempt {component.step_attempts}/{step.attempts}) "
+                           f"after: {component.problem}")
+            started, started_at = time.monotonic(), _now()
+            try:
+                applied = await step.action()
+                ok = True
+            except Exception as e:
+                logger.error(f"{component.name}: {step.name} failed: {str(e)}")
+                applied, ok = True, False
+                component.action_failures += 1
+            if applied is False:
+                component.step_attempts = step.attempts  # Escalate straight to the next step
+                continue
+            component.actions[step.name] += 1
+            if component._recovery_start is None:
+                component._recovery_start = now
+            if component.outage is not None:
+                component.outage['actions'].append({'action': step.name, 'at': started_at, 'ok': ok,
+                                                    'seconds': round(time.monotonic() - started, 3)})
+            component.breaker.open(now + (time.monotonic() - started), step.cooldown)  # cooldown runs from the end
+            return
+        # Nothing applied: check again after the shortest cooldown
+        component.breaker.open(now, min(step.cooldown for step in component.steps))
+
+    def _finish_outage(self, component: Component, now: float) -> None:
+        outage = component.outage
+        duration = now - component._outage_start
+        outage['recovered'] = _now()
+        outage['outage_seconds'] = round(duration, 3)
+        outage['recovery_seconds'] = (round(now - component._recovery_start, 3)
+                                      if component._recovery_start is not None else None)
+        outage['recovered_by'] = outage['actions'][-1]['action'] if outage['actions'] else None
+        component.outages += 1
+        component.outage_seconds += duration
+        component.outage = None
+        self.history.append(outage)
+        how = f"after {outage['recovered_by']}" if outage['recovered_by'] else "without intervention"
+        logger.info(f"{component.name} recovered {how}: outage {duration:.1f}s, "
+                    f"{len(outage['actions'])} recovery action(s)")
+        if self.outage_log:
+            try:
+                with open(self.outage_log, 'a') as f:
+                    f.write(json.dumps(outage) + '\n')
+            except OSError as e:
+                logger.error(f"Could not write outage log {self.outage_log}: {str(e)}")
+
+    @property
+    def all_healthy(self) -> bool:
+        return all(c.healthy for c in self.components.values())
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        return {
+            name: {
+                'healthy': c.healthy,
+                'problem': c.problem,
+                'breaker': c.breaker.state,
+                'step': c.steps[c.step_index].name if c.healthy is False else None,
+                'outages': c.outages,
+                'outage_seconds': round(c.outage_seconds, 1),
+                'actions': dict(c.actions),
+            }
+            for name, c in self.components.items()
+        }
@@ -0,0 +1,24 @@
+import analytics
+
+
+def _tick(valr_bid):
+    return {'ib_bid': 18.5, 'ib_ask': 18.5, 'valr_bid': valr_bid, 'valr_ask': 18.6}
+
+
+def test_percentiles_cover_each_window_separately():
+    spreads = analytics.SpreadAnalytics('USDZAR', windows=(10, 100), quantiles=(0.5, 0.95))
+    for _ in range(90):
+        spreads.on_tick(_tick(18.5))
+    for _ in range(10):
+        spreads.on_tick(_tick(18.6))  # The last 10 ticks sell VALR 10c over IB
+
+    summary = spreads.summary()['valr_over_ib']
+    bps = 0.1 / 18.5 * 1e4
+    assert abs(summary['p50_10'] - bps) < 1e-6 and abs(summary['p95_10'] - bps) < 1e-6
+    assert summary['p50_100'] == 0.0
+    assert abs(summary['p95_100'] - bps) < 1e-6
+
+
+def test_percentiles_are_none_before_the_first_value():
+    summary = analytics.SpreadAnalytics('USDZAR', windows=(10,)).summary()['valr_over_ib']
+    assert summary['p50_10'] is None and summary['bps'] is None
@@ -0,0 +1,26 @@
+import numpy as np
+import pytest
+from asof_join import AsofJoiner, asof_join
+
+
+@pytest.mark.parametrize('policy', ['flag', 'drop'])
+def test_vectorised_join_matches_streaming_updates(policy):
+    rng = np.random.default_rng(7)
+    # Rounded times so the venues quote at the same instant now and then
+    ib_time = np.sort(np.round(rng.uniform(0, 100, 300), 1))
+    valr_time = np.sort(np.round(rng.uniform(0, 100, 200), 1))
+    ib_bid, valr_bid = rng.uniform(18, 19, 300), rng.uniform(18, 19, 200)
+    ib_ask, valr_ask = ib_bid + 0.01, valr_bid + 0.02
+
+    joiner = AsofJoiner(max_skew=1.0, policy=policy)
+    # IB first on equal times, then in arrival order
+    quotes = sorted([(t, 0, k, 'ib', ib_bid[k], ib_ask[k]) for k, t in enumerate(ib_time)] +
+                    [(t, 1, k, 'valr', valr_bid[k], valr_ask[k]) for k, t in enumerate(valr_time)])
+    streamed = [row for row in (joiner.update(venue, t, bid, ask) for t, _, _, venue, bid, ask in quotes) if row]
+
+    joined = asof_join(ib_time, ib_bid, ib_ask, valr_time, valr_bid, valr_ask, max_skew=1.0, policy=policy)
+    assert len(joined['time']) == len(streamed) > 0
+    for k, row in enumerate(streamed):
+        assert joined['source'][k] == row['source']
+        for field in ('ib_bid', 'ib_ask', 'valr_bid', 'valr_ask', 'ib_time', 'valr_time', 'quote_skew', 'stale'):
+            assert joined[field][k] == row[field], field
@@ -0,0 +1,36 @@
+import asyncio
+from datetime import datetime, timezone
+from db_writer import BatchWriter
+
+
+def test_partly_acknowledged_batches_are_retried():
+    calls = []
+
+    def write_batch(batch, retry=False):
+        calls.append(retry)
+        return len(batch) if retry else len(batch) - 2
+
+    async def run():
+        writer = BatchWriter(write_batch, max_batch=10, max_delay=0.01)
+        writer.start()
+        for _ in range(10):
+            writer.submit({'timestamp': datetime.now(timezone.utc)})
+        await writer.stop()  # After the one-second backoff
+        return writer
+
+    writer = asyncio.run(run())
+    assert calls == [False, True]
+    assert (writer.written, writer.failed) == (10, 0)
+
+
+def test_stop_returns_within_the_timeout_when_the_queue_is_full():
+    async def run():
+        writer = BatchWriter(lambda batch, retry=False: len(batch), max_queue=2)
+        writer.start()
+        writer._task.cancel()  # A flush task that never takes anything off the queue
+        writer._task = asyncio.ensure_future(asyncio.sleep(3600))
+        writer.submit({'i': 1})
+        writer.submit({'i': 2})
+        await asyncio.wait_for(writer.stop(timeout=0.1), 1)
+
+    asyncio.run(run())
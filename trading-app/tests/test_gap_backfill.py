@@ -0,0 +1,104 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+import pytest
+from ib_insync import Contract, HistoricalTickBidAsk, TickAttribBidAsk
+from gap_backfill import BACKFILL_SOURCE, TICKS_PER_REQUEST, Gap, GapBackfiller
+
+START = datetime(2024, 5, 6, 8, 0, tzinfo=timezone.utc)
+
+
+class NoPacer:
+    waited = 0.0
+
+    async def acquire(self, weight: int = 1) -> None:
+        pass
+
+
+class StubIB:
+    """Serves BID_ASK history like IB: second-resolution times, pages starting at startDateTime"""
+
+    def __init__(self, ticks):
+        self.ticks = ticks
+        self.requests = []
+
+    async def reqHistoricalTicksAsync(self, contract, startDateTime, endDateTime, numberOfTicks, whatToShow,
+                                      useRth, ignoreSize=False, miscOptions=[]):
+        self.requests.append((startDateTime, whatToShow))
+        return [tick for tick in self.ticks if tick.time >= startDateTime][:numberOfTicks]
+
+    async def reqHistoricalDataAsync(self, contract, endDateTime, durationStr, barSizeSetting, whatToShow,
+                                     useRTH, formatDate=1):
+        self.requests.append((endDateTime, whatToShow))
+        seconds = int(durationStr.split()[0])
+        return [SimpleNamespace(date=endDateTime - timedelta(minutes=m), open=18.5 + m / 1000, close=18.51 + m / 1000)
+                for m in range(seconds // 60, -1, -1)]
+
+
+def _history(seconds: int, per_second: int = 3):
+    return [HistoricalTickBidAsk(START + timedelta(seconds=s), TickAttribBidAsk(),
+                                 18.5 + (s * per_second + n) / 1e5, 18.6 + (s * per_second + n) / 1e5, 1e6, 1e6)
+            for s in range(seconds) for n in range(per_second)]
+
+
+def _run(backfiller, gaps):
+    written = []
+    backfiller.write = lambda rows: written.extend(rows) or len(rows)
+    summary = asyncio.run(backfiller.run(gaps))
+    return summary, written
+
+
+def test_ticks_are_paged_without_duplicates_and_fill_only_the_gap():
+    history = _history(1200)
+    ib = StubIB(history)
+    gap = Gap(START + timedelta(seconds=100), START + timedelta(seconds=1000))
+    summary, rows = _run(GapBackfiller(ib, Contract(), pacer=NoPacer()), [gap])
+
+    expected = [t for t in history if gap.start < t.time < gap.end]
+    assert summary['rows'] == len(rows) == len(expected)
+    assert summary['requests'] == len(ib.requests) > 1
+    assert len(expected) > TICKS_PER_REQUEST
+    assert [(r['timestamp'], r['ib_bid'], r['ib_ask']) for r in rows] == \
+        [(t.time, t.priceBid, t.priceAsk) for t in expected]
+    assert all(r['source'] == BACKFILL_SOURCE and r['valr_bid'] is None and r['valr_ask'] is None for r in rows)
+    assert all(what == 'BID_ASK' for _, what in ib.requests)
+
+
+def test_gap_without_history_writes_nothing():
+    summary, rows = _run(GapBackfiller(StubIB([]), Contract(), pacer=NoPacer()),
+                         [Gap(START, START + timedelta(minutes=5))])
+    assert summary['rows'] == 0 and rows == []
+    assert summary['failed_gaps'] == 0
+
+
+def test_bars_become_one_row_per_bar_inside_the_gap():
+    gap = Gap(START, START + timedelta(minutes=10))
+    summary, rows = _run(GapBackfiller(StubIB([]), Contract(), method='bars', pacer=NoPacer()), [gap])
+
+    assert [r['timestamp'] for r in rows] == [START + timedelta(minutes=m) for m in range(1, 10)]
+    assert (rows[0]['ib_bid'], rows[0]['ib_ask']) == pytest.approx((18.509, 18.519))
+    assert summary['requests'] == 1
+
+
+def test_find_gaps_matches_a_scan_of_every_row():
+    mongomock = pytest.importorskip('mongomock')
+    from bson import ObjectId
+    import bucket_store
+    from gap_backfill import find_gaps
+    db = mongomock.MongoClient().db
+    stamps, t = [], START.replace(tzinfo=None)
+    for i in range(5000):
+        # Mostly 0.4s apart, with holes shorter and longer than a minute bucket
+        seconds = 61 + i % 300 if i % 700 == 0 else 20 + i % 13 if i % 97 == 0 else 0.4
+        t += timedelta(seconds=seconds, milliseconds=i % 7)
+        stamps.append(t)
+    db.usdzar.insert_many([{'timestamp': ts} for ts in stamps])
+
+    db.usdzar_buckets.bulk_write(bucket_store.bucket_updates(
+        [{'_id': ObjectId(), 'timestamp': ts} for ts in stamps]))
+
+    for mode in ('documents', 'buckets'):
+        for min_gap in (0.5, 15, 45, 60, 120):
+            expected = [(a, b) for a, b in zip(stamps, stamps[1:]) if (b - a).total_seconds() > min_gap]
+            gaps = find_gaps(db, min_gap, mode=mode, skip_attempted=False)
+            assert [(g.start.replace(tzinfo=None), g.end.replace(tzinfo=None)) for g in gaps] == expected, (mode, min_gap)
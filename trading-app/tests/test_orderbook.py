@@ -0,0 +1,20 @@
+from orderbook import OrderBook
+
+
+def test_levels_are_not_overwritten_by_later_updates():
+    book = OrderBook('USDTZAR')
+    assert book.apply_levels(['18.50', '18.49'], ['100', '200'], ['18.52', '18.53'], ['50', '75'])
+    prices, quantities = book.levels('bid')
+
+    assert book.apply_levels(['18.51'], ['10'], ['18.52', '18.53'], ['50', '75'])
+    assert list(prices) == [18.50, 18.49] and list(quantities) == [100, 200]
+    assert list(book.levels('bid')[0]) == [18.51]
+
+
+def test_vwap_and_depth_follow_the_current_levels():
+    book = OrderBook('USDTZAR')
+    book.apply_levels(['18.50', '18.40'], ['100', '100'], ['18.60', '18.70'], ['100', '100'])
+    assert book.vwap('bid', quantity=150) == (18.50 * 100 + 18.40 * 50) / 150
+    assert book.depth('ask', price_limit=18.65) == 100
+    assert not book.apply_levels(['18.50', '18.40'], ['100', '100'], ['18.60', '18.70'], ['100', '100'])
+    assert book.changed_levels == 0
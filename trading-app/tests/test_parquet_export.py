@@ -0,0 +1,28 @@
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+import pytest
+import parquet_export
+import usdzar_db
+
+
+def test_export_accepts_an_aware_start(monkeypatch, tmp_path):
+    mongomock = pytest.importorskip('mongomock')
+    db = mongomock.MongoClient().db
+
+    @contextmanager
+    def connection():
+        yield db
+
+    monkeypatch.setattr(usdzar_db, 'db_connection', connection)
+    monkeypatch.setattr(parquet_export, 'db_connection', connection)
+    monkeypatch.setattr(usdzar_db, 'STORAGE_MODE', 'documents')
+    start = datetime.utcnow().replace(microsecond=0) - timedelta(hours=2)
+    db.usdzar.insert_many([{'timestamp': start + timedelta(seconds=s), 'ib_bid': 18.5, 'ib_ask': 18.6,
+                            'valr_bid': 18.4, 'valr_ask': 18.7, 'source': 'ib'} for s in range(60)])
+
+    # A --from given with an offset, compared with the default (naive) until
+    rows = parquet_export.export(root=str(tmp_path), start=start.replace(tzinfo=timezone.utc).astimezone(
+        timezone(timedelta(hours=2))), workers=1)
+
+    assert rows == 60
+    assert len(parquet_export.read_range(start, start + timedelta(minutes=1), root=str(tmp_path))) == 60
@@ -0,0 +1,117 @@
+import asyncio
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+import numpy as np
+import pytest
+import rollups
+
+START = datetime(2024, 5, 6, 8, 0, tzinfo=timezone.utc)
+
+
+class FlakyDB:
+    """A MongoDB whose bulk writes to the named collections fail once"""
+
+    def __init__(self, db, failing):
+        self.db = db
+        self.failing = set(failing)
+
+    def __getitem__(self, name):
+        collection = self.db[name]
+        if name not in self.failing:
+            return collection
+        failing = self.failing
+
+        class Flaky:
+            def create_index(self, *args, **kwargs):
+                return collection.create_index(*args, **kwargs)
+
+            def bulk_write(self, requests, **kwargs):
+                failing.discard(name)
+                raise ConnectionError(f"{name} unavailable")
+        return Flaky()
+
+
+def _tick(seconds, ib_bid=18.5):
+    return {'timestamp': START + timedelta(seconds=seconds), 'instrument': 'USDZAR',
+            'ib_bid': ib_bid, 'ib_ask': ib_bid + 0.1, 'valr_bid': 18.4, 'valr_ask': 18.7}
+
+
+def test_partial_flush_failure_does_not_count_committed_bars_twice(monkeypatch):
+    mongomock = pytest.importorskip('mongomock')
+    db = FlakyDB(mongomock.MongoClient().db, ['usdzar_bars_1h'])
+
+    @contextmanager
+    def connection():
+        yield db
+
+    monkeypatch.setattr(rollups, 'db_connection', connection)
+    monkeypatch.setattr(rollups, '_indexed', set())
+    builder = rollups.RollupBuilder({'USDZAR': 'usdzar'}, ['1m', '1h'])
+
+    for s in range(10):
+        builder.on_tick(_tick(s))
+    asyncio.run(builder.flush())
+    assert builder.failed_flushes == 1
+    assert builder.stats()['pending_bars'] == 1  # Only the 1h bar is retried
+
+    for s in range(10, 15):
+        builder.on_tick(_tick(s, 18.4))
+    asyncio.run(builder.flush())
+    assert builder.stats()['pending_bars'] == 0
+
+    for resolution in ('1m', '1h'):
+        bar = db.db[f'usdzar_bars_{resolution}'].find_one()
+        assert bar['count'] == 15
+        assert bar['ib_bid_o'] == 18.5
+        assert bar['ib_bid_c'] == 18.4
+        assert bar['ib_bid_l'] == 18.4
+
+
+def test_spread_means_leave_out_rows_without_a_valr_quote():
+    timestamps = np.array([START.replace(tzinfo=None) + timedelta(seconds=s) for s in range(4)], dtype='datetime64[us]')
+    nan = float('nan')
+    columns = {'timestamp': timestamps,
+               'ib_bid': np.array([18.5, 18.5, 18.5, 18.5]), 'ib_ask': np.array([18.6, 18.6, 18.6, 18.6]),
+               # Rows 1 and 2 were backfilled from IB history, which has no VALR side
+               'valr_bid': np.array([18.8, nan, nan, 18.8]), 'valr_ask': np.array([18.9, nan, nan, 18.9])}
+    [bar] = rollups.bars_from_columns(columns, 60)
+
+    rows = [{name: columns[name][row] for name in ('ib_bid', 'ib_ask', 'valr_bid', 'valr_ask')} for row in range(4)]
+    live = rollups.Bar(bar.start, 0, rollups._series_values(rows[0]), rollups._spread_values(rows[0]))
+    for ts, row in enumerate(rows[1:], 1):
+        live.add(ts, rollups._series_values(row), rollups._spread_values(row))
+
+    for built in (bar, live):
+        doc = built.to_doc()
+        assert doc['count'] == 4 and doc['valr_over_ib_count'] == 2
+        assert doc['valr_over_ib_sum'] / doc['valr_over_ib_count'] == pytest.approx(18.8 - 18.6)
+
+
+def test_backfill_rebuilds_whole_bars_around_an_unaligned_range(monkeypatch):
+    mongomock = pytest.importorskip('mongomock')
+    db = mongomock.MongoClient().db
+
+    @contextmanager
+    def connection():
+        yield db
+
+    monkeypatch.setattr(rollups, 'db_connection', connection)
+    monkeypatch.setattr(rollups.usdzar_db, 'db_connection', connection)
+    monkeypatch.setattr(rollups.usdzar_db, 'STORAGE_MODE', 'documents')
+    monkeypatch.setattr(rollups, '_indexed', set())
+    db.usdzar.insert_many([dict(_tick(s), timestamp=(START + timedelta(seconds=s)).replace(tzinfo=None))
+                           for s in range(600)])
+
+    written = rollups.backfill(START + timedelta(minutes=5, seconds=30), START + timedelta(minutes=5, seconds=40),
+                               ['1m', '5m'])
+
+    assert written == {'1m': 5, '5m': 1}  # The whole 5m bar starting at 08:05
+    bar = db.usdzar_bars_1m.find_one({'bar_start': START.replace(tzinfo=None) + timedelta(minutes=5)})
+    assert bar['count'] == 60
+    assert db.usdzar_bars_5m.find_one()['count'] == 300
+
+
+def test_backfill_leaves_bars_the_collector_is_updating(monkeypatch):
+    monkeypatch.setattr(rollups.usdzar_db, 'iter_price_data_range', lambda *args, **kwargs: pytest.fail("read ticks"))
+    now = datetime.now(timezone.utc)
+    assert rollups.backfill(now - timedelta(seconds=30), now, ['1h']) == {'1h': 0}
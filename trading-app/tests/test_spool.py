@@ -0,0 +1,144 @@
+import asyncio
+import os
+from datetime import datetime
+from zoneinfo import ZoneInfo
+from spool import TickSpool
+from tick_capture import SOURCE_CODES, SOURCES
+
+SA_TZ = ZoneInfo("Africa/Johannesburg")
+
+
+def _tick(**fields):
+    tick = {
+        'timestamp': datetime(2024, 5, 6, 10, 0, 0, 250000, tzinfo=SA_TZ),
+        'ib_bid': 18.51, 'ib_ask': 18.52, 'valr_bid': 18.49, 'valr_ask': 18.55,
+        'source': 'ib', 'instrument': 'USDZAR',
+        'ib_recv_time': None, 'valr_recv_time': None, 'valr_event_time': None,
+        'ib_recv_mono': 100.0, 'valr_recv_mono': 100.5,
+        'stale': False, 'ib_mode': 'tick_by_tick',
+    }
+    tick.update(fields)
+    return tick
+
+
+def test_round_trip_keeps_tick_fields(tmp_path):
+    spool = TickSpool(str(tmp_path), write_batch=len, segment_records=16)
+    spool.submit(_tick())
+    spool.submit(_tick(ib_mode='mktdata', stale=True, source='valr'))
+
+    first, second = spool._next_batch()
+    assert first['timestamp'] == _tick()['timestamp']
+    assert (first['ib_bid'], first['ib_ask'], first['valr_bid'], first['valr_ask']) == (18.51, 18.52, 18.49, 18.55)
+    assert first['instrument'] == 'USDZAR'
+    assert first['source'] == 'ib'
+    assert first['ib_mode'] == 'tick_by_tick'
+    assert first['stale'] is False
+    assert first['quote_skew'] == 0.5
+    assert second['ib_mode'] == 'mktdata'
+    assert second['stale'] is True
+    assert second['source'] == 'valr'
+
+
+def test_reopened_spool_decodes_the_same_records(tmp_path):
+    spool = TickSpool(str(tmp_path), write_batch=len, segment_records=16)
+    spool.submit(_tick())
+    for segment in spool._segments.values():
+        segment.close()
+
+    reopened = TickSpool(str(tmp_path), write_batch=len, segment_records=16)
+    [doc] = reopened._next_batch()
+    assert doc['ib_mode'] == 'tick_by_tick'
+
+
+def test_sources_keep_the_codes_stored_in_existing_segments(tmp_path):
+    # Segments written before the source table was shared with tick_pubsub used these codes
+    assert (SOURCE_CODES['sample'], SOURCE_CODES['ib'], SOURCE_CODES['valr']) == (0, 1, 2)
+    spool = TickSpool(str(tmp_path), write_batch=len, segment_records=16)
+    for source in SOURCES:
+        spool.submit(_tick(source=source))
+    assert tuple(doc['source'] for doc in spool._next_batch()) == SOURCES
+
+
+def test_rotation_switches_to_the_segment_allocated_while_replay_is_stuck(tmp_path):
+    def write_batch(batch, retry=False):
+        raise ConnectionError("MongoDB unavailable")
+
+    # No replay task at all: allocation must not depend on replay progress
+    spool = TickSpool(str(tmp_path), write_batch=write_batch, segment_records=8, instruments=['USDZAR'])
+    for _ in range(4):
+        spool.submit(_tick())
+    prepared = spool._next.result(timeout=5)  # Started by the submit that half filled the segment
+    assert os.path.exists(prepared.path)
+
+    original = spool._create_segment
+    spool._create_segment = None  # Rotation must not allocate a segment itself
+    for _ in range(6):
+        assert spool.submit(_tick())
+    spool._create_segment = original
+    assert spool._active is prepared
+    assert spool.pending() == 10 and spool.dropped == 0
+    for segment in spool._segments.values():
+        segment.close()
+
+
+def test_failed_allocation_leaves_no_file_and_is_retried(tmp_path, monkeypatch):
+    spool = TickSpool(str(tmp_path), write_batch=len, segment_records=4)
+    real_fallocate = os.posix_fallocate
+
+    def disk_full(fd, offset, length):
+        raise OSError(28, 'No space left on device')
+    monkeypatch.setattr(os, 'posix_fallocate', disk_full)
+    for _ in range(4):
+        assert spool.submit(_tick())
+    assert not spool.submit(_tick())  # Nowhere to rotate to: dropped, not blocking
+    assert os.listdir(tmp_path).count('spool-00000002.seg') == 0
+
+    monkeypatch.setattr(os, 'posix_fallocate', real_fallocate)
+    spool._allocate_after = 0
+    assert spool.submit(_tick())
+    assert spool._active.seq == 2 and spool.dropped == 1
+
+
+def test_only_the_first_batch_after_a_restart_and_retries_are_marked(tmp_path):
+    calls = []
+
+    def write_batch(batch, retry=False):
+        calls.append(retry)
+        return len(batch) - 1 if len(calls) == 2 else len(batch)  # The second write is partly rejected
+
+    async def run():
+        spool = TickSpool(str(tmp_path), write_batch=write_batch, segment_records=64, replay_batch=4)
+        spool.start()
+        for _ in range(12):
+            spool.submit(_tick())
+        await asyncio.sleep(1.5)  # Includes the one-second backoff after the rejected write
+        await spool.stop()
+
+    asyncio.run(run())
+    assert calls == [True, False, True, False]
+
+
+def test_records_mongodb_keeps_rejecting_go_to_the_dead_letter_file(tmp_path):
+    stored = []
+
+    def write_batch(batch, retry=False):
+        accepted = [doc for doc in batch if doc['ib_bid'] is not None]  # A record the store refuses
+        stored.extend(accepted)
+        return len(accepted)
+
+    async def run():
+        spool = TickSpool(str(tmp_path), write_batch=write_batch, segment_records=64, replay_batch=4,
+                          max_rejections=2)
+        spool.start()
+        for i in range(8):
+            spool.submit(_tick(ib_bid=None if i == 1 else 18.51))
+        await asyncio.sleep(3.5)  # Two rejections, a one- and a two-second backoff, then the batch is isolated
+        await spool.stop()
+        return spool
+
+    spool = asyncio.run(run())
+    assert spool.dead_lettered == 1 and spool.pending() == 0
+    with open(tmp_path / 'dead-letter.jsonl') as f:
+        [line] = f.readlines()
+    assert '"ib_bid": null' in line
+    assert len({doc['_id'] for doc in stored}) == 7
@@ -0,0 +1,35 @@
+from datetime import datetime, timezone
+from types import SimpleNamespace
+from tick_capture import TickCapture
+
+
+def _bid_ask(bid, ask):
+    return SimpleNamespace(time=datetime.now(timezone.utc), bidPrice=bid, askPrice=ask, bidSize=1e6, askSize=1e6)
+
+
+def _capture():
+    ticks = []
+    capture = TickCapture(on_tick=ticks.append)
+    capture.on_valr_price(18.40, 18.60)
+    return capture, ticks
+
+
+def test_every_tick_by_tick_quote_in_an_update_is_captured():
+    capture, ticks = _capture()
+    entries = [_bid_ask(18.50, 18.52), _bid_ask(18.51, 18.52), _bid_ask(18.51, 18.53)]
+    ticker = SimpleNamespace(bid=18.51, ask=18.53, tickByTicks=entries)
+
+    capture.on_ib_ticker(ticker, 'tick_by_tick')
+
+    assert [(t['ib_bid'], t['ib_ask']) for t in ticks] == [(18.50, 18.52), (18.51, 18.52), (18.51, 18.53)]
+    assert {t['ib_mode'] for t in ticks} == {'tick_by_tick'}
+    assert ticks[0]['ib_recv_time'] == entries[0].time
+
+
+def test_mode_comes_from_the_subscription_not_the_update():
+    capture, ticks = _capture()
+    # A ticker handed over outside an update cycle has no tickByTicks entries
+    capture.on_ib_ticker(SimpleNamespace(bid=18.50, ask=18.52, tickByTicks=[]), 'tick_by_tick')
+    capture.on_ib_ticker(SimpleNamespace(bid=18.49, ask=18.52, tickByTicks=[]))
+
+    assert [(t['ib_bid'], t['ib_mode']) for t in ticks] == [(18.50, 'tick_by_tick'), (18.49, 'mktdata')]
@@ -0,0 +1,12 @@
+from datetime import datetime, timezone
+from tick_capture import SOURCES
+from tick_pubsub import decode_tick, encode_tick
+
+
+def test_frames_keep_the_tick_source():
+    for seq, source in enumerate(SOURCES + ('unknown',)):
+        tick = {'timestamp': datetime(2024, 5, 6, 8, 0, tzinfo=timezone.utc), 'instrument': 'USDZAR',
+                'ib_bid': 18.5, 'ib_ask': 18.6, 'valr_bid': 18.4, 'valr_ask': 18.7, 'source': source}
+        decoded = decode_tick(encode_tick(seq, tick))
+        assert decoded['seq'] == seq
+        assert decoded['source'] == (source if source in SOURCES else None)
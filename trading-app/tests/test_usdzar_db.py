@@ -0,0 +1,103 @@
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+import pytest
+from bson import ObjectId
+import tick_store
+import usdzar_db
+
+START = datetime(2024, 5, 6, 8, 0, tzinfo=timezone.utc)
+
+
+@pytest.fixture
+def stores(monkeypatch):
+    """A ring and a MongoDB holding the same ticks, one per second for ten minutes, plus backfilled rows"""
+    mongomock = pytest.importorskip('mongomock')
+    db = mongomock.MongoClient().db
+    reads = []
+
+    @contextmanager
+    def connection():
+        reads.append(1)
+        yield db
+
+    monkeypatch.setattr(usdzar_db, 'db_connection', connection)
+    monkeypatch.setattr(usdzar_db, 'STORAGE_MODE', 'documents')
+    monkeypatch.setattr(tick_store, '_rings', {})
+    ring = tick_store.register_ring('usdzar', 10000)
+    rows = []
+    for s in range(600):
+        if 200 <= s < 400:
+            continue  # An outage: only backfilled rows below
+        tick = {'timestamp': START + timedelta(seconds=s), 'ib_bid': 18.5, 'ib_ask': 18.6,
+                'valr_bid': 18.4, 'valr_ask': 18.7, 'source': 'ib'}
+        ring.append_doc(tick)
+        rows.append(dict(tick, timestamp=tick['timestamp'].replace(tzinfo=None)))
+    rows += [{'timestamp': (START + timedelta(seconds=s)).replace(tzinfo=None), 'ib_bid': 18.55, 'ib_ask': 18.65,
+              'valr_bid': None, 'valr_ask': None, 'source': 'backfill'} for s in range(210, 390, 10)]
+    db.usdzar.insert_many(rows)
+    return reads
+
+
+def test_ring_serves_price_fields_in_a_window_without_holes(stores):
+    rows = usdzar_db.get_price_data_range(START, START + timedelta(seconds=100), ['timestamp', 'ib_bid'])
+    assert len(rows) == 101 and set(rows[0]) == {'timestamp', 'ib_bid'}
+    assert stores == []
+
+
+def test_full_documents_come_from_mongodb(stores):
+    rows = usdzar_db.get_price_data_range(START, START + timedelta(seconds=100))
+    assert len(rows) == 101 and rows[0]['source'] == 'ib' and '_id' in rows[0]
+    latest = usdzar_db.get_latest_usdzar_price()
+    assert latest['source'] == 'ib' and '_id' in latest
+    assert len(stores) == 2
+
+
+def test_window_with_a_hole_includes_backfilled_rows(stores):
+    rows = usdzar_db.get_price_data_range(START + timedelta(seconds=150), START + timedelta(seconds=450),
+                                          ['timestamp', 'ib_bid'])
+    assert len(rows) == 50 + 18 + 51
+    assert stores == [1]
+
+
+def test_latest_price_fields_come_from_the_ring(stores):
+    latest = usdzar_db.get_latest_usdzar_price(fields=['timestamp', 'valr_ask'])
+    assert set(latest) == {'timestamp', 'valr_ask'}
+    assert latest['timestamp'] == START + timedelta(seconds=599)
+    assert stores == []
+
+
+def test_ring_timestamps_match_mongodb_precision(monkeypatch):
+    monkeypatch.setattr(tick_store, '_rings', {})
+    ring = tick_store.register_ring('usdzar', 10)
+    ts = START + timedelta(minutes=20, microseconds=123999)
+    ring.append_doc({'timestamp': ts, 'ib_bid': 18.5, 'ib_ask': 18.6, 'valr_bid': 18.4, 'valr_ask': 18.7})
+
+    [doc] = tick_store.to_docs(ring.view(), ['timestamp'])
+    assert doc['timestamp'] == ts.replace(microsecond=123000, tzinfo=None)
+
+
+@pytest.mark.parametrize('mode', ['buckets', 'timeseries', 'documents'])
+def test_retried_batches_are_stored_once(stores, monkeypatch, mode):
+    monkeypatch.setattr(usdzar_db, '_ready_collections', {'usdzar_ts'})  # mongomock has no time-series collections
+    docs = [{'timestamp': START + timedelta(hours=1, seconds=s / 2), 'ib_bid': 18.5, 'ib_ask': 18.6,
+             'valr_bid': 18.4, 'valr_ask': 18.7, 'source': 'ib'} for s in range(300)]
+    assert usdzar_db.insert_usdzar_batch(docs[:200], mode=mode) == 200
+    # The first write landed but was not acknowledged: the writer retries it, now with more rows
+    assert usdzar_db.insert_usdzar_batch(docs, mode=mode, retry=True) == 300
+    assert usdzar_db.insert_usdzar_batch(docs, mode=mode, retry=True) == 300
+
+    monkeypatch.setattr(usdzar_db, 'STORAGE_MODE', mode)
+    rows = usdzar_db.get_price_data_range(START + timedelta(hours=1), START + timedelta(hours=2))
+    assert len(rows) == 300
+
+
+def test_first_attempts_do_not_look_up_stored_ids(stores, monkeypatch):
+    lookups = []
+    monkeypatch.setattr(usdzar_db, '_stored_ids', lambda *args: lookups.append(args) or set())
+    # Spool replay and migrations pass documents that already carry an _id
+    docs = [{'_id': ObjectId(), 'timestamp': START + timedelta(hours=1, seconds=s), 'ib_bid': 18.5, 'ib_ask': 18.6,
+             'valr_bid': 18.4, 'valr_ask': 18.7, 'source': 'ib'} for s in range(10)]
+    assert usdzar_db.insert_usdzar_batch(docs, mode='buckets') == 10
+    assert lookups == []
+    assert usdzar_db.insert_usdzar_batch(docs, mode='buckets', retry=True) == 10
+    assert len(lookups) == 1
@@ -0,0 +1,187 @@
+import asyncio
+import logging
+import time
+from datetime import datetime, timezone
+from zoneinfo import ZoneInfo
+from typing import Any, Callable, Dict, List, Optional
+from asof_join import AsofJoiner
+
+logger = logging.getLogger(__name__)
+
+SA_TZ = ZoneInfo("Africa/Johannesburg")
+MIN_VALID_PRICE = 2
+
+# Where a tick document came from. Spool segments and tick_pubsub frames store the
+# index as the source code, so names are only ever appended.
+SOURCES = ('sample', 'ib', 'valr', 'backfill')
+SOURCE_CODES = {name: code for code, name in enumerate(SOURCES)}
+
+
+def is_valid_price(p) -> bool:
+    """Check that a price is present and not NaN"""
+    return p is not None and not (isinstance(p, float) and (p != p))
+
+
+class TickCapture:
+    """Event-driven capture of top-of-book changes from IB and VALR.
+
+    Every time either venue's best bid or ask changes, the quote is fed
+    through an AsofJoiner and the joined row is emitted as a tick document
+    holding the latest quote from both venues and the time the change was
+    received. One instance is kept per instrument.
+
+    Each tick also carries its provenance: the wall-clock and monotonic
+    time each venue's quote was last received (ib_recv_time / _mono,
+    valr_recv_time / _mono) and VALR's own book change time
+    (valr_event_time). IB market data has no exchange timestamp. ib_mode
+    says how the IB quote was delivered: 'tick_by_tick' (every change) or
+    'mktdata' (IB's throttled, conflated stream).
+    quote_skew is the gap in seconds between the two quotes; beyond
+    `max_skew` the tick is flagged stale or dropped, per `skew_policy`.
+    """
+
+    __slots__ = ('instrument', 'on_tick', 'joiner', 'last_ib_update', 'last_valr_update',
+                 'valr_event_time', 'ib_mode', 'ib_updates', 'valr_updates', 'ticks_emitted',
+                 'invalid_ib_updates')
+
+    def __init__(self, on_tick: Callable[[Dict[str, Any]], None], instrument: str = 'USDZAR',
+                 max_skew: Optional[float] = None, skew_policy: str = 'flag'):
+        self.instrument = instrument
+        self.on_tick = on_tick
+        self.joiner = AsofJoiner(max_skew, skew_policy)
+
+        self.last_ib_update: Optional[datetime] = None
+        self.last_valr_update: Optional[datetime] = None
+        self.valr_event_time: Optional[datetime] = None
+        self.ib_mode: Optional[str] = None
+
+        self.ib_updates = 0
+        self.valr_updates = 0
+        self.ticks_emitted = 0
+        self.invalid_ib_updates = 0
+
+    @property
+    def ib_bid(self) -> Optional[float]:
+        quote = self.joiner.quote('ib')
+        return quote[1] if quote else None
+
+    @property
+    def ib_ask(self) -> Optional[float]:
+        quote = self.joiner.quote('ib')
+        return quote[2] if quote else None
+
+    @property
+    def valr_bid(self) -> Optional[float]:
+        quote = self.joiner.quote('valr')
+        return quote[1] if quote else None
+
+    @property
+    def valr_ask(self) -> Optional[float]:
+        quote = self.joiner.quote('valr')
+        return quote[2] if quote else None
+
+    def on_ib_ticker(self, ticker, mode: str = 'mktdata') -> None:
+        """Handle an ib_insync Ticker.updateEvent from a subscription in `mode`"""
+        self.ib_mode = mode
+        if mode == 'tick_by_tick' and ticker.tickByTicks:
+            # One update can carry several BidAsk ticks read in the same batch: capture each change
+            recv_mono = time.monotonic()
+            for entry in ticker.tickByTicks:
+                if hasattr(entry, 'bidPrice'):
+                    recv_time = entry.time.astimezone(SA_TZ) if entry.time else datetime.now(SA_TZ)
+                    self._on_ib_quote(entry.bidPrice, entry.askPrice, recv_time, recv_mono)
+        else:
+            self._on_ib_quote(ticker.bid, ticker.ask, datetime.now(SA_TZ), time.monotonic())
+
+    def _on_ib_quote(self, bid: Optional[float], ask: Optional[float], recv_time: datetime, recv_mono: float) -> None:
+        if bid is None or ask is None:
+            return
+        bid = abs(bid)  # IB reports some quotes as negative
+        ask = abs(ask)
+        if not (is_valid_price(bid) and is_valid_price(ask)) or bid < MIN_VALID_PRICE or ask < MIN_VALID_PRICE:
+            self.invalid_ib_updates += 1
+            return
+        self._on_quote('ib', bid, ask, recv_time, recv_mono)
+
+    def on_valr_price(self, bid: float, ask: float, recv_time: Optional[datetime] = None,
+                      recv_mono: Optional[float] = None, event_time: Optional[float] = None) -> None:
+        """Handle a VALR top-of-book update (event_time: VALR's epoch-seconds change time)"""
+        if not (is_valid_price(bid) and is_valid_price(ask)):
+            return
+        if event_time is not None:
+            self.valr_event_time = datetime.fromtimestamp(event_time, timezone.utc)
+        self._on_quote('valr', bid, ask, recv_time or datetime.now(SA_TZ), recv_mono or time.monotonic())
+
+    def _on_quote(self, venue: str, bid: float, ask: float, recv_time: datetime, recv_mono: float) -> None:
+        if venue == 'ib':
+            self.last_ib_update = recv_time
+        else:
+            self.last_valr_update = recv_time
+        quote = self.joiner.quote(venue)
+        if quote is not None and bid == quote[1] and ask == quote[2]:
+            self.joiner.touch(venue, recv_mono)
+            return
+        if venue == 'ib':
+            self.ib_updates += 1
+        else:
+            self.valr_updates += 1
+        row = self.joiner.update(venue, recv_mono, bid, ask)
+        if row is None:
+            return  # Waiting for the other venue, or dropped for skew
+        self._emit(self._tick(row, recv_time))
+
+    def _tick(self, row: Dict[str, Any], timestamp: datetime) -> Dict[str, Any]:
+        return {
+            'timestamp': timestamp,
+            'ib_bid': row['ib_bid'],
+            'ib_ask': row['ib_ask'],
+            'valr_bid': row['valr_bid'],
+            'valr_ask': row['valr_ask'],
+            'source': row['source'],
+            'instrument': self.instrument,
+            'ib_recv_time': self.last_ib_update,
+            'valr_recv_time': self.last_valr_update,
+            'ib_recv_mono': row['ib_time'],
+            'valr_recv_mono': row['valr_time'],
+            'valr_event_time': self.valr_event_time,
+            'ib_mode': self.ib_mode,
+            'quote_skew': row['quote_skew'],
+            'stale': row['stale']
+        }
+
+    def snapshot(self, source: str = 'sample') -> Optional[Dict[str, Any]]:
+        """Return the latest quotes from both venues, or None if incomplete or dropped for skew"""
+        row = self.joiner.join(source)
+        if row is None:
+            return None
+        return self._tick(row, datetime.now(SA_TZ))
+
+    def _emit(self, tick: Dict[str, Any]) -> None:
+        self.ticks_emitted += 1
+        try:
+            self.on_tick(tick)
+        except Exception as e:
+            logger.error(f"Error handling tick: {str(e)}")
+
+
+class Downsampler:
+    """Fixed-interval sampler over the latest captured quotes.
+
+    Reproduces the original polling behaviour (one row per instrument every
+    `interval` seconds) on top of the event-driven capture.
+    """
+
+    def __init__(self, captures: List[TickCapture], on_sample: Callable[[Dict[str, Any]], None], interval: float = 15):
+        self.captures = captures
+        self.on_sample = on_sample
+        self.interval = interval
+
+    async def run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            for capture in self.captures:
+                sample = capture.snapshot()
+                if sample is None:
+                    logger.warning(f"Downsampler: {capture.instrument} quotes incomplete or too far apart, skipping sample")
+                    continue
+                self.on_sample(sample)
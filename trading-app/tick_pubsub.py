@@ -0,0 +1,249 @@
+"""Local fan-out of live ticks over a Unix domain socket."""
+import argparse
+import asyncio
+import logging
+import math
+import os
+import struct
+import time
+from datetime import datetime, timezone
+from typing import Any, Dict, Optional
+from tick_capture import SOURCE_CODES, SOURCES
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'TICK'
+VERSION = 2  # 2: source codes from tick_capture.SOURCES
+HELLO = struct.Struct('<4sHHQ')  # magic, version, frame size, session id (new every collector start)
+# sequence (shared by all instruments), timestamp, ib_bid, ib_ask, valr_bid, valr_ask,
+# quote_skew (NaN when missing), source, flags, instrument (ASCII, NUL padded)
+FRAME = struct.Struct('<Q6dBB16s')
+UNKNOWN_SOURCE = 255
+STALE = 0x01
+IB_TICK_BY_TICK = 0x02
+
+_NAN = float('nan')
+
+
+def _float(value) -> float:
+    return _NAN if value is None else value
+
+
+def encode_tick(seq: int, tick: Dict[str, Any]) -> bytes:
+    flags = (STALE if tick.get('stale') else 0) | (IB_TICK_BY_TICK if tick.get('ib_mode') == 'tick_by_tick' else 0)
+    return FRAME.pack(seq, tick['timestamp'].timestamp(),
+                      _float(tick.get('ib_bid')), _float(tick.get('ib_ask')),
+                      _float(tick.get('valr_bid')), _float(tick.get('valr_ask')),
+                      _float(tick.get('quote_skew')),
+                      SOURCE_CODES.get(tick.get('source'), UNKNOWN_SOURCE), flags,
+                      tick.get('instrument', '').encode('ascii', 'replace')[:16])
+
+
+def decode_tick(frame: bytes) -> Dict[str, Any]:
+    """Turn a frame back into a tick document (timestamp as an aware UTC datetime)"""
+    seq, ts, ib_bid, ib_ask, valr_bid, valr_ask, skew, source, flags, instrument = FRAME.unpack(frame)
+    return {
+        'seq': seq,
+        'timestamp': datetime.fromtimestamp(ts, timezone.utc),
+        'instrument': instrument.rstrip(b'\0').decode('ascii'),
+        'ib_bid': ib_bid,
+        'ib_ask': ib_ask,
+        'valr_bid': valr_bid,
+        'valr_ask': valr_ask,
+        'quote_skew': None if math.isnan(skew) else skew,
+        'source': SOURCES[source] if source < len(SOURCES) else None,
+        'stale': bool(flags & STALE),
+        'ib_mode': 'tick_by_tick' if flags & IB_TICK_BY_TICK else 'mktdata',
+    }
+
+
+class _Subscriber:
+    __slots__ = ('transport', 'peer', 'sent', 'dropped', 'over_since')
+
+    def __init__(self, transport: asyncio.WriteTransport, peer: str):
+        self.transport = transport
+        self.peer = peer
+        self.sent = 0
+        self.dropped = 0
+        self.over_since: Optional[float] = None  # when the buffer went over the limit
+
+
+class TickPublisher:
+    """Publishes ticks to every connected subscriber without ever blocking"""
+
+    def __init__(self, path: str, max_buffer: int = 1 << 20, disconnect_after: float = 10.0):
+        self.path = path
+        self.max_buffer = max_buffer
+        self.disconnect_after = disconnect_after
+        self.session = int.from_bytes(os.urandom(8), 'little')
+        self.seq = 0
+        self._subscribers: Dict[int, _Subscriber] = {}
+        self._server: Optional[asyncio.AbstractServer] = None
+
+        self.connects = 0
+        self.disconnects = 0  # Slow subscribers disconnected by the publisher
+        self.dropped = 0
+
+    async def start(self) -> None:
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        if os.path.exists(self.path):
+            os.unlink(self.path)  # Left over from a previous run
+        self._server = await asyncio.start_unix_server(self._serve, path=self.path)
+        os.chmod(self.path, 0o666)  # Subscribers may run as other users or in other containers
+        logger.info(f"Publishing ticks on {self.path}")
+
+    async def stop(self) -> None:
+        if self._server is None:
+            return
+        self._server.close()
+        for subscriber in list(self._subscribers.values()):
+            subscriber.transport.close()
+        await self._server.wait_closed()
+        self._server = None
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        subscriber = _Subscriber(writer.transport, str(writer.get_extra_info('peername') or 'local'))
+        key = id(subscriber)
+        writer.transport.write(HELLO.pack(MAGIC, VERSION, FRAME.size, self.session))
+        self._subscribers[key] = subscriber
+        self.connects += 1
+        logger.info(f"Tick subscriber connected ({len(self._subscribers)} connected)")
+        try:
+            while await reader.read(4096):
+                pass  # Subscribers have nothing to say; wait for them to hang up
+        except ConnectionError:
+            pass
+        finally:
+            self._subscribers.pop(key, None)
+            writer.close()
+            logger.info(f"Tick subscriber disconnected after {subscriber.sent} ticks, "
+                        f"{subscriber.dropped} dropped ({len(self._subscribers)} connected)")
+
+    def publish(self, tick: Dict[str, Any]) -> None:
+        """Send a tick to all subscribers; called from the capture path"""
+        self.seq += 1
+        if not self._subscribers:
+            return
+        frame = encode_tick(self.seq, tick)
+        now = None
+        for subscriber in list(self._subscribers.values()):
+            transport = subscriber.transport
+            if transport.is_closing():
+                continue
+            if transport.get_write_buffer_size() > self.max_buffer:
+                # Falling behind: skip frames (the subscriber sees the sequence gap)
+                subscriber.dropped += 1
+                self.dropped += 1
+                now = now or time.monotonic()
+                if subscriber.over_since is None:
+                    subscriber.over_since = now
+                elif now - subscriber.over_since > self.disconnect_after:
+                    logger.warning(f"Disconnecting tick subscriber {subscriber.peer}: "
+                                   f"behind for {now - subscriber.over_since:.0f}s, {subscriber.dropped} dropped")
+                    self.disconnects += 1
+                    transport.abort()
+                continue
+            subscriber.over_since = None
+            transport.write(frame)
+            subscriber.sent += 1
+
+    @property
+    def subscribers(self) -> int:
+        return len(self._subscribers)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'subscribers': self.subscribers,
+            'published': self.seq,
+            'dropped': self.dropped,
+            'connects': self.connects,
+            'disconnects': self.disconnects,
+        }
+
+
+class TickSubscriber:
+    """Async iterator over the ticks published on a socket.
+
+    Sequence gaps (ticks skipped because this subscriber fell behind) are
+    counted in `missed` / `gaps` and logged. A new session id means the
+    collector restarted, which is not counted as a gap.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.session: Optional[int] = None
+        self.last_seq: Optional[int] = None
+        self.received = 0
+        self.missed = 0
+        self.gaps = 0
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._frame_size = FRAME.size
+
+    async def connect(self) -> None:
+        self._reader, self._writer = await asyncio.open_unix_connection(self.path)
+        magic, version, frame_size, session = HELLO.unpack(await self._reader.readexactly(HELLO.size))
+        if magic != MAGIC or version != VERSION or frame_size != FRAME.size:
+            self.close()
+            raise ValueError(f"Unsupported tick stream (magic {magic!r}, version {version}, frame {frame_size} bytes)")
+        if session != self.session:
+            self.session = session
+            self.last_seq = None
+
+    def close(self) -> None:
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> Dict[str, Any]:
+        if self._reader is None:
+            await self.connect()
+        try:
+            frame = await self._reader.readexactly(self._frame_size)
+        except asyncio.IncompleteReadError:
+            self.close()
+            raise StopAsyncIteration
+        tick = decode_tick(frame)
+        seq = tick['seq']
+        if self.last_seq is not None and seq > self.last_seq + 1:
+            self.missed += seq - self.last_seq - 1
+            self.gaps += 1
+            logger.warning(f"Missed {seq - self.last_seq - 1} ticks ({self.last_seq + 1}..{seq - 1})")
+        self.last_seq = seq
+        self.received += 1
+        return tick
+
+
+async def _print_ticks(path: str, quiet: bool) -> None:
+    subscriber = TickSubscriber(path)
+    started = time.monotonic()
+    try:
+        async for tick in subscriber:
+            if not quiet:
+                print(f"{tick['seq']} {tick['timestamp'].isoformat()} {tick['instrument']} {tick['source']} "
+                      f"IB {tick['ib_bid']:.5f}/{tick['ib_ask']:.5f} ({tick['ib_mode']}) "
+                      f"VALR {tick['valr_bid']:.2f}/{tick['valr_ask']:.2f}{' stale' if tick['stale'] else ''}")
+    finally:
+        elapsed = time.monotonic() - started
+        print(f"{subscriber.received} ticks in {elapsed:.1f}s, {subscriber.missed} missed in {subscriber.gaps} gap(s)")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Print the ticks the collector publishes")
+    parser.add_argument('--socket', default=os.environ.get('TICK_SOCKET', 'run/ticks.sock'))
+    parser.add_argument('--quiet', action='store_true', help="Only report counts and gaps at the end")
+    args = parser.parse_args()
+    try:
+        asyncio.run(_print_ticks(args.socket, args.quiet))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,136 @@
+import logging
+from datetime import datetime, timezone
+from typing import Dict, Optional
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+TICK_DTYPE = np.dtype([
+    ('ts', 'f8'),  # epoch seconds (UTC)
+    ('ib_bid', 'f8'),
+    ('ib_ask', 'f8'),
+    ('valr_bid', 'f8'),
+    ('valr_ask', 'f8'),
+])
+PRICE_FIELDS = TICK_DTYPE.names[1:]
+RING_FIELDS = ('timestamp',) + PRICE_FIELDS  # document fields a ring can return
+
+
+class TickRing:
+    """Fixed-capacity in-memory tick buffer for one instrument.
+
+    Backed by a numpy structured array of twice the capacity: every tick is
+    written both at its ring position and one capacity further on, so the
+    most recent `capacity` ticks are always one contiguous slice. Range
+    queries therefore binary-search the timestamp column and return a view
+    into the buffer without copying.
+
+    Ticks are expected in (roughly) non-decreasing timestamp order, which is
+    how the collector receives them.
+    """
+
+    def __init__(self, capacity: int = 200000):
+        self.capacity = capacity
+        self._buf = np.zeros(2 * capacity, dtype=TICK_DTYPE)
+        self._next = 0  # Total ticks ever appended
+
+    def __len__(self) -> int:
+        return min(self._next, self.capacity)
+
+    def append(self, ts: float, ib_bid: float, ib_ask: float, valr_bid: float, valr_ask: float) -> None:
+        pos = self._next % self.capacity
+        row = (ts, ib_bid, ib_ask, valr_bid, valr_ask)
+        self._buf[pos] = row
+        self._buf[pos + self.capacity] = row
+        self._next += 1
+
+    def append_doc(self, doc: Dict) -> None:
+        """Append a tick document as produced by TickCapture"""
+        self.append(doc['timestamp'].timestamp(), _price(doc.get('ib_bid')), _price(doc.get('ib_ask')),
+                    _price(doc.get('valr_bid')), _price(doc.get('valr_ask')))
+
+    def view(self) -> np.ndarray:
+        """All buffered ticks, oldest first, as a read-only view"""
+        n = len(self)
+        end = self._next % self.capacity + self.capacity if self._next >= self.capacity else self._next
+        window = self._buf[end - n:end]
+        window.flags.writeable = False
+        return window
+
+    def latest(self) -> Optional[np.void]:
+        """The most recent tick, or None if the buffer is empty"""
+        if self._next == 0:
+            return None
+        return self._buf[(self._next - 1) % self.capacity]
+
+    @property
+    def oldest_ts(self) -> Optional[float]:
+        if self._next == 0:
+            return None
+        return float(self.view()['ts'][0])
+
+    def range(self, start_ts: float, end_ts: float) -> np.ndarray:
+        """Ticks with start_ts <= ts <= end_ts, oldest first, as a zero-copy view"""
+        window = self.view()
+        ts = window['ts']
+        lo = int(np.searchsorted(ts, start_ts, side='left'))
+        hi = int(np.searchsorted(ts, end_ts, side='right'))
+        return window[lo:hi]
+
+    def covers(self, start_ts: float) -> bool:
+        """True if everything from start_ts onwards is still in the buffer"""
+        oldest = self.oldest_ts
+        return oldest is not None and oldest <= start_ts
+
+    def longest_hole(self, start_ts: float, end_ts: float) -> float:
+        """Longest time in seconds between consecutive buffered ticks around start_ts..end_ts"""
+        ts = self.view()['ts']
+        lo = max(int(np.searchsorted(ts, start_ts, side='left')) - 1, 0)
+        hi = int(np.searchsorted(ts, end_ts, side='right')) + 1
+        span = ts[lo:hi]
+        return float(np.diff(span).max()) if len(span) > 1 else 0.0
+
+
+def _price(value) -> float:
+    return np.nan if value is None else value
+
+
+def serves(fields: Optional[list]) -> bool:
+    """True if a ring holds every requested field (full documents always come from MongoDB)"""
+    return bool(fields) and set(fields) <= set(RING_FIELDS)
+
+
+def to_docs(ticks: np.ndarray, fields: Optional[list] = None, descending: bool = True) -> list:
+    """Convert ring rows to documents shaped like MongoDB results (naive UTC timestamps, whole milliseconds)"""
+    names = [name for name in PRICE_FIELDS if not fields or name in fields]
+    include_ts = not fields or 'timestamp' in fields
+    rows = ticks[::-1] if descending else ticks
+    docs = []
+    for row in rows:
+        doc = {}
+        if include_ts:
+            ts = datetime.fromtimestamp(float(row['ts']), timezone.utc).replace(tzinfo=None)
+            # BSON dates hold milliseconds; MongoDB truncates the rest
+            doc['timestamp'] = ts.replace(microsecond=ts.microsecond // 1000 * 1000)
+        for name in names:
+            value = float(row[name])
+            doc[name] = None if value != value else value
+        docs.append(doc)
+    return docs
+
+
+# In-process buffers keyed by collection name, filled by the collector
+_rings: Dict[str, TickRing] = {}
+
+
+def register_ring(collection: str, capacity: int = 200000) -> TickRing:
+    ring = _rings.get(collection)
+    if ring is None:
+        ring = _rings[collection] = TickRing(capacity)
+        logger.info(f"Tick buffer for {collection}: {capacity} ticks "
+                    f"({ring._buf.nbytes / 1e6:.1f} MB)")
+    return ring
+
+
+def get_ring(collection: str) -> Optional[TickRing]:
+    return _rings.get(collection)
@@ -1,12 +1,90 @@
 import logging
 from datetime import datetime, timezone
 from zoneinfo import ZoneInfo
-from typing import Dict, Any, Optional
+import os
+from typing import Dict, Any, Iterator, List, Optional
+import numpy as np
+from bson import ObjectId
+from pymongo.errors import BulkWriteError, CollectionInvalid
 from mongodb import db_connection
+import bucket_store
+import tick_store
 
 logger = logging.getLogger(__name__)
 
-def insert_usdzar_data(data: Dict[str, Any]) -> bool:
+# Storage layout for price data, per instrument collection (e.g. 'usdzar'):
+#   documents  - one document per sample in db.usdzar (default)
+#   timeseries - MongoDB native time-series collection db.usdzar_ts
+#   buckets    - one document per minute with columnar arrays in db.usdzar_buckets
+STORAGE_MODE = os.environ.get('USDZAR_STORAGE', 'documents').lower()
+COLLECTION_SUFFIXES = {
+    'documents': '',
+    'timeseries': '_ts',
+    'buckets': '_buckets'
+}
+DEFAULT_COLLECTION = 'usdzar'
+# Windows with a longer hole in the in-memory ring may hold rows written by gap_backfill; read those from MongoDB
+RING_MAX_HOLE = float(os.environ.get('BACKFILL_MIN_GAP', '60'))
+_ready_collections = set()
+
+def collection_name(collection: str = DEFAULT_COLLECTION, mode: Optional[str] = None) -> str:
+    """Name of the MongoDB collection holding `collection`'s prices in a storage mode"""
+    mode = mode or STORAGE_MODE
+    if mode not in COLLECTION_SUFFIXES:
+        raise ValueError(f"Unknown USDZAR_STORAGE mode: {mode}")
+    return collection + COLLECTION_SUFFIXES[mode]
+
+def _collection(db, mode: Optional[str] = None, collection: str = DEFAULT_COLLECTION):
+    """Return the price collection for a storage mode, creating it on first use"""
+    mode = mode or STORAGE_MODE
+    name = collection_name(collection, mode)
+    if name not in _ready_collections:
+        ensure_usdzar_storage(db, mode, collection)
+        _ready_collections.add(name)
+    return db[name]
+
+def ensure_usdzar_storage(db, mode: str, collection: str = DEFAULT_COLLECTION) -> None:
+    """Create the time-series collection or bucket indexes for a storage mode."""
+    name = collection_name(collection, mode)
+    if mode == 'timeseries':
+        try:
+            db.create_collection(name, timeseries={
+                'timeField': 'timestamp',
+                'metaField': 'meta',
+                'granularity': 'seconds'
+            })
+            logger.info(f"Created time-series collection {name}")
+        except CollectionInvalid:
+            pass  # Already exists
+    elif mode == 'buckets':
+        collection = db[name]
+        collection.create_index([("bucket_start", 1), ("count", 1)], background=True, name="bucket_fill")
+        collection.create_index([("last", -1), ("first", 1)], background=True, name="bucket_range")
+
+def _from_storage(doc: Dict[str, Any]) -> Dict[str, Any]:
+    """Drop storage-only fields so every mode returns the same document shape"""
+    doc.pop('meta', None)
+    return doc
+
+def _to_mongo_doc(data: Dict[str, Any]) -> Dict[str, Any]:
+    """Copy a price document, filling in and converting its timestamp to UTC"""
+    # Add timestamp if not present
+    if 'timestamp' not in data:
+        data['timestamp'] = datetime.now(ZoneInfo("Africa/Johannesburg"))
+
+    # Create a copy of the data for MongoDB; the instrument is implied by the collection
+    mongo_data = data.copy()
+    mongo_data.pop('instrument', None)
+
+    # Convert timestamp to UTC for storage
+    # MongoDB will store in UTC but maintain the correct instant in time
+    if mongo_data['timestamp'].tzinfo:
+        mongo_data['timestamp'] = mongo_data['timestamp'].astimezone(timezone.utc)
+    # When the document was handed to MongoDB (kept if it already has one, e.g. when migrating)
+    mongo_data.setdefault('persist_time', datetime.now(timezone.utc))
+    return mongo_data
+
+def insert_usdzar_data(data: Dict[str, Any], collection: str = DEFAULT_COLLECTION) -> bool:
     """
     Insert USDZAR price data into the database.
     
@@ -17,60 +95,156 @@ def insert_usdzar_data(data: Dict[str, Any]) -> bool:
             - ib_ask: float
             - valr_bid: float
             - valr_ask: float
+        collection: Instrument collection to write to
     
     Returns:
         bool: True if insertion was successful, False otherwise
     """
     try:
+        if STORAGE_MODE != 'documents':
+            return insert_usdzar_batch([data], collection=collection) == 1
+
         with db_connection() as db:
-            collection = db.usdzar
-            
-            # Add timestamp if not present
-            if 'timestamp' not in data:
-                data['timestamp'] = datetime.now(ZoneInfo("Africa/Johannesburg"))
-            
-            # Create a copy of the data for MongoDB
-            mongo_data = data.copy()
-            
-            # Convert timestamp to UTC for storage
-            # MongoDB will store in UTC but maintain the correct instant in time
-            if mongo_data['timestamp'].tzinfo:
-                mongo_data['timestamp'] = mongo_data['timestamp'].astimezone(timezone.utc)
-                
-            # Insert the document
-            result = collection.insert_one(mongo_data)
-            
-            # Verify insertion
-            inserted_doc = collection.find_one({'_id': result.inserted_id})
-            if inserted_doc:
+            # Insert the document; the acknowledged result confirms the write
+            result = _collection(db, collection=collection).insert_one(_to_mongo_doc(data))
+            if result.acknowledged and result.inserted_id is not None:
                 return True
             else:
-                logger.error("Document not found after insertion")
+                logger.error("Insert was not acknowledged")
                 return False
             
     except Exception as e:
         logger.error(f"Error inserting USDZAR data: {str(e)}")
         return False
 
-def get_latest_usdzar_price() -> Optional[Dict[str, Any]]:
+def insert_usdzar_batch(docs: List[Dict[str, Any]], mode: Optional[str] = None,
+                        collection: str = DEFAULT_COLLECTION, retry: bool = False) -> int:
+    """
+    Insert a batch of USDZAR price documents with a single unordered insert_many.
+    
+    Args:
+        docs: Price documents in the same shape as insert_usdzar_data accepts
+        mode: Storage mode to write to; defaults to USDZAR_STORAGE
+        collection: Instrument collection to write to
+        retry: The batch may already be (partly) stored by an earlier attempt.
+               Time-series and bucket collections do not reject duplicate _ids,
+               so they are looked up and skipped first.
+    
+    Returns:
+        int: Number of documents confirmed written. Documents rejected as
+             duplicates (already written by an earlier attempt) count as written.
+    
+    Raises:
+        Exception: Connection or server errors other than per-document write
+                   errors are raised so the caller can retry the batch.
+    """
+    if not docs:
+        return 0
+    mode = mode or STORAGE_MODE
+    mongo_docs = [_to_mongo_doc(doc) for doc in docs]
+    # Keep the generated _ids on the caller's documents so a retry is idempotent
+    for doc, mongo_doc in zip(docs, mongo_docs):
+        if '_id' not in doc:
+            doc['_id'] = mongo_doc['_id'] = ObjectId()
+    if mode == 'timeseries':
+        meta = {'pair': collection.upper()}
+        for doc in mongo_docs:
+            doc['meta'] = meta
+    with db_connection() as db:
+        coll = _collection(db, mode, collection)
+        if mode != 'documents' and retry:
+            # Only documents mode has a unique _id; skip what an earlier attempt already stored
+            stored = _stored_ids(coll, mode, mongo_docs)
+            pending = [doc for doc in mongo_docs if doc['_id'] not in stored]
+        else:
+            pending = mongo_docs
+        if not pending:
+            return len(mongo_docs)
+        if mode == 'buckets':
+            result = coll.bulk_write(bucket_store.bucket_updates(pending), ordered=False)
+            return len(mongo_docs) if result.acknowledged else 0
+        try:
+            result = coll.insert_many(pending, ordered=False)
+            return len(mongo_docs) - len(pending) + len(result.inserted_ids) if result.acknowledged else 0
+        except BulkWriteError as e:
+            details = e.details
+            duplicates = sum(1 for err in details.get('writeErrors', []) if err.get('code') == 11000)
+            if duplicates < len(details.get('writeErrors', [])):
+                logger.error(f"Bulk insert rejected {len(details['writeErrors']) - duplicates} documents: "
+                             f"{details['writeErrors'][0].get('errmsg')}")
+            return len(mongo_docs) - len(pending) + details.get('nInserted', 0) + duplicates
+
+def _stored_ids(coll, mode: str, mongo_docs: List[Dict[str, Any]]) -> set:
+    """The _ids among `mongo_docs` already in a time-series or bucket collection"""
+    ids = [doc['_id'] for doc in mongo_docs]
+    first = min(doc['timestamp'] for doc in mongo_docs)
+    last = max(doc['timestamp'] for doc in mongo_docs)
+    if mode == 'buckets':
+        # Bounded by bucket_start so the lookup uses the bucket_fill index
+        query = {'bucket_start': {'$gte': bucket_store.bucket_start(first), '$lte': last}, 'ids': {'$in': ids}}
+        wanted = set(ids)
+        return {i for bucket in coll.find(query, projection={'_id': 0, 'ids': 1}) for i in bucket['ids'] if i in wanted}
+    query = {'timestamp': {'$gte': first, '$lte': last}, '_id': {'$in': ids}}
+    return {doc['_id'] for doc in coll.find(query, projection={'_id': 1})}
+
+def insert_tick_batch(docs: List[Dict[str, Any]], collections: Dict[str, str], retry: bool = False) -> int:
+    """
+    Insert ticks for several instruments, routing each by its 'instrument' field.
+    
+    Args:
+        docs: Price documents, each with an 'instrument' name
+        collections: Mapping of instrument name to collection
+        retry: The batch may already be (partly) stored, see insert_usdzar_batch
+    
+    Returns:
+        int: Number of documents confirmed written across all collections
+    """
+    groups: Dict[str, List[Dict[str, Any]]] = {}
+    for doc in docs:
+        collection = collections.get(doc.get('instrument'), DEFAULT_COLLECTION)
+        groups.setdefault(collection, []).append(doc)
+    return sum(insert_usdzar_batch(group, collection=collection, retry=retry) for collection, group in groups.items())
+
+def get_latest_usdzar_price(collection: str = DEFAULT_COLLECTION, fields: list = None) -> Optional[Dict[str, Any]]:
     """
     Get the most recent USDZAR price data.
     
+    Args:
+        collection: Instrument collection to read from
+        fields: List of fields to return, e.g. ['timestamp', 'ib_bid']; all fields if not given
+    
     Returns:
         Optional[Dict]: Latest price data or None if no data exists
     """
+    ring = tick_store.get_ring(collection)
+    if ring is not None and len(ring) and tick_store.serves(fields):
+        # Served from the collector's in-memory buffer when running in-process
+        latest = tick_store.to_docs(ring.view()[-1:], fields)[0]
+        if 'timestamp' in latest:
+            latest['timestamp'] = latest['timestamp'].replace(tzinfo=timezone.utc).astimezone(ZoneInfo('Africa/Johannesburg'))
+        return latest
+
     try:
         with db_connection() as db:
-            collection = db.usdzar
+            collection = _collection(db, collection=collection)
             
-            # Get the most recent document by timestamp
-            latest = collection.find_one(
-                sort=[('timestamp', -1)]  # -1 for descending order
-            )
+            if STORAGE_MODE == 'buckets':
+                bucket = collection.find_one(sort=[('last', -1)])
+                latest = bucket_store.latest_row(bucket) if bucket else None
+            else:
+                # Get the most recent document by timestamp
+                latest = collection.find_one(
+                    sort=[('timestamp', -1)]  # -1 for descending order
+                )
             
             if latest:
+                _from_storage(latest)
+                if fields:
+                    latest = {field: latest[field] for field in fields if field in latest}
+            
                 # Convert UTC timestamp to SA time
-                latest['timestamp'] = latest['timestamp'].replace(tzinfo=timezone.utc).astimezone(ZoneInfo('Africa/Johannesburg'))
+                if 'timestamp' in latest:
+                    latest['timestamp'] = latest['timestamp'].replace(tzinfo=timezone.utc).astimezone(ZoneInfo('Africa/Johannesburg'))
             
             return latest
             
@@ -78,11 +252,11 @@ def get_latest_usdzar_price() -> Optional[Dict[str, Any]]:
         logger.error(f"Error retrieving latest USDZAR data: {str(e)}")
         return None
 
-def create_usdzar_indexes():
+def create_usdzar_indexes(collection: str = DEFAULT_COLLECTION):
     """Create necessary indexes for the USDZAR collection."""
     try:
         with db_connection() as db:
-            collection = db.usdzar
+            collection = db[collection]
             
             # Create timestamp index for efficient time-based queries
             collection.create_index([("timestamp", -1)], 
@@ -110,7 +284,8 @@ def create_usdzar_indexes():
     except Exception as e:
         logger.error(f"Error creating indexes: {str(e)}")
 
-def get_price_data_range(start_time: datetime, end_time: datetime, fields: list = None) -> list:
+def get_price_data_range(start_time: datetime, end_time: datetime, fields: list = None,
+                         collection: str = DEFAULT_COLLECTION) -> list:
     """Get price data for a specific time range.
     
     Args:
@@ -118,13 +293,28 @@ def get_price_data_range(start_time: datetime, end_time: datetime, fields: list
         end_time: End of the time range
         fields: List of fields to return (optimization for partial document reads)
                e.g., ['timestamp', 'ib_bid', 'valr_ask']
+        collection: Instrument collection to read from
     
     Returns:
         list: List of price data documents within the time range
     """
+    ring = tick_store.get_ring(collection)
+    start_ts, end_ts = _epoch(start_time), _epoch(end_time)
+    if (ring is not None and tick_store.serves(fields) and ring.covers(start_ts)
+            and ring.longest_hole(start_ts, end_ts) <= RING_MAX_HOLE):
+        # The whole window is still in memory and has nothing backfilled; skip the database round trip
+        return tick_store.to_docs(ring.range(start_ts, end_ts), fields)
+
     try:
         with db_connection() as db:
-            collection = db.usdzar
+            collection = _collection(db, collection=collection)
+            
+            if STORAGE_MODE == 'buckets':
+                rows = []
+                for bucket in collection.find(bucket_store.range_query(start_time, end_time)):
+                    rows.extend(bucket_store.unpack_bucket(bucket, start_time, end_time, fields))
+                rows.sort(key=lambda row: row['timestamp'], reverse=True)
+                return rows
             
             # Prepare projection for selective field retrieval
             projection = None
@@ -145,8 +335,137 @@ def get_price_data_range(start_time: datetime, end_time: datetime, fields: list
                 projection=projection
             ).sort("timestamp", -1)
             
-            return list(cursor)
+            return [_from_storage(doc) for doc in cursor]
             
     except Exception as e:
         logger.error(f"Error retrieving price data range: {str(e)}")
         return []
+
+
+
+PRICE_FIELDS = ['ib_bid', 'ib_ask', 'valr_bid', 'valr_ask']
+STREAM_OUTPUTS = ('numpy', 'pandas', 'arrow')
+
+
+class _ColumnBatch:
+    """Fixed-size column buffers filled row by row and reused between batches"""
+
+    def __init__(self, fields: List[str], size: int):
+        self.fields = fields
+        self.size = size
+        self.columns = {}
+        for field in fields:
+            if field == 'timestamp' or field.endswith('_time'):
+                self.columns[field] = np.empty(size, dtype='datetime64[us]')
+            elif field in PRICE_FIELDS or field.endswith('_mono') or field == 'quote_skew':
+                self.columns[field] = np.empty(size, dtype='f8')
+            else:
+                self.columns[field] = np.empty(size, dtype=object)
+        self.count = 0
+
+    def add(self, row: Dict[str, Any]) -> bool:
+        """Append a row; returns True once the batch is full"""
+        i = self.count
+        for field, column in self.columns.items():
+            value = row.get(field)
+            if value is None and column.dtype.kind == 'f':
+                value = np.nan
+            elif column.dtype.kind == 'M':
+                value = np.datetime64('NaT') if value is None else _naive_utc(value)
+            column[i] = value
+        self.count += 1
+        return self.count >= self.size
+
+    def take(self) -> Dict[str, np.ndarray]:
+        """Copy out the filled rows and reset for the next batch"""
+        out = {field: column[:self.count].copy() for field, column in self.columns.items()}
+        self.count = 0
+        return out
+
+
+def _naive_utc(value: datetime) -> datetime:
+    return value.astimezone(timezone.utc).replace(tzinfo=None) if value.tzinfo else value
+
+
+def _convert_batch(columns: Dict[str, np.ndarray], output: str):
+    if output == 'pandas':
+        import pandas as pd
+        return pd.DataFrame(columns)
+    if output == 'arrow':
+        import pyarrow as pa
+        return pa.RecordBatch.from_pydict(columns)
+    return columns
+
+
+def _iter_bucket_rows(collection, start_time: datetime, end_time: datetime, fields: List[str],
+                      ascending: bool, batch_size: int) -> Iterator[Dict[str, Any]]:
+    projection = {field: 1 for field in set(fields) | {'timestamp'}}
+    cursor = collection.find(bucket_store.range_query(start_time, end_time), projection=projection) \
+        .sort('bucket_start', 1 if ascending else -1).batch_size(max(1, batch_size // 100))
+    for bucket in cursor:
+        rows = list(bucket_store.unpack_bucket(bucket, start_time, end_time, fields + ['timestamp']))
+        rows.sort(key=lambda row: row['timestamp'], reverse=not ascending)
+        yield from rows
+
+
+def iter_price_data_range(start_time: datetime, end_time: datetime, fields: list = None,
+                          batch_size: int = 10000, ascending: bool = True, output: str = 'numpy',
+                          collection: str = DEFAULT_COLLECTION) -> Iterator[Any]:
+    """Stream price data for a time range in fixed-size columnar batches.
+
+    Unlike get_price_data_range, documents are never all held in memory:
+    the cursor is consumed `batch_size` rows at a time and only the
+    requested fields are fetched from MongoDB.
+
+    Args:
+        start_time: Start of the time range
+        end_time: End of the time range
+        fields: Fields to return (default: timestamp, prices and source)
+        batch_size: Rows per yielded batch
+        ascending: Oldest first if True, newest first otherwise
+        output: 'numpy' (dict of column arrays), 'pandas' (DataFrame) or 'arrow' (RecordBatch)
+        collection: Instrument collection to read from
+
+    Yields:
+        One batch of at most batch_size rows at a time
+    """
+    if output not in STREAM_OUTPUTS:
+        raise ValueError(f"Unknown output format: {output}")
+    fields = list(fields) if fields else ['timestamp'] + PRICE_FIELDS + ['source']
+    batch = _ColumnBatch(fields, batch_size)
+
+    with db_connection() as db:
+        coll = _collection(db, collection=collection)
+        if STORAGE_MODE == 'buckets':
+            rows = _iter_bucket_rows(coll, start_time, end_time, fields, ascending, batch_size)
+        else:
+            projection = {field: 1 for field in fields}
+            projection['_id'] = 0
+            query = {"timestamp": {"$gte": start_time, "$lte": end_time}}
+            rows = coll.find(query, projection=projection) \
+                .sort("timestamp", 1 if ascending else -1).batch_size(batch_size)
+
+        for row in rows:
+            if batch.add(row):
+                yield _convert_batch(batch.take(), output)
+        if batch.count:
+            yield _convert_batch(batch.take(), output)
+
+def get_price_array_range(start_time: datetime, end_time: datetime,
+                          collection: str = DEFAULT_COLLECTION):
+    """Get buffered ticks for a time range as a read-only numpy view.
+
+    Only the collector's in-memory buffer is consulted; returns None if the
+    buffer does not reach back to start_time.
+    """
+    ring = tick_store.get_ring(collection)
+    if ring is None or not ring.covers(_epoch(start_time)):
+        return None
+    return ring.range(_epoch(start_time), _epoch(end_time))
+
+
+def _epoch(value: datetime) -> float:
+    """Epoch seconds for a datetime; naive values are treated as UTC like pymongo does"""
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.timestamp()
@@ -0,0 +1,161 @@
+"""Decoding of VALR websocket frames."""
+import json
+import logging
+import os
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+BOOK_UPDATE = 'AGGREGATED_ORDERBOOK_UPDATE'
+BACKENDS = ('msgspec', 'orjson', 'json')
+
+_TYPE_KEY = '"type"'
+
+
+def available_backends() -> List[str]:
+    return [name for name, module in zip(BACKENDS, (msgspec, orjson, json)) if module is not None]
+
+
+def peek_type(raw: str) -> Optional[str]:
+    """The value of the first "type" key in a raw frame, without parsing it.
+
+    VALR sends the type as the first key of every message. Returns None if
+    no plain string value is found, in which case the frame has to be parsed.
+    """
+    i = raw.find(_TYPE_KEY)
+    if i < 0:
+        return None
+    i += len(_TYPE_KEY)
+    start = raw.find('"', i)
+    if start < 0 or raw[i:start].strip() != ':':
+        return None
+    end = raw.find('"', start + 1)
+    if end < 0:
+        return None
+    return raw[start + 1:end]
+
+
+class BookUpdate:
+    """One decoded AGGREGATED_ORDERBOOK_UPDATE, levels best first"""
+
+    __slots__ = ('pair', 'bid_prices', 'bid_quantities', 'ask_prices', 'ask_quantities', 'sequence', 'last_change')
+
+    def __init__(self, pair: Optional[str], bid_prices: list, bid_quantities: list, ask_prices: list,
+                 ask_quantities: list, sequence: Optional[int], last_change):
+        self.pair = pair
+        self.bid_prices = bid_prices
+        self.bid_quantities = bid_quantities
+        self.ask_prices = ask_prices
+        self.ask_quantities = ask_quantities
+        self.sequence = sequence
+        self.last_change = last_change
+
+    def apply_to(self, book) -> bool:
+        """Apply to an OrderBook; returns True if the best bid or ask changed"""
+        return book.apply_levels(self.bid_prices, self.bid_quantities, self.ask_prices, self.ask_quantities,
+                                 self.sequence, self.last_change)
+
+
+if msgspec is not None:
+    class _Level(msgspec.Struct, gc=False):
+        price: float
+        quantity: float
+
+    class _BookData(msgspec.Struct, gc=False):
+        Bids: List[_Level] = []
+        Asks: List[_Level] = []
+        LastChange: Union[int, str, None] = None
+        SequenceNumber: Optional[int] = None
+
+    class _BookMessage(msgspec.Struct, gc=False):
+        data: _BookData
+        currencyPairSymbol: Optional[str] = None
+
+
+def _book_from_dict(message: Dict[str, Any]) -> BookUpdate:
+    data = message.get('data') or {}
+    try:
+        bids = data.get('Bids') or ()
+        asks = data.get('Asks') or ()
+        return BookUpdate(message.get('currencyPairSymbol'),
+                          [level['price'] for level in bids], [level['quantity'] for level in bids],
+                          [level['price'] for level in asks], [level['quantity'] for level in asks],
+                          data.get('SequenceNumber'), data.get('LastChange'))
+    except (KeyError, TypeError, AttributeError) as e:
+        raise ValueError(f"Malformed order book update: {e!r}") from e
+
+
+class ValrDecoder:
+    """Decode VALR frames with the chosen JSON backend"""
+
+    def __init__(self, backend: Optional[str] = None):
+        backend = (backend or os.environ.get('VALR_JSON_BACKEND', 'auto')).lower()
+        available = available_backends()
+        if backend == 'auto':
+            backend = available[0]
+        elif backend not in available:
+            raise ValueError(f"JSON backend {backend} is not available (installed: {', '.join(available)})")
+        self.backend = backend
+        self.loads: Callable[[Union[str, bytes]], Any] = orjson.loads if backend == 'orjson' else json.loads
+        if backend == 'msgspec':
+            self.loads = msgspec.json.decode
+            self._book_decoder = msgspec.json.Decoder(_BookMessage, strict=False)  # numeric strings -> float
+            self._decode_book = self._decode_book_msgspec
+        else:
+            self._decode_book = self._decode_book_dict
+
+        self.decoded = 0
+        self.skipped = 0
+
+    def decode(self, raw: Union[str, bytes]) -> Tuple[Optional[str], Any]:
+        """Return (message type, payload).
+
+        The payload is a BookUpdate for order book updates, the parsed
+        message if its type could not be read from the raw frame, and None
+        for every other type. Raises ValueError for malformed frames.
+        """
+        if isinstance(raw, bytes):
+            raw = raw.decode('utf-8')
+        msg_type = peek_type(raw)
+        if msg_type is None:
+            message = self.loads(raw)
+            if not isinstance(message, dict):
+                raise ValueError("VALR message is not a JSON object")
+            msg_type = message.get('type')
+            if msg_type == BOOK_UPDATE:
+                self.decoded += 1
+                return msg_type, _book_from_dict(message)
+            return msg_type, message
+        if msg_type == BOOK_UPDATE:
+            self.decoded += 1
+            return msg_type, self._decode_book(raw)
+        self.skipped += 1
+        return msg_type, None
+
+    def _decode_book_msgspec(self, raw: str) -> BookUpdate:
+        message = self._book_decoder.decode(raw)
+        data = message.data
+        bids, asks = data.Bids, data.Asks
+        return BookUpdate(message.currencyPairSymbol,
+                          [level.price for level in bids], [level.quantity for level in bids],
+                          [level.price for level in asks], [level.quantity for level in asks],
+                          data.SequenceNumber, data.LastChange)
+
+    def _decode_book_dict(self, raw: str) -> BookUpdate:
+        message = self.loads(raw)
+        if not isinstance(message, dict):
+            raise ValueError("VALR message is not a JSON object")
+        return _book_from_dict(message)
+
+    def stats(self) -> Dict[str, Any]:
+        return {'backend': self.backend, 'decoded': self.decoded, 'skipped': self.skipped}
@@ -1,12 +1,17 @@
-import websocket
+import asyncio
 import json
 import hmac
 import hashlib
 import time
 import os
 import logging
+from datetime import datetime
+from zoneinfo import ZoneInfo
+import websockets
 from dotenv import load_dotenv
-from typing import Optional, Tuple, Callable
+from typing import Callable, Dict, List, Optional, Tuple
+from orderbook import OrderBook
+from valr_decode import BOOK_UPDATE, ValrDecoder
 
 # Configure logging
 logging.basicConfig(
@@ -14,22 +19,62 @@ logging.basicConfig(
     format='%(asctime)s - %(levelname)s - %(message)s'
 )
 
+SA_TZ = ZoneInfo("Africa/Johannesburg")
+
+
+def parse_event_time(value) -> Optional[float]:
+    """VALR LastChange (epoch ms or ISO-8601) as epoch seconds"""
+    if value is None:
+        return None
+    try:
+        if isinstance(value, (int, float)) or str(value).isdigit():
+            return int(value) / 1000
+        return datetime.fromisoformat(str(value).replace('Z', '+00:00')).timestamp()
+    except ValueError:
+        return None
+
+
 class ValrWebSocket:
-    def __init__(self, on_price_update: Optional[Callable[[float, float], None]] = None):
+    """asyncio VALR trade websocket client.
+
+    Runs on the same event loop as ib_insync. Each pair's full aggregated
+    order book is kept in `self.books`; top-of-book changes are handed
+    to consumers through `self.updates`, an asyncio.Queue of
+    (receive_time, receive_monotonic, pair, bid, ask, event_time) tuples,
+    where event_time is VALR's LastChange for the book (epoch seconds) or
+    None. All pairs share one subscription. The connection is re-established in a
+    loop with exponential backoff, and is dropped if the server stops
+    answering either websocket pings or VALR's application-level PING.
+    """
+
+    def __init__(self, pairs: Optional[List[str]] = None, queue_size: int = 10000,
+                 ping_interval: float = 20, ping_timeout: float = 10):
         load_dotenv()
         self.api_key = os.getenv('VALR_API_KEY')
         self.api_secret = os.getenv('VALR_API_SECRET')
-        self.ws_url = "wss://api.valr.com/ws/trade"
+        self.ws_url = os.getenv('VALR_WS_URL', "wss://api.valr.com/ws/trade")
         self.ws = None
-        self.on_price_update = on_price_update
-        self.last_bid: Optional[float] = None
-        self.last_ask: Optional[float] = None
+        self.pairs = pairs or ["USDTZAR"]
+        self.ping_interval = ping_interval
+        self.ping_timeout = ping_timeout
+        self.queue_size = queue_size
+        self.updates: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._connected = False
+        self.last_pong: float = 0.0
+        self.books: Dict[str, OrderBook] = {}  # Full L2 book per pair
+        self.decoder = ValrDecoder()  # VALR_JSON_BACKEND picks the JSON library
+        self.on_raw: Optional[Callable[[str], None]] = None  # e.g. replay.FrameRecorder.valr_frame
+
+        self.messages = 0
+        self.reconnects = 0
+        self.dropped_updates = 0
 
     def _generate_signature(self, timestamp: int) -> str:
         path = "/ws/trade"
         verb = "GET"
         body = ""
-        
+
         message = str(timestamp) + verb + path + body
         signature = hmac.new(
             self.api_secret.encode('utf-8'),
@@ -38,93 +83,147 @@ class ValrWebSocket:
         ).hexdigest()
         return signature
 
-    def on_message(self, ws, message):
-        data = json.loads(message)
-        if data.get('type') == 'AUTHENTICATED':
-            self.subscribe_to_orderbook()
-        elif data.get('type') == 'AGGREGATED_ORDERBOOK_UPDATE':
-            orderbook = data.get('data', {})
-            bids = orderbook.get('Bids', [])
-            asks = orderbook.get('Asks', [])
-            
-            if bids and asks:
-                try:
-                    bid = float(bids[0]['price'])
-                    ask = float(asks[0]['price'])
-                    self.last_bid = bid
-                    self.last_ask = ask
-                    if self.on_price_update:
-                        self.on_price_update(bid, ask)
-                except (IndexError, KeyError, ValueError) as e:
-                    print(f"Error parsing prices: {e}")
-
-    def on_error(self, ws, error):
-        logging.error(f"VALR WebSocket error: {error}")
-        self._reconnect()
-
-    def on_close(self, ws, close_status_code, close_msg):
-        logging.warning(f"VALR WebSocket closed. Code: {close_status_code}, Message: {close_msg}")
-        self._reconnect()
-
-    def on_open(self, ws):
-        logging.info("VALR WebSocket connected")
-
-    def _reconnect(self):
-        """Attempt to reconnect with exponential backoff"""
-        max_retries = 5
-        retry_delay = 5  # Initial delay in seconds
-
-        for attempt in range(max_retries):
-            try:
-                time.sleep(retry_delay)
-                logging.info(f"Attempting to reconnect to VALR (attempt {attempt + 1}/{max_retries})")
-                self.connect()
-                return
-            except Exception as e:
-                logging.error(f"Reconnection attempt {attempt + 1} failed: {e}")
-                retry_delay = min(retry_delay * 2, 60)  # Double delay up to 60 seconds
-
-        logging.error("Failed to reconnect to VALR after maximum retries")
-
-    def get_current_prices(self) -> Tuple[Optional[float], Optional[float]]:
-        """Get the most recent bid and ask prices"""
-        return self.last_bid, self.last_ask
-
-    def connect(self):
+    def _headers(self) -> dict:
         timestamp = int(time.time() * 1000)
-        signature = self._generate_signature(timestamp)
-
-        headers = {
+        return {
             'X-VALR-API-KEY': self.api_key,
-            'X-VALR-SIGNATURE': signature,
+            'X-VALR-SIGNATURE': self._generate_signature(timestamp),
             'X-VALR-TIMESTAMP': str(timestamp)
         }
 
-        self.ws = websocket.WebSocketApp(
+    async def on_message(self, message):
+        recv_time = datetime.now(SA_TZ)
+        recv_mono = time.monotonic()
+        self.messages += 1
+        if self.on_raw is not None:
+            self.on_raw(message)
+        try:
+            msg_type, payload = self.decoder.decode(message)
+        except ValueError as e:
+            logging.error(f"Invalid VALR message: {e}")
+            return
+        if msg_type == BOOK_UPDATE:
+            pair = payload.pair or 'USDTZAR'
+            book = self.books.get(pair)
+            if book is None:
+                book = self.books[pair] = OrderBook(pair)
+            if not payload.apply_to(book):
+                return  # Only deeper levels moved
+            bid, ask = book.best_bid, book.best_ask
+            if bid is not None and ask is not None:
+                self._publish((recv_time, recv_mono, pair, bid, ask, parse_event_time(book.last_change)))
+        elif msg_type == 'AUTHENTICATED':
+            await self.subscribe_to_orderbook()
+        elif msg_type == 'PONG':
+            self.last_pong = time.monotonic()
+
+    def _publish(self, update: tuple) -> None:
+        """Queue an update, discarding the oldest one if consumers fall behind"""
+        if self.updates.full():
+            self.updates.get_nowait()
+            self.dropped_updates += 1
+        self.updates.put_nowait(update)
+
+    def get_current_prices(self, pair: Optional[str] = None) -> Tuple[Optional[float], Optional[float]]:
+        """Get the most recent bid and ask prices for a pair (default: the first subscribed)"""
+        book = self.books.get(pair or self.pairs[0])
+        if book is None:
+            return None, None
+        return book.best_bid, book.best_ask
+
+    def start(self) -> asyncio.Task:
+        """Start the connection task on the running event loop"""
+        if self.updates is None:
+            # Created here so the queue belongs to the running loop
+            self.updates = asyncio.Queue(maxsize=self.queue_size)
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self.run())
+        return self._task
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    @property
+    def connected(self) -> bool:
+        return self._connected and self.ws is not None
+
+    async def restart(self) -> asyncio.Task:
+        """Cancel the connection task, including any backoff wait, and start a fresh one"""
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        self._connected = False
+        self.ws = None
+        return self.start()
+
+    async def run(self, max_retry_delay: float = 60):
+        """Connect and process messages forever, reconnecting with exponential backoff"""
+        retry_delay = 1
+        while True:
+            self._connected = False
+            try:
+                await self._connect_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"VALR WebSocket error: {e}")
+            if self._connected:
+                retry_delay = 1  # Lost an established connection: reconnect promptly
+            self.reconnects += 1
+            logging.info(f"Reconnecting to VALR in {retry_delay} seconds (reconnect {self.reconnects})")
+            await asyncio.sleep(retry_delay)
+            retry_delay = min(retry_delay * 2, max_retry_delay)
+
+    async def _connect_once(self):
+        async with websockets.connect(
             self.ws_url,
-            header=[": ".join([k, v]) for k, v in headers.items()],
-            on_message=self.on_message,
-            on_error=self.on_error,
-            on_close=self.on_close,
-            on_open=self.on_open
-        )
-        
-        self.ws.run_forever()
-
-    def subscribe_to_orderbook(self):
+            extra_headers=self._headers(),
+            ping_interval=self.ping_interval,
+            ping_timeout=self.ping_timeout
+        ) as ws:
+            self.ws = ws
+            self._connected = True
+            self.last_pong = time.monotonic()
+            logging.info("VALR WebSocket connected")
+            keepalive = asyncio.ensure_future(self._keepalive(ws))
+            try:
+                async for message in ws:
+                    await self.on_message(message)
+                logging.warning(f"VALR WebSocket closed. Code: {ws.close_code}, Message: {ws.close_reason}")
+            finally:
+                keepalive.cancel()
+                self.ws = None
+
+    async def _keepalive(self, ws):
+        """Send VALR's application-level PING and drop the socket if PONGs stop"""
+        while True:
+            await asyncio.sleep(self.ping_interval)
+            if time.monotonic() - self.last_pong > self.ping_interval + self.ping_timeout:
+                logging.error("VALR PONG timeout, closing connection")
+                await ws.close()
+                return
+            await ws.send(json.dumps({"type": "PING"}))
+
+    async def reconnect(self):
+        """Drop the current connection; `run` will establish a new one"""
+        if self.ws is not None:
+            await self.ws.close()
+
+    async def subscribe_to_orderbook(self):
         if self.ws:
             subscribe_message = {
                 "type": "SUBSCRIBE",
                 "subscriptions": [
                     {
                         "event": "AGGREGATED_ORDERBOOK_UPDATE",
-                        "pairs": ["USDTZAR"]
+                        "pairs": self.pairs
                     }
                 ]
             }
-            self.ws.send(json.dumps(subscribe_message))
+            await self.ws.send(json.dumps(subscribe_message))
 
-    def unsubscribe_from_orderbook(self):
+    async def unsubscribe_from_orderbook(self):
         if self.ws:
             unsubscribe_message = {
                 "type": "SUBSCRIBE",
@@ -135,4 +234,4 @@ class ValrWebSocket:
                     }
                 ]
             }
-            self.ws.send(json.dumps(unsubscribe_message))
+            await self.ws.send(json.dumps(unsubscribe_message))